@@ -1,8 +1,13 @@
 #!/usr/bin/python
 # -*- coding:Utf-8 -*-
 
-from holygrail import _Realm, _Quest, _Mission, _TagMission
+from holygrail import _Realm, _Quest, _Mission, _Tag, _TagMission
 from holygrail import *
+from holygrail_async import AsyncGrail
+from holygrail_read_model import ReadModel
+from holygrail_dump import dump, restore
+from holygrail_tracks import import_tracks
+from holygrail_exceptions import CallCancelled, CallQueueFull, RepeatedQueriesWarning
 
 VERSION="0.1.2 Galahad"
 
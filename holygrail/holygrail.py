@@ -21,15 +21,30 @@ HolyGrail  Copyright (C) 2010  Laurent Peuch  <cortex@worlddomination.be>
 """
 
 import sqlobject
+from sqlobject import sqlbuilder
+from sqlobject.dbconnection import Transaction, ConnectionHub, Iteration
+from sqlobject.sresults import SelectResults
 import os
+import re
+import json
+import time
+import types
+import warnings
+import functools
+import base64
+import threading
 import ConfigParser
 
 
 from holygrail_exceptions import RealmDoesntExist,\
     MissionDoesntExist, RealmStillHasElems, CanRemoveTheDefaultRealm,\
-    QuestDoesntExist, NoDatabaseConfiguration, WaitForError
+    QuestDoesntExist, NoDatabaseConfiguration, WaitForError, RepeatedQueriesWarning
 
 from datetime import date, datetime, timedelta
+from itertools import groupby, islice
+from heapq import merge
+from contextlib import contextmanager
+from collections import OrderedDict
 
 config = ConfigParser.ConfigParser()
 config.read(["holygrailrc", os.path.expanduser("~/.holygrailrc")])
@@ -37,7 +52,54 @@ DATABASE_ACCESS = config.get("holygrail", "uri") if config.has_option("holygrail
 
 __version__ = "Galahad 0.1"
 
-class _Realm(sqlobject.SQLObject):
+# number of changes kept by the change log, see Grail.changes_since()
+CHANGES_KEPT = 10000
+# the change log is compacted every time this number of changes is written
+CHANGES_COMPACT_EVERY = 1000
+# maximum number of missions kept by the cache of the views of a Grail
+VIEW_CACHE_LIMIT = 100000
+# number of days after which a completed mission is archived by
+# Grail.archive_missions()
+ARCHIVE_AFTER = 30
+# a call that run the same query more than this number of times, with
+# different values issue a RepeatedQueriesWarning, see Grail.stats()
+REPEATED_QUERIES = 20
+
+# the _QueryCounter of the current thread, see _instrument()
+_recording = threading.local()
+
+
+class _CountedIteration(Iteration):
+    """
+    Intern iteration over the rows of a select that count them in the
+    _QueryCounter of the thread.
+    """
+    def next(self):
+        row = super(_CountedIteration, self).next()
+        _count_rows(1)
+        return row
+
+
+class _SelectResults(SelectResults):
+    IterationClass = _CountedIteration
+
+
+class _GrailObject(sqlobject.SQLObject):
+    """
+    Base class of the HolyGrail tables.
+
+    Inside a Grail.transaction() the modifications of the attributes aren't
+    written immediately, see _Transaction.
+    """
+    class sqlmeta:
+        @property
+        def lazyUpdate(self):
+            return isinstance(_real_connection(self.instance._connection), _Transaction)
+
+    SelectResultsClass = _SelectResults
+
+
+class _Realm(_GrailObject):
     """
     A realm.
 
@@ -56,27 +118,19 @@ class _Realm(sqlobject.SQLObject):
     hide = sqlobject.BoolCol(default=False)
     position = sqlobject.IntCol(unique=True)
 
+    description_index = sqlobject.DatabaseIndex({'column': 'description', 'length': 255})
+
     def get_missions(self, all_missions=False):
         """
-        Get the missions associated to this quest.
+        Get the missions associated to this realm.
 
-        Return a list of a list of missions.
+        Return a generator of missions.
         """
-        def visible(mission):
-            """
-            A method that return True if the mission will be display in the main_view
-            or in list_missions. You normaly needn't use it.
-            """
-            return (not mission.previous_mission or mission.previous_mission.completed)\
-                and (not mission.quest or (not mission.quest.hide and not mission.quest.completed\
-                and ((mission.quest.tickler == None) or (mission.quest.tickler < datetime.now()))))
-
         if not all_missions:
-            for i in _Mission.select(sqlobject.AND(_Mission.q.completed == False, sqlobject.OR(_Mission.q.tickler == None, _Mission.q.tickler < datetime.now()), _Mission.q.realm == self)):
-                if visible(i):
-                    yield i
+            for i in _visible_missions(self._connection, _Mission.q.realm == self, check_realm=False):
+                yield i
         else:
-            for i in _Mission.select(_Mission.q.realm == self):
+            for i in _Mission.select(_Mission.q.realm == self, connection=self._connection):
                 yield i
 
     def change_position(self, new_position):
@@ -85,23 +139,22 @@ class _Realm(sqlobject.SQLObject):
 
         Arguments:
             * new_position: the new position of the realm, if the position is
-              > at the max position, it will simply be put at the end
+              > at the max position, it will simply be put at the end, if
+              it's < 0 at the beginning
         """
+        new_position = max(0, min(new_position, _Realm.select(connection=self._connection).count() - 1))
         if new_position == self.position:
             return
 
-        realms = [i for i in self.select().orderBy("position")]
-        if new_position > self.position:
-            # since insert() insert before
-            realms.insert(new_position + 1, self)
-            realms.remove(self)
-        else:
-            realms.remove(self)
-            realms.insert(new_position, self)
-        for i in realms:
-            i.position = None
-        for i in realms:
-            i.position = realms.index(i)
+        with _transaction(self._connection):
+            old_position = self.position
+            self.position = None
+            # the realms between the old and the new position move by one
+            if new_position > old_position:
+                _shift_positions(self._connection, old_position + 1, new_position, -1)
+            else:
+                _shift_positions(self._connection, new_position, old_position - 1, 1)
+            self.position = new_position
 
     def remove(self):
         """
@@ -115,17 +168,14 @@ class _Realm(sqlobject.SQLObject):
         """
         if self.default_realm:
             raise CanRemoveTheDefaultRealm
-        elif _Mission.select(_Mission.q.realm == self).count() != 0:
-            raise RealmStillHasElems
-        else:
-            self.destroySelf()
+        with _transaction(self._connection) as connection:
+            if connection.queryOne("SELECT id FROM _mission WHERE realm_id = %d LIMIT 1" % self.id) or\
+               connection.queryOne("SELECT id FROM _archived_mission WHERE realm_id = %d LIMIT 1" % self.id):
+                raise RealmStillHasElems
+            _delete_rows(connection, _Realm, [self.id])
 
-        # update position after removing one realm
-        realms = [i for i in _Realm.select().orderBy("position")]
-        i = 0
-        while i < len(realms):
-            realms[i].position = i
-            i += 1
+            # update position after removing one realm
+            _shift_positions(connection, self.position + 1, None, -1)
 
     def rename(self, new_description):
         """
@@ -140,7 +190,7 @@ class _Realm(sqlobject.SQLObject):
         """
         Set this realm as the new default realm.
         """
-        self.select(self.q.default_realm == True)[0].default_realm = False
+        self.select(self.q.default_realm == True, connection=self._connection)[0].default_realm = False
         self.default_realm = True
 
     def toggle_hide(self):
@@ -150,7 +200,7 @@ class _Realm(sqlobject.SQLObject):
         self.hide = not self.hide
 
 
-class _Mission(sqlobject.SQLObject):
+class _Mission(_GrailObject):
     """
     A Mission object.
 
@@ -166,17 +216,36 @@ class _Mission(sqlobject.SQLObject):
     tickler = sqlobject.DateTimeCol(default=None)
     realm = sqlobject.ForeignKey('_Realm')
     quest = sqlobject.ForeignKey('_Quest', default=None)
+    # the mission given to wait_for(), the missions waited for are in
+    # _Prerequisite
     previous_mission = sqlobject.ForeignKey('_Mission', default=None)
     completed_at = sqlobject.DateTimeCol(default=None)
     _due = sqlobject.DateTimeCol(default=None)
     completed = sqlobject.BoolCol(default=False)
+    # due date of the mission once the one of its quest is taken into
+    # account, kept up to date by due_for(), change_quest() and the quest
+    # due_for() so it can be used in queries
+    _effective_due = sqlobject.DateTimeCol(default=None)
+    # number of uncompleted missions this mission waits for, kept up to date
+    # by add_prerequisite(), remove_prerequisite(), toggle() and remove() so
+    # the views only have to check that it's 0
+    unmet_prerequisites = sqlobject.IntCol(default=0)
+
+    # indexes matching the queries of the views and of the list_* methods
+    visible_index = sqlobject.DatabaseIndex('completed', 'realm', 'tickler')
+    quest_index = sqlobject.DatabaseIndex('quest')
+    previous_mission_index = sqlobject.DatabaseIndex('previous_mission')
+    completed_at_index = sqlobject.DatabaseIndex('completed', 'completed_at')
+    effective_due_index = sqlobject.DatabaseIndex('completed', '_effective_due')
+    ready_index = sqlobject.DatabaseIndex('completed', 'unmet_prerequisites')
+    description_index = sqlobject.DatabaseIndex({'column': 'description', 'length': 255})
 
     def visible(self):
         """
         A method that return True if the mission will be display in the main_view
         or in list_missions. You normaly needn't use it.
         """
-        return (not self.previous_mission or self.previous_mission.completed)\
+        return self.unmet_prerequisites == 0\
             and not self.realm.hide\
             and (not self.quest or (not self.quest.hide and not self.quest.completed and ((self.quest.tickler == None) or (self.quest.tickler < datetime.now()))))
 
@@ -194,16 +263,14 @@ class _Mission(sqlobject.SQLObject):
         Argument:
             * the new quest *id*
         """
-        self.quest = new_quest_id
+        quest = new_quest_id if new_quest_id is None or isinstance(new_quest_id, _Quest) else _Quest.get(new_quest_id, connection=self._connection)
+        self.set(quest=quest, _effective_due=_effective_due(self._due, quest.due if quest else None))
 
     def remove(self):
         """
         Remove the mission from the database.
         """
-        # remove from mission that wait for this mission to be completed
-        for i in self.select(_Mission.q.previous_mission == self):
-            i.previous_mission = None
-        self.destroySelf()
+        _remove_missions(self._connection, [self.id])
 
     def rename(self, description):
         """
@@ -229,45 +296,86 @@ class _Mission(sqlobject.SQLObject):
     def wait_for(self, mission_id):
         """
         Define the mission that this mission will wait to be completed to appears in
-        list_missions or the main_view.
+        list_missions or the main_view. It replaces the missions this mission
+        was waiting for, use add_prerequisite() to wait for several missions.
+
+        Argument:
+            * the mission *id*, None to stop waiting
+        """
+        mission = mission_id if mission_id is None or isinstance(mission_id, _Mission) else _Mission.get(mission_id, connection=self._connection)
+        if mission is not None and mission.id == self.id:
+            raise WaitForError("Can't wait for self")
+        with _transaction(self._connection):
+            for i in self.prerequisites:
+                if mission is None or i.id != mission.id:
+                    self.remove_prerequisite(i)
+            if mission is not None:
+                self.add_prerequisite(mission)
+            self.previous_mission = mission
+
+    @property
+    def prerequisites(self):
+        """
+        The missions this mission waits for.
+        """
+        return list(_Mission.select(sqlobject.AND(_Prerequisite.q.prerequisite == _Mission.q.id, _Prerequisite.q.mission == self.id), connection=self._connection).orderBy(_Prerequisite.q.id))
+
+    def add_prerequisite(self, mission_id):
+        """
+        Add a mission that this mission will wait to be completed to appears
+        in list_missions or the main_view, in addition to the ones it already
+        waits for.
 
         Argument:
             * the mission *id*
         """
-        if mission_id is self:
+        mission = mission_id if isinstance(mission_id, _Mission) else _Mission.get(mission_id, connection=self._connection)
+        if mission.id == self.id:
             raise WaitForError("Can't wait for self")
-        elif (mission_id.previous_mission and mission_id.previous_mission is self):
+        if _Prerequisite.select(sqlobject.AND(_Prerequisite.q.mission == self.id, _Prerequisite.q.prerequisite == mission.id), connection=self._connection).count():
+            return
+        if _DependencyGraph(self._connection, edges_only=True).waits_for(mission.id, self.id):
             raise WaitForError("Can't wait for a mission that is waiting for me")
-        self.previous_mission = mission_id
+        with _transaction(self._connection):
+            _Prerequisite(mission=self.id, prerequisite=mission.id, connection=self._connection)
+            if not mission.completed:
+                self.unmet_prerequisites += 1
+
+    def remove_prerequisite(self, mission_id):
+        """
+        Stop waiting for a mission.
+
+        Argument:
+            * the mission *id*
+        """
+        mission = mission_id if isinstance(mission_id, _Mission) else _Mission.get(mission_id, connection=self._connection)
+        prerequisite = _Prerequisite.select(sqlobject.AND(_Prerequisite.q.mission == self.id, _Prerequisite.q.prerequisite == mission.id), connection=self._connection)
+        if prerequisite.count() == 0:
+            raise ValueError("this mission doesn't wait for mission %d" % mission.id)
+        with _transaction(self._connection):
+            prerequisite[0].destroySelf()
+            if not mission.completed:
+                self.unmet_prerequisites -= 1
+            if self.previous_missionID == mission.id:
+                self.previous_mission = None
 
     @property
     def tags(self):
-        return [i.description for i in _TagMission.select(_TagMission.q.mission_id == self.id)]
+        return [i.description for i in _Tag.select(sqlobject.AND(_TagMission.q.tag == _Tag.q.id, _TagMission.q.mission_id == self.id), connection=self._connection).orderBy(_TagMission.q.id)]
 
     def add_tag(self, tag):
-        if not _TagMission.select(sqlobject.AND(_TagMission.q.description == tag, _TagMission.q.mission_id == self)).count():
-            _TagMission(mission_id = self.id, description = tag)
-        else:
-            assert _TagMission.select(sqlobject.AND(_TagMission.q.description == tag, _TagMission.q.mission_id == self)).count() == 1
+        if not _TagMission.select(sqlobject.AND(_TagMission.q.tag == _Tag.q.id, _Tag.q.description == tag, _TagMission.q.mission_id == self), connection=self._connection).count():
+            _TagMission(mission_id=self.id, tag=_Tag.get_or_create(tag, self._connection), connection=self._connection)
 
     def remove_tag(self, req_tag):
-        tag = _TagMission.select(sqlobject.AND(_TagMission.q.description == req_tag, _TagMission.q.mission_id == self))
+        tag = _TagMission.select(sqlobject.AND(_TagMission.q.tag == _Tag.q.id, _Tag.q.description == req_tag, _TagMission.q.mission_id == self), connection=self._connection)
         if tag.count() == 0:
-            raise ValueError('tag "%s" doesn\'t exist' % tag)
-        assert tag.count() == 1
+            raise ValueError('tag "%s" doesn\'t exist' % req_tag)
         tag[0].destroySelf()
 
     @property
     def due(self):
-        # return my due date if
-        # I don't have a quest
-        # my quest don't have a due date
-        # my due date is earlier than the quest one
-        # else, return quest due date
-        return self._due if None == self.quest or\
-                            (not self.quest.due or
-                                (self._due != None and self.quest.due > self._due))\
-                            else self.quest.due
+        return self._effective_due
 
     def due_for(self, due):
         """
@@ -276,22 +384,57 @@ class _Mission(sqlobject.SQLObject):
         Argument:
             * the *datetime* for witch the mission is due.
         """
-        self._due = due
+        self.set(_due=due, _effective_due=_effective_due(due, self.quest.due if self.quest else None))
 
     def toggle(self):
         """
         Toggle to mission completion state.
         """
-        self.completed = not self.completed
-        self.completed_at = datetime.now() if self.completed else None
+        with _transaction(self._connection) as connection:
+            self.completed = not self.completed
+            self.completed_at = datetime.now() if self.completed else None
+            _shift_unmet_prerequisites(connection, [self.id], -1 if self.completed else 1)
+
+
+class _Prerequisite(_GrailObject):
+    """
+    A mission that another mission waits for, see
+    _Mission.add_prerequisite().
+    """
+    mission = sqlobject.ForeignKey("_Mission")
+    prerequisite = sqlobject.ForeignKey("_Mission")
+
+    mission_index = sqlobject.DatabaseIndex('mission', 'prerequisite', unique=True)
+    prerequisite_index = sqlobject.DatabaseIndex('prerequisite')
 
 
-class _TagMission(sqlobject.SQLObject):
+class _Tag(_GrailObject):
+    """
+    A tag, every tag description is stored only once and the missions are
+    linked to it through _TagMission.
+    """
+    description = sqlobject.UnicodeCol(alternateID=True, length=255)
+
+    @classmethod
+    def get_or_create(cls, description, connection=None):
+        """
+        Return the tag with this description, create it if needed.
+        """
+        try:
+            return cls.byDescription(description, connection=connection)
+        except sqlobject.SQLObjectNotFound:
+            return cls(description=description, connection=connection)
+
+
+class _TagMission(_GrailObject):
     mission_id = sqlobject.ForeignKey("_Mission")
-    description = sqlobject.UnicodeCol()
+    tag = sqlobject.ForeignKey("_Tag")
 
+    tag_index = sqlobject.DatabaseIndex('tag', 'mission_id', unique=True)
+    mission_index = sqlobject.DatabaseIndex('mission_id')
 
-class _Quest(sqlobject.SQLObject):
+
+class _Quest(_GrailObject):
     """
     A quest object.
 
@@ -314,26 +457,17 @@ class _Quest(sqlobject.SQLObject):
     default_realm = sqlobject.ForeignKey('_Realm', default=None)
     hide = sqlobject.BoolCol(default=False)
 
+    description_index = sqlobject.DatabaseIndex({'column': 'description', 'length': 255})
+
     def get_missions(self, all_missions=False):
         """
         Get the missions associated to this quest.
 
-        Return a list of a list of missions.
+        Return a list of missions.
         """
-        def visible(mission):
-            """
-            A method that return True if the mission will be display in the main_view
-            or in list_missions. You normaly needn't use it.
-            """
-            return (not mission.previous_mission or mission.previous_mission.completed)\
-                and (not mission.quest or (not mission.quest.hide and not mission.quest.completed\
-                and ((mission.quest.tickler == None) or (mission.quest.tickler < datetime.now()))))
-
-        return [i for i in _Mission.select(sqlobject.AND(_Mission.q.completed == False,
-                sqlobject.OR(_Mission.q.tickler == None, _Mission.q.tickler < datetime.now()),\
-                _Mission.q.quest == self)) if visible(i)]\
+        return [i for i in _visible_missions(self._connection, _Mission.q.quest == self, check_realm=False)]\
                 if not all_missions\
-                else [i for i in _Mission.select(_Mission.q.quest == self)]
+                else [i for i in _Mission.select(_Mission.q.quest == self, connection=self._connection)]
 
     def due_for(self, due):
         """
@@ -343,14 +477,13 @@ class _Quest(sqlobject.SQLObject):
             * the *datetime* for witch the mission is due.
         """
         self.due = due
+        _update_effective_due(self._connection, self)
 
     def remove(self):
         """
-        Remove this quest.
+        Remove this quest, its missions are kept without quest.
         """
-        for i in _Mission.select(_Mission.q.quest == self):
-            i.quest = None
-        self.destroySelf()
+        _remove_quests(self._connection, [self.id])
 
     def rename(self, new_description):
         """
@@ -401,9 +534,1200 @@ class _Quest(sqlobject.SQLObject):
         self.hide = not self.hide
 
 
+def _restoring(method):
+    """
+    Intern function that return a method of _ArchivedMission that bring back
+    the mission with the other missions then call the method of _Mission on
+    it, the archived mission shouldn't be used anymore.
+    """
+    @functools.wraps(method)
+    def restoring(self, *args, **kwargs):
+        with _transaction(self._connection):
+            _restore_missions(self._connection, [self.id])
+            return method(_Mission.get(self.id, connection=self._connection), *args, **kwargs)
+    return restoring
+
+
+class _ArchivedMission(_Mission):
+    """
+    A mission completed a long time ago, moved out of the missions table by
+    Grail.archive_missions() with its tags.
+
+    Grail.get_mission(), list_missions(all_missions=True) and
+    last_completed_missions() return them with the other missions. An
+    archived mission doesn't wait for other missions anymore and is frozen:
+    rename(), remove(), add_tag() and remove_tag() keep it archived, the
+    other modifications (toggle(), tickle(), due_for()...) bring it back
+    with the other missions first, use get_mission() to get it back.
+    """
+    archived_completed_at_index = sqlobject.DatabaseIndex('completed_at')
+
+    change_realm = _restoring(_Mission.change_realm)
+    change_quest = _restoring(_Mission.change_quest)
+    tickle = _restoring(_Mission.tickle)
+    wait_for = _restoring(_Mission.wait_for)
+    add_prerequisite = _restoring(_Mission.add_prerequisite)
+    remove_prerequisite = _restoring(_Mission.remove_prerequisite)
+    due_for = _restoring(_Mission.due_for)
+    toggle = _restoring(_Mission.toggle)
+
+    @property
+    def tags(self):
+        return [i.description for i in _Tag.select(sqlobject.AND(_ArchivedTagMission.q.tag == _Tag.q.id, _ArchivedTagMission.q.mission_id == self.id), connection=self._connection).orderBy(_ArchivedTagMission.q.id)]
+
+    def add_tag(self, tag):
+        if not _ArchivedTagMission.select(sqlobject.AND(_ArchivedTagMission.q.tag == _Tag.q.id, _Tag.q.description == tag, _ArchivedTagMission.q.mission_id == self.id), connection=self._connection).count():
+            _ArchivedTagMission(mission_id=self.id, tag=_Tag.get_or_create(tag, self._connection), connection=self._connection)
+
+    def remove_tag(self, req_tag):
+        tag = _ArchivedTagMission.select(sqlobject.AND(_ArchivedTagMission.q.tag == _Tag.q.id, _Tag.q.description == req_tag, _ArchivedTagMission.q.mission_id == self.id), connection=self._connection)
+        if tag.count() == 0:
+            raise ValueError('tag "%s" doesn\'t exist' % req_tag)
+        tag[0].destroySelf()
+
+
+class _ArchivedTagMission(_GrailObject):
+    """
+    A tag of an archived mission.
+    """
+    mission_id = sqlobject.ForeignKey("_ArchivedMission")
+    tag = sqlobject.ForeignKey("_Tag")
+
+    archived_mission_index = sqlobject.DatabaseIndex('mission_id')
+
+
+class _Change(_GrailObject):
+    """
+    An entry of the change log: a mission, a quest or a realm that has been
+    created, modified or removed, or every row of the table if row_id is
+    NULL. The id of the last change is the token of Grail.changes_since().
+
+    The entries are only written by _log_changes().
+    """
+    table_name = sqlobject.StringCol(length=20)
+    row_id = sqlobject.IntCol(default=None)
+
+
+class _Transaction(Transaction):
+    """
+    Intern transaction used by Grail.transaction().
+
+    The objects modified inside the transaction are kept in memory and each
+    one is written with a single UPDATE before the next query or at commit.
+    On rollback the modified objects are expired to reload their values.
+
+    The changes of rows are only told to the listeners of the connection
+    once the transaction is committed, see _changed().
+    """
+    def __init__(self, connection):
+        super(_Transaction, self).__init__(connection)
+        self._dirty = {}
+        self._touched = {}
+        self._changes = []
+        self._flushing = False
+
+    def register(self, instance):
+        self._dirty[id(instance)] = instance
+        self._touched[id(instance)] = instance
+
+    def flush(self):
+        """
+        Write the pending modifications.
+        """
+        if self._flushing:
+            return
+        self._flushing = True
+        try:
+            while self._dirty:
+                self._dirty.popitem()[1].syncUpdate()
+        finally:
+            self._flushing = False
+
+    def query(self, s):
+        self.flush()
+        return super(_Transaction, self).query(s)
+
+    def queryAll(self, s):
+        self.flush()
+        return super(_Transaction, self).queryAll(s)
+
+    def queryOne(self, s):
+        self.flush()
+        return super(_Transaction, self).queryOne(s)
+
+    def queryInsertID(self, soInstance, id, names, values):
+        self.flush()
+        return super(_Transaction, self).queryInsertID(soInstance, id, names, values)
+
+    def iterSelect(self, select):
+        self.flush()
+        return super(_Transaction, self).iterSelect(select)
+
+    def commit(self, close=False):
+        self.flush()
+        _log_changes(self, self._changes)
+        super(_Transaction, self).commit(close=close)
+        self._touched = {}
+
+    def rollback(self):
+        self._dirty = {}
+        super(_Transaction, self).rollback()
+        for i in self._touched.values():
+            i._SO_createValues = {}
+            i.sqlmeta.dirty = False
+            i.expire()
+        self._touched = {}
+
+
+class _ConnectionHub(ConnectionHub):
+    """
+    Intern connection of a Grail.
+
+    It is the connection to the database or, for a thread that is inside a
+    Grail.transaction(), the transaction of this thread. The connections to
+    the database are pooled and reused by the threads, SQLite files get a
+    connection per thread. Everything else is forwarded to the current
+    connection so it can be given to SQLObject as a connection.
+    """
+    def __init__(self, connection):
+        super(_ConnectionHub, self).__init__()
+        self.processConnection = connection
+        # functions called with a table and a list of ids, or None for
+        # every rows, when rows are created, modified or removed
+        self.listeners = []
+        # changes written in the change log since its last compaction
+        self.logged_changes = 0
+
+    def notify(self, changes):
+        """
+        Call the listeners for every (table, ids) in changes.
+        """
+        for listener in list(self.listeners):
+            for table, ids in changes:
+                listener(table, ids)
+
+    def __getattr__(self, attr):
+        if attr.startswith("__") or attr == "processConnection":
+            raise AttributeError(attr)
+        return getattr(self.getConnection(), attr)
+
+
+# the hub of each database connection, shared by the Grails of the same uri
+_hubs = {}
+_hubs_lock = threading.Lock()
+
+
+def _connection_hub(connection):
+    """
+    Intern function that return the _ConnectionHub of a connection, a
+    transaction or a hub.
+    """
+    if isinstance(connection, ConnectionHub):
+        return connection
+    if isinstance(connection, Transaction):
+        connection = connection._dbConnection
+    with _hubs_lock:
+        if connection not in _hubs:
+            _hubs[connection] = _ConnectionHub(connection)
+        return _hubs[connection]
+
+
+def _real_connection(connection):
+    """
+    Intern function that return the connection currently used by a hub.
+    """
+    return connection.getConnection() if isinstance(connection, ConnectionHub) else connection
+
+
+def _register_update(instance, kwargs):
+    """
+    Intern listener that keep the objects modified inside a _Transaction.
+    """
+    connection = _real_connection(instance._connection)
+    if isinstance(connection, _Transaction):
+        connection.register(instance)
+
+
+def _changed(connection, table, ids=None):
+    """
+    Intern function that write in the change log and tell the listeners of
+    a database, like ReadModel, that rows have been created, modified or
+    removed. Inside a _Transaction this is done when it's committed.
+
+    Arguments:
+        * connection, the connection that has modified the rows
+        * table, the SQLObject class of the rows
+        * ids, the list of the ids of the rows, None for every rows
+    """
+    connection = _real_connection(connection)
+    if isinstance(connection, _Transaction):
+        connection._changes.append((table, ids))
+        return
+    _log_changes(connection, [(table, ids)])
+    _connection_hub(connection).notify([(table, ids)])
+
+
+def _log_changes(connection, changes):
+    """
+    Intern function that write the changes of missions, quests and realms
+    in the change log, each row once, and compact it from time to time.
+
+    Arguments:
+        * connection, the connection that has modified the rows
+        * changes, a list of (table, list of ids or None)
+    """
+    rows = []
+    seen = set()
+    for table, ids in changes:
+        if table not in (_Mission, _Quest, _Realm):
+            continue
+        for i in [None] if ids is None else ids:
+            if (table, i) not in seen:
+                seen.add((table, i))
+                rows.append("(%s, %s)" % (connection.sqlrepr(table.sqlmeta.table), connection.sqlrepr(i)))
+    for chunk in xrange(0, len(rows), 500):
+        connection.query("INSERT INTO _change (table_name, row_id) VALUES %s" % ", ".join(rows[chunk:chunk + 500]))
+
+    hub = _connection_hub(connection)
+    hub.logged_changes += len(rows)
+    if hub.logged_changes >= CHANGES_COMPACT_EVERY:
+        hub.logged_changes = 0
+        _compact_changes(connection, CHANGES_KEPT)
+
+
+def _compact_changes(connection, kept):
+    """
+    Intern function that remove the oldest changes of the change log to
+    only keep the last ones.
+    """
+    last = connection.queryOne("SELECT MAX(id) FROM _change")[0]
+    if last is not None:
+        connection.query("DELETE FROM _change WHERE id <= %d" % (last - kept))
+
+
+def _row_changed(instance, *args):
+    """
+    Intern listener that call _changed() for a row created, modified or
+    removed by SQLObject.
+    """
+    # the archived missions are missions for the listeners and the change log
+    _changed(instance._connection, _Mission if isinstance(instance, _Mission) else instance.__class__, [instance.id])
+    if isinstance(instance, _TagMission):
+        # the tags of the mission have changed
+        _changed(instance._connection, _Mission, [instance.mission_idID])
+
+
+for table in (_Realm, _Mission, _Tag, _TagMission, _Quest, _Prerequisite, _ArchivedMission, _ArchivedTagMission):
+    sqlobject.events.listen(_register_update, table, sqlobject.events.RowUpdateSignal)
+    for signal in (sqlobject.events.RowCreatedSignal, sqlobject.events.RowUpdatedSignal, sqlobject.events.RowDestroyedSignal):
+        sqlobject.events.listen(_row_changed, table, signal)
+
+
+@contextmanager
+def _transaction(connection):
+    """
+    Intern context manager that run its block in a transaction, or in the
+    current one if there is already one.
+
+    The transaction is only used by the current thread.
+
+    Argument:
+        * connection, the connection, or its hub, of the database
+    """
+    hub = _connection_hub(connection)
+    connection = hub.getConnection()
+    if isinstance(connection, Transaction):
+        yield connection
+        return
+
+    try:
+        previous = hub.threadConnection
+    except AttributeError:
+        previous = None
+    transaction = _Transaction(connection)
+    hub.threadConnection = transaction
+    try:
+        yield transaction
+        transaction.commit(close=True)
+    except:
+        transaction.rollback()
+        raise
+    finally:
+        if previous is None:
+            del hub.threadConnection
+        else:
+            hub.threadConnection = previous
+    hub.notify(transaction._changes)
+
+
+def _effective_due(mission_due, quest_due):
+    """
+    Intern function that return the due date of a mission from its own due
+    date and the one of its quest.
+    """
+    # return my due date if
+    # I don't have a quest
+    # my quest don't have a due date
+    # my due date is earlier than the quest one
+    # else, return quest due date
+    return mission_due if not quest_due or\
+                          (mission_due != None and quest_due > mission_due)\
+                          else quest_due
+
+
+def _expire_cached(connection, table, ids=None, condition=None):
+    """
+    Intern function that expire the values of the cached objects of a table
+    after a set-based statement has modified their rows, they are reloaded
+    by one query when they are used again.
+
+    Unlike SQLObject.expire() the objects stay in the cache, so get() keeps
+    returning the objects already used.
+
+    Arguments:
+        * connection, the connection that has run the statement
+        * table, the SQLObject class
+        * ids, if given only expire the objects of these ids
+        * condition, if given only expire the objects for which it's True,
+          the objects already expired aren't given to it
+    """
+    connection = _real_connection(connection)
+    caches = [connection.cache] + ([connection._dbConnection.cache] if isinstance(connection, Transaction) else [])
+    for cache in caches:
+        if ids is None:
+            cached = cache.getAll(table)
+        else:
+            cached = [i for i in [cache.tryGet(j, table) for j in ids] if i is not None]
+        for i in cached:
+            if i.sqlmeta.expired or (condition is not None and not condition(i)):
+                continue
+            i._SO_writeLock.acquire()
+            try:
+                for column in i.sqlmeta.columnList:
+                    if hasattr(i, "_SO_val_" + column.name):
+                        delattr(i, "_SO_val_" + column.name)
+                i.sqlmeta.expired = True
+            finally:
+                i._SO_writeLock.release()
+
+
+def _shift_positions(connection, first, last, delta):
+    """
+    Intern function that move by delta the realms between the positions first
+    and last (included, None for the last realm) with set-based statements.
+
+    Positions are unique and checked on every row, so the realms are first
+    moved to distinct negative positions and then to their new positions.
+    """
+    where = "position >= %d" % first if last is None else "position BETWEEN %d AND %d" % (first, last)
+    ids = [i[0] for i in connection.queryAll("SELECT id FROM _realm WHERE %s" % where)]
+    connection.query("UPDATE _realm SET position = - (position + %d) - 1 WHERE %s" % (delta, where))
+    connection.query("UPDATE _realm SET position = - position - 1 WHERE position < 0")
+    _expire_cached(connection, _Realm, ids)
+    _changed(connection, _Realm, ids)
+
+
+def _shift_unmet_prerequisites(connection, prerequisites, delta):
+    """
+    Intern function that add delta to the number of unmet prerequisites of
+    the missions that wait for some missions, with set-based statements,
+    when those missions are completed, uncompleted or removed.
+
+    Arguments:
+        * connection, the connection of the database
+        * prerequisites, the list of the ids of the missions waited for
+        * delta, the change for each of them, 1 or -1
+    """
+    # a mission can wait for several of those missions
+    counts = {}
+    for i in _id_lists(prerequisites):
+        for mission, count in connection.queryAll("SELECT mission_id, COUNT(*) FROM _prerequisite WHERE prerequisite_id IN (%s) GROUP BY mission_id" % i):
+            counts[mission] = counts.get(mission, 0) + count
+    if not counts:
+        return
+    missions = {}
+    for mission, count in counts.iteritems():
+        missions.setdefault(count, []).append(mission)
+    for count, ids in missions.iteritems():
+        for i in _id_lists(ids):
+            connection.query("UPDATE _mission SET unmet_prerequisites = unmet_prerequisites + %d WHERE id IN (%s)" % (count * delta, i))
+    _expire_cached(connection, _Mission, counts.keys())
+    _changed(connection, _Mission, counts.keys())
+
+
+def _id_lists(ids):
+    """
+    Intern function that return ids as comma separated lists of at most 500
+    ids, to avoid too big IN clauses.
+    """
+    return [", ".join([str(int(i)) for i in ids[chunk:chunk + 500]]) for chunk in xrange(0, len(ids), 500)]
+
+
+def _select_ids(connection, query, ids):
+    """
+    Intern function that run a query, with a %s for a list of ids, on every
+    list of _id_lists(ids) and return the ids it selects.
+    """
+    return [row[0] for i in _id_lists(ids) for row in connection.queryAll(query % i)]
+
+
+def _remove_missions(connection, ids):
+    """
+    Intern function that remove several missions, their tags and their
+    prerequisites in one transaction with set-based statements, the
+    missions that waited for them don't wait anymore.
+
+    Return the number of missions removed.
+    """
+    with _transaction(connection) as connection:
+        archived = _select_ids(connection, "SELECT id FROM _archived_mission WHERE id IN (%s)", ids)
+        if archived:
+            _delete_rows(connection, _ArchivedTagMission, _select_ids(connection, "SELECT id FROM _archived_tag_mission WHERE mission_id_id IN (%s)", archived))
+            _delete_rows(connection, _ArchivedMission, archived)
+            _changed(connection, _Mission, archived)
+
+        ids = _select_ids(connection, "SELECT id FROM _mission WHERE id IN (%s)", ids)
+        uncompleted = _select_ids(connection, "SELECT id FROM _mission WHERE completed = %s AND id IN (%%s)" % connection.sqlrepr(False), ids)
+        _shift_unmet_prerequisites(connection, uncompleted, -1)
+
+        waiting = _select_ids(connection, "SELECT id FROM _mission WHERE previous_mission_id IN (%s)", ids)
+        for i in _id_lists(ids):
+            connection.query("UPDATE _mission SET previous_mission_id = NULL WHERE previous_mission_id IN (%s)" % i)
+        if waiting:
+            _expire_cached(connection, _Mission, waiting)
+            _changed(connection, _Mission, waiting)
+
+        _delete_rows(connection, _Prerequisite, list(set(_select_ids(connection, "SELECT id FROM _prerequisite WHERE mission_id IN (%s)", ids) +
+                                                         _select_ids(connection, "SELECT id FROM _prerequisite WHERE prerequisite_id IN (%s)", ids))))
+        _delete_rows(connection, _TagMission, _select_ids(connection, "SELECT id FROM _tag_mission WHERE mission_id_id IN (%s)", ids))
+        _delete_rows(connection, _Mission, ids)
+    return len(ids) + len(archived)
+
+
+def _mission_columns(archived=False):
+    """
+    Intern function that return the comma separated columns of the missions
+    table, the ones of a mission that is archived if archived is True.
+    """
+    names = ["id"] + [i.dbName for i in _Mission.sqlmeta.columnList]
+    # an archived mission doesn't wait anymore, its prerequisites are removed
+    archived_values = {"previous_mission_id": "NULL", "unmet_prerequisites": "0"} if archived else {}
+    return ", ".join([archived_values.get(i, i) for i in names])
+
+
+def _archive_missions(connection, before):
+    """
+    Intern function that move the missions completed before a datetime, and
+    their tags, to the archive tables with set-based statements in one
+    transaction. The missions still waited for by a mission that isn't
+    archived are kept.
+
+    Return the number of missions archived.
+    """
+    with _transaction(connection) as connection:
+        # the last mission is kept so its id can't be given again to a new
+        # mission on the databases where the ids aren't AUTOINCREMENT
+        before = _Mission.sqlmeta.columns["completed_at"].from_python(before, sqlbuilder.SQLObjectState(_Mission, connection=connection))
+        candidates = set([i[0] for i in connection.queryAll("SELECT id FROM _mission WHERE completed = %s AND completed_at < %s AND id < (SELECT MAX(id) FROM _mission)"
+                                                            % (connection.sqlrepr(True), connection.sqlrepr(before)))])
+        references = []
+        for i in _id_lists(sorted(candidates)):
+            references += connection.queryAll("SELECT mission_id, prerequisite_id FROM _prerequisite WHERE prerequisite_id IN (%s)" % i)
+            references += connection.queryAll("SELECT id, previous_mission_id FROM _mission WHERE previous_mission_id IN (%s)" % i)
+        kept = True
+        while kept:
+            kept = set([target for source, target in references if target in candidates and source not in candidates])
+            candidates -= kept
+
+        ids = sorted(candidates)
+        for i in _id_lists(ids):
+            connection.query("INSERT INTO _archived_mission (%s) SELECT %s FROM _mission WHERE id IN (%s)" % (_mission_columns(), _mission_columns(archived=True), i))
+            connection.query("INSERT INTO _archived_tag_mission (mission_id_id, tag_id) SELECT mission_id_id, tag_id FROM _tag_mission WHERE mission_id_id IN (%s) ORDER BY id" % i)
+        _delete_rows(connection, _Prerequisite, _select_ids(connection, "SELECT id FROM _prerequisite WHERE mission_id IN (%s)", ids))
+        _delete_rows(connection, _TagMission, _select_ids(connection, "SELECT id FROM _tag_mission WHERE mission_id_id IN (%s)", ids))
+        _delete_rows(connection, _Mission, ids)
+        _changed(connection, _ArchivedTagMission, _select_ids(connection, "SELECT id FROM _archived_tag_mission WHERE mission_id_id IN (%s)", ids))
+    return len(ids)
+
+
+def _restore_missions(connection, ids):
+    """
+    Intern function that move back archived missions, and their tags, with
+    the other missions.
+    """
+    with _transaction(connection) as connection:
+        ids = _select_ids(connection, "SELECT id FROM _archived_mission WHERE id IN (%s)", ids)
+        for i in _id_lists(ids):
+            connection.query("INSERT INTO _mission (%s) SELECT %s FROM _archived_mission WHERE id IN (%s)" % (_mission_columns(), _mission_columns(), i))
+            connection.query("INSERT INTO _tag_mission (mission_id_id, tag_id) SELECT mission_id_id, tag_id FROM _archived_tag_mission WHERE mission_id_id IN (%s) ORDER BY id" % i)
+        _delete_rows(connection, _ArchivedTagMission, _select_ids(connection, "SELECT id FROM _archived_tag_mission WHERE mission_id_id IN (%s)", ids))
+        _delete_rows(connection, _ArchivedMission, ids)
+        # objects of the missions before they were archived could still be in the cache
+        real_connection = _real_connection(connection)
+        for cache in [real_connection.cache] + ([real_connection._dbConnection.cache] if isinstance(real_connection, Transaction) else []):
+            for i in ids:
+                cache.expire(i, _Mission)
+        _changed(connection, _TagMission, _select_ids(connection, "SELECT id FROM _tag_mission WHERE mission_id_id IN (%s)", ids))
+        _changed(connection, _Mission, ids)
+
+
+def _remove_quests(connection, ids):
+    """
+    Intern function that remove several quests in one transaction with
+    set-based statements, their missions are kept without quest.
+
+    Return the number of quests removed.
+    """
+    with _transaction(connection) as connection:
+        ids = _select_ids(connection, "SELECT id FROM _quest WHERE id IN (%s)", ids)
+        missions = _select_ids(connection, "SELECT id FROM _mission WHERE quest_id IN (%s)", ids)
+        for i in _id_lists(ids):
+            connection.query("UPDATE _mission SET quest_id = NULL, effective_due = due WHERE quest_id IN (%s)" % i)
+        # the archived missions are frozen, they only lose their quest
+        archived = _select_ids(connection, "SELECT id FROM _archived_mission WHERE quest_id IN (%s)", ids)
+        for i in _id_lists(ids):
+            connection.query("UPDATE _archived_mission SET quest_id = NULL WHERE quest_id IN (%s)" % i)
+        if missions or archived:
+            _expire_cached(connection, _Mission, missions)
+            _expire_cached(connection, _ArchivedMission, archived)
+            _changed(connection, _Mission, missions + archived)
+        _delete_rows(connection, _Quest, ids)
+    return len(ids)
+
+
+def _update_effective_due(connection, quest=None):
+    """
+    Intern function that recompute with set-based statements the stored due
+    date of the missions of a quest, or of every missions if quest is None.
+    """
+    with _transaction(connection) as connection:
+        where = "quest_id = %s" % connection.sqlrepr(quest.id) if quest else "1 = 1"
+        connection.query("UPDATE _mission SET effective_due = due WHERE %s" % where)
+        connection.query("UPDATE _mission SET effective_due = (SELECT _quest.due FROM _quest WHERE _quest.id = _mission.quest_id) "
+                         "WHERE %s AND quest_id IN (SELECT _quest.id FROM _quest WHERE _quest.due IS NOT NULL) "
+                         "AND (due IS NULL OR due >= (SELECT _quest.due FROM _quest WHERE _quest.id = _mission.quest_id))" % where)
+        ids = [i[0] for i in connection.queryAll("SELECT id FROM _mission WHERE %s" % where)] if quest else None
+        # the cached missions now have a wrong due date, they are reloaded when used
+        _expire_cached(connection, _Mission, ids)
+        _changed(connection, _Mission, ids)
+
+
+def _to_unicode(string):
+    """
+    Intern function that return string as an unicode object.
+    """
+    return string.decode("utf-8") if isinstance(string, str) else string
+
+
+def _insert_rows(connection, table, columns, rows):
+    """
+    Intern function that insert several rows in a table and return their ids.
+
+    On SQLite the rows are inserted with one multi-rows INSERT, this is only
+    safe inside a transaction since the ids are deduced from the last one.
+
+    Arguments:
+        * connection, the connection (usually a transaction) to use
+        * table, the SQLObject class of the rows
+        * columns, the names of the columns in sqlmeta.columns, "id" to set the ids
+        * rows, a list of tuples of python values of those columns
+    """
+    if not rows:
+        return []
+    state = sqlbuilder.SQLObjectState(table, connection=connection)
+    sqlmeta_columns = [table.sqlmeta.columns.get(i) for i in columns]
+    names = [i.dbName if i else table.sqlmeta.idName for i in sqlmeta_columns]
+    values = [[i.from_python(value, state) if i else value for i, value in zip(sqlmeta_columns, row)] for row in rows]
+
+    if connection.dbName != "sqlite" and "id" not in columns:
+        ids = [connection.queryInsertID(table, None, names, i) for i in values]
+    else:
+        connection.query("INSERT INTO %s (%s) VALUES %s" % (table.sqlmeta.table, ", ".join(names),
+                         ", ".join(["(%s)" % ", ".join([connection.sqlrepr(j) for j in i]) for i in values])))
+        if "id" in columns:
+            ids = [row[columns.index("id")] for row in rows]
+        else:
+            last_id = connection.queryOne("SELECT last_insert_rowid()")[0]
+            ids = range(last_id - len(rows) + 1, last_id + 1)
+
+    # objects of removed rows that had the same ids could still be in the cache
+    cache = getattr(connection, "_dbConnection", connection).cache
+    for i in ids:
+        cache.expire(i, table)
+    _changed(connection, table, ids)
+    return ids
+
+
+def _delete_rows(connection, table, ids):
+    """
+    Intern function that remove several rows of a table by their ids.
+
+    Arguments:
+        * connection, the connection to use
+        * table, the SQLObject class of the rows
+        * ids, the list of the ids of the rows
+    """
+    if not ids:
+        return
+    for i in _id_lists(ids):
+        connection.query("DELETE FROM %s WHERE id IN (%s)" % (table.sqlmeta.table, i))
+    connection = _real_connection(connection)
+    caches = [connection.cache] + ([connection._dbConnection.cache] if isinstance(connection, Transaction) else [])
+    for cache in caches:
+        for i in ids:
+            cache.expire(i, table)
+    _changed(connection, table, ids)
+
+
+def _select_rows(connection, table, columns, where=None):
+    """
+    Intern function that return the rows of a table as tuples of python
+    values without creating SQLObject objects.
+
+    Arguments:
+        * connection, the connection to use
+        * table, the SQLObject class of the rows
+        * columns, the names of the columns in sqlmeta.columns, "id" for the ids
+        * where, an sqlobject clause to select the rows
+    """
+    state = sqlbuilder.SQLObjectState(table, connection=connection)
+    sqlmeta_columns = [table.sqlmeta.columns.get(i) for i in columns]
+    query = sqlbuilder.Select([getattr(table.q, i.name) if i else table.q.id for i in sqlmeta_columns],
+                              where=where if where is not None else sqlbuilder.NoDefault)
+
+    # dates and booleans are parsed once per distinct value, the rows then
+    # share the same objects
+    converters = []
+    for column in sqlmeta_columns:
+        if not column or not column.to_python:
+            converters.append(None)
+        elif isinstance(column, sqlobject.col.SOUnicodeCol):
+            # the encoding is looked for once instead of for each value
+            converters.append(lambda value, to_python=column.to_python, encoding=column.getDbEncoding(state):
+                              value.decode(encoding) if isinstance(value, str) else to_python(value, state))
+        elif isinstance(column, sqlobject.col.SOStringLikeCol):
+            converters.append(lambda value, to_python=column.to_python: to_python(value, state))
+        else:
+            converters.append(_memoize(lambda value, to_python=column.to_python: to_python(value, state)))
+    return [tuple([converter(value) if converter and value is not None else value
+                   for converter, value in zip(converters, row)])
+            for row in connection.queryAll(connection.sqlrepr(query))]
+
+
+def _memoize(function):
+    """
+    Intern function that return function with its results kept by argument.
+    """
+    results = {}
+    def memoized(argument):
+        if argument not in results:
+            results[argument] = function(argument)
+        return results[argument]
+    return memoized
+
+
+def _first_after(connection, table, column, after, clause):
+    """
+    Intern function that return the first value after a datetime of a
+    datetime column, None if there isn't.
+
+    Arguments:
+        * connection, the connection of the database
+        * table, the SQLObject class
+        * column, the name of the column in sqlmeta.columns
+        * after, the datetime
+        * clause, a sqlobject clause to restrict the rows
+    """
+    value = table.select(sqlobject.AND(getattr(table.q, column) > after, clause), connection=connection).min(getattr(table.q, column))
+    if value is None:
+        return None
+    return table.sqlmeta.columns[column].to_python(value, sqlbuilder.SQLObjectState(table, connection=connection))
+
+
+def _encode_cursor(method, values):
+    """
+    Intern function that return the opaque cursor of a page of a list
+    method, made of the values of the ordering columns of its last element.
+    """
+    values = [["datetime", i.strftime("%Y-%m-%d %H:%M:%S.%f")] if isinstance(i, datetime) else i for i in values]
+    return base64.urlsafe_b64encode(json.dumps([method, values]))
+
+
+def _decode_cursor(method, cursor):
+    """
+    Intern function that return the values of a cursor of a list method,
+    raise ValueError if it isn't a cursor of this method.
+    """
+    try:
+        name, values = json.loads(base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError, ValueError):
+        raise ValueError("invalid cursor %r" % cursor)
+    if name != method:
+        raise ValueError("this cursor is a cursor of %s, not of %s" % (name, method))
+    return [datetime.strptime(i[1], "%Y-%m-%d %H:%M:%S.%f") if isinstance(i, list) else i for i in values]
+
+
+def _after(columns, values, descending=False):
+    """
+    Intern function that return the clause that select the rows after the
+    values of a cursor in the order of some columns, the last column being
+    unique, so the database can start from the cursor in its index.
+
+    Arguments:
+        * columns, the sqlbuilder columns of the order
+        * values, the values of the last element of the previous page
+        * descending, True if the order is descending
+    """
+    clauses = []
+    for i in range(len(columns)):
+        previous = [column == value for column, value in zip(columns[:i], values[:i])]
+        clauses.append(sqlobject.AND(*(previous + [columns[i] < values[i] if descending else columns[i] > values[i]])))
+    return sqlobject.OR(*clauses)
+
+
+def _view_size(view):
+    """
+    Intern function that return the number of missions of a view made of
+    lists of a row and a list of missions.
+    """
+    return sum([len(missions) for row, missions in view])
+
+
+def _visible_missions(connection, clause=None, check_realm=True):
+    """
+    Intern function that return a select of the missions that will be display
+    in the main_view or in list_missions.
+
+    The whole visibility rule (the mission isn't completed nor tickled, the
+    missions it waits for are completed, its quest isn't hidden, completed or
+    tickled and its realm isn't hidden) is done in one joined query instead
+    of checking every mission with _Mission.visible().
+
+    Arguments:
+        * connection, the connection of the database
+        * clause, an additional sqlobject clause to restrict the missions
+        * check_realm, if False missions of an hidden realm are also returned
+    """
+    now = datetime.now()
+    where = [_Mission.q.completed == False,
+             sqlobject.OR(_Mission.q.tickler == None, _Mission.q.tickler < now),
+             _Mission.q.unmet_prerequisites == 0,
+             sqlobject.OR(_Mission.q.quest == None,
+                          sqlobject.AND(_Quest.q.hide == False, _Quest.q.completed == False,
+                                        sqlobject.OR(_Quest.q.tickler == None, _Quest.q.tickler < now)))]
+    if check_realm:
+        where.append(_Realm.q.hide == False)
+    if clause is not None:
+        where.append(clause)
+    join = [sqlbuilder.INNERJOINOn(None, _Realm, _Mission.q.realm == _Realm.q.id),
+            sqlbuilder.LEFTJOINOn(None, _Quest, _Mission.q.quest == _Quest.q.id)]
+    return _Mission.select(sqlobject.AND(*where), join=join, connection=connection).orderBy(_Mission.q.id)
+
+
+class _DependencyGraph(object):
+    """
+    Intern graph of the missions that wait for other missions, loaded in one
+    query. Every walk of the graph visit each mission and each wait at most
+    once.
+    """
+    def __init__(self, connection, edges_only=False):
+        """
+        Arguments:
+            * connection, the connection of the database
+            * edges_only, don't load the completed state of the missions,
+              the waits are enough to look for cycles
+        """
+        self.prerequisites = {}
+        self.dependents = {}
+        self.completed = {}
+        for mission, prerequisite in _select_rows(connection, _Prerequisite, ("missionID", "prerequisiteID")):
+            self.prerequisites.setdefault(mission, []).append(prerequisite)
+            self.dependents.setdefault(prerequisite, []).append(mission)
+        if not edges_only:
+            self.completed = dict(_select_rows(connection, _Mission, ("id", "completed")))
+
+    def _walk(self, start, edges):
+        """
+        Return the missions reachable from start, in breadth first order.
+        """
+        seen = set([start])
+        order = []
+        queue = [start]
+        for mission in queue:
+            for i in edges.get(mission, []):
+                if i not in seen:
+                    seen.add(i)
+                    order.append(i)
+                    queue.append(i)
+        return order
+
+    def waits_for(self, mission, other):
+        """
+        Return True if mission waits, directly or not, for other.
+        """
+        return other in self._walk(mission, self.prerequisites)
+
+    def chain(self, mission):
+        """
+        Return every mission that mission waits for, directly or not.
+        """
+        return self._walk(mission, self.prerequisites)
+
+    def cycles(self):
+        """
+        Return the list of the cycles of missions, each one as the list of
+        its missions.
+        """
+        # iterative depth first search, a mission met again while it's still
+        # on the path close a cycle
+        state = {}
+        cycles = []
+        for root in self.prerequisites:
+            if root in state:
+                continue
+            path = [root]
+            iterators = [iter(self.prerequisites.get(root, []))]
+            state[root] = "path"
+            while iterators:
+                for i in iterators[-1]:
+                    if state.get(i) == "path":
+                        cycles.append(path[path.index(i):])
+                    elif i not in state:
+                        state[i] = "path"
+                        path.append(i)
+                        iterators.append(iter(self.prerequisites.get(i, [])))
+                        break
+                else:
+                    state[path.pop()] = "done"
+                    iterators.pop()
+        return cycles
+
+
+class _MissionSelection(object):
+    """
+    The missions selected by Grail.missions(), to modify all of them at once.
+
+    Every modification is done with set-based statements in one transaction
+    and return the number of missions modified. The selection is run again
+    by every method, so it can be reused after a modification.
+    """
+    def __init__(self, connection, where):
+        self._connection = connection
+        self._where = where
+
+    def _ids(self, connection, where):
+        return [i[0] for i in _select_rows(connection, _Mission, ("id",), where)]
+
+    def _update(self, connection, where, ids, values):
+        """
+        Intern method that set values, a dict of column name: python value,
+        on the missions selected by where whose ids are given.
+        """
+        state = sqlbuilder.SQLObjectState(_Mission, connection=connection)
+        columns = _Mission.sqlmeta.columns
+        connection.query("UPDATE _mission SET %s WHERE %s" % (", ".join(["%s = %s" % (columns[name].dbName, connection.sqlrepr(columns[name].from_python(value, state)))
+                                                                          for name, value in values.iteritems()]), connection.sqlrepr(where)))
+        self._synced(connection, ids)
+
+    def _synced(self, connection, ids):
+        """
+        Intern method that expire the cached missions after a modification.
+        """
+        _expire_cached(connection, _Mission, ids)
+        _changed(connection, _Mission, ids)
+
+    def __iter__(self):
+        return iter(_Mission.select(self._where, connection=self._connection).orderBy(_Mission.q.id))
+
+    def ids(self):
+        """
+        Return the list of the ids of the selected missions.
+        """
+        return self._ids(self._connection, self._where)
+
+    def count(self):
+        """
+        Return the number of selected missions.
+        """
+        return _Mission.select(self._where, connection=self._connection).count()
+
+    def complete(self):
+        """
+        Complete the uncompleted selected missions.
+        """
+        with _transaction(self._connection) as connection:
+            where = sqlobject.AND(self._where, _Mission.q.completed == False)
+            ids = self._ids(connection, where)
+            if ids:
+                self._update(connection, where, ids, {"completed": True, "completed_at": datetime.now()})
+                _shift_unmet_prerequisites(connection, ids, -1)
+        return len(ids)
+
+    def tickle(self, tickler):
+        """
+        Change the tickler of the selected missions.
+
+        Argument:
+            * the new tickle *datetime*
+        """
+        with _transaction(self._connection) as connection:
+            ids = self._ids(connection, self._where)
+            if ids:
+                self._update(connection, self._where, ids, {"tickler": tickler})
+        return len(ids)
+
+    def postpone(self, delay):
+        """
+        Postpone the due date of the selected missions that have one.
+
+        The missions have different due dates, so they are written by one
+        UPDATE for every 500 missions.
+
+        Argument:
+            * delay, a *timedelta*
+        """
+        with _transaction(self._connection) as connection:
+            rows = _select_rows(connection, _Mission, ("id", "_due", "questID"), sqlobject.AND(self._where, _Mission.q._due != None))
+            quest_ids = list(set([i[2] for i in rows if i[2] is not None]))
+            quests = dict(_select_rows(connection, _Quest, ("id", "due"), sqlbuilder.IN(_Quest.q.id, quest_ids))) if quest_ids else {}
+            state = sqlbuilder.SQLObjectState(_Mission, connection=connection)
+            columns = _Mission.sqlmeta.columns
+            for chunk in xrange(0, len(rows), 500):
+                due, effective_due = [], []
+                for mission, mission_due, quest in rows[chunk:chunk + 500]:
+                    due.append("WHEN %d THEN %s" % (mission, connection.sqlrepr(columns["_due"].from_python(mission_due + delay, state))))
+                    effective_due.append("WHEN %d THEN %s" % (mission, connection.sqlrepr(columns["_effective_due"].from_python(_effective_due(mission_due + delay, quests.get(quest)), state))))
+                connection.query("UPDATE _mission SET due = CASE id %s END, effective_due = CASE id %s END WHERE id IN (%s)"
+                                 % (" ".join(due), " ".join(effective_due), ", ".join([str(i[0]) for i in rows[chunk:chunk + 500]])))
+            if rows:
+                self._synced(connection, [i[0] for i in rows])
+        return len(rows)
+
+    def move_to_realm(self, realm_id):
+        """
+        Move the selected missions to a realm.
+
+        Argument:
+            * the realm or the realm *id*
+        """
+        realm_id = getattr(realm_id, "id", realm_id)
+        with _transaction(self._connection) as connection:
+            if not connection.queryOne("SELECT id FROM _realm WHERE id = %d" % realm_id):
+                raise RealmDoesntExist(realm_id)
+            ids = self._ids(connection, self._where)
+            if ids:
+                self._update(connection, self._where, ids, {"realmID": realm_id})
+        return len(ids)
+
+    def tag(self, tag):
+        """
+        Add a tag to the selected missions that don't have it yet.
+
+        Argument:
+            * the tag description
+        """
+        with _transaction(self._connection) as connection:
+            tag_id = _Tag.get_or_create(tag, connection).id
+            where = sqlobject.AND(self._where, sqlbuilder.NOTIN(_Mission.q.id, sqlbuilder.Select(_TagMission.q.mission_id, where=_TagMission.q.tag == tag_id)))
+            ids = self._ids(connection, where)
+            if ids:
+                connection.query("INSERT INTO _tag_mission (mission_id_id, tag_id) SELECT id, %d FROM _mission WHERE %s" % (tag_id, connection.sqlrepr(where)))
+                _changed(connection, _TagMission, _select_ids(connection, "SELECT id FROM _tag_mission WHERE tag_id = %d AND mission_id_id IN (%%s)" % tag_id, ids))
+                _changed(connection, _Mission, ids)
+        return len(ids)
+
+    def remove(self):
+        """
+        Remove the selected missions, see Grail.remove_missions().
+        """
+        return _remove_missions(self._connection, self.ids())
+
+
+# the rows of the super main view with their number of days
+_SUPER_MAIN_VIEW_ROWS = (("For today", 1), ("For in 3 days", 4), ("For this week", 8))
+
+
+class _ViewCache(object):
+    """
+    Intern cache of the results of the views of a Grail.
+
+    An entry is valid until the change log has a new change or until its
+    expiration date, when a tickler or a due date will modify the view. The
+    least recently used entries are removed to keep at most limit missions.
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, key, token, now):
+        """
+        Return the result of the view, None if it isn't in the cache.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                entry_token, expires, size, result = entry
+                if entry_token == token and (expires is None or now < expires):
+                    self._entries[key] = entry
+                    self.hits += 1
+                    return result
+                self.size -= size
+                self.invalidations += 1
+            self.misses += 1
+            return None
+
+    def put(self, key, token, expires, size, result):
+        with self._lock:
+            if size > self.limit:
+                return
+            while self._entries and self.size + size > self.limit:
+                self.size -= self._entries.popitem(last=False)[1][2]
+            self._entries[key] = (token, expires, size, result)
+            self.size += size
+
+    def stats(self):
+        with self._lock:
+            requests = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "invalidations": self.invalidations,
+                    "hit_rate": float(self.hits) / requests if requests else 0.0,
+                    "entries": len(self._entries), "size": self.size, "limit": self.limit}
+
+
+class _QueryCounter(object):
+    """
+    Intern counter of the queries run by a thread during a call of a Grail
+    method or inside Grail.count_queries().
+
+    The queries are counted by their statement without its values, so the
+    lazy loads of a loop, one query per object, are counted together.
+    """
+    def __init__(self, name, statements=True):
+        self.name = name
+        self.queries = 0
+        self.rows = 0
+        self.seconds = 0.0
+        self.query_seconds = 0.0
+        # statement without values: number of queries, None if not counted
+        self.statements = {} if statements else None
+
+    def repeated_queries(self, threshold):
+        """
+        Return the list of (number of queries, statement) run more than
+        threshold times, the most frequent first.
+        """
+        return sorted([(count, statement) for statement, count in (self.statements or {}).iteritems() if count > threshold], reverse=True)
+
+
+# the values of a query: strings, numbers and lists of them
+_QUERY_VALUES = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_QUERY_LISTS = re.compile(r"\?(?:\s*,\s*\?)+")
+
+
+def _statement(query):
+    """
+    Intern function that return a query without its values, only its
+    beginning is kept since the repeated queries are the short ones.
+    """
+    return _QUERY_LISTS.sub("?", _QUERY_VALUES.sub("?", query[:500]))
+
+
+def _count_rows(rows):
+    for counter in getattr(_recording, "counters", ()):
+        counter.rows += rows
+
+
+def _instrument(connection):
+    """
+    Intern function that count the queries run by a database connection, and
+    the rows they return, in the _QueryCounter of the thread running them.
+
+    Every query of SQLObject, in a transaction or not, is run by
+    _executeRetry() and its rows read by _queryAll(), _queryOne() or an
+    iteration of a select (see _CountedIteration).
+    """
+    if getattr(connection, "_instrumented", False):
+        return
+    connection._instrumented = True
+    execute, query_all, query_one = connection._executeRetry, connection._queryAll, connection._queryOne
+
+    def _executeRetry(conn, cursor, query):
+        counters = getattr(_recording, "counters", None)
+        if not counters:
+            return execute(conn, cursor, query)
+        start = time.time()
+        try:
+            return execute(conn, cursor, query)
+        finally:
+            seconds = time.time() - start
+            statement = _statement(query) if [i for i in counters if i.statements is not None] else None
+            for counter in counters:
+                counter.queries += 1
+                counter.query_seconds += seconds
+                if counter.statements is not None:
+                    counter.statements[statement] = counter.statements.get(statement, 0) + 1
+
+    def _queryAll(conn, s):
+        rows = query_all(conn, s)
+        _count_rows(len(rows))
+        return rows
+
+    def _queryOne(conn, s):
+        row = query_one(conn, s)
+        _count_rows(int(row is not None))
+        return row
+
+    connection._executeRetry, connection._queryAll, connection._queryOne = _executeRetry, _queryAll, _queryOne
+
+
+@contextmanager
+def _counting(counter, call=False):
+    """
+    Intern context manager that count the queries of its block in counter,
+    the queries of the nested calls of Grail methods are counted in the
+    outermost call only.
+    """
+    counters = _recording.__dict__.setdefault("counters", [])
+    counters.append(counter)
+    if call:
+        _recording.call = counter
+    start = time.time()
+    try:
+        yield counter
+    finally:
+        counter.seconds += time.time() - start
+        counters.remove(counter)
+        if call:
+            _recording.call = None
+
+
+def _recorded(name, method):
+    """
+    Intern decorator of the public methods of Grail that record the queries
+    of their calls, see Grail.stats(). The queries of a generator are
+    counted while it's iterated.
+    """
+    @functools.wraps(method)
+    def recorded(self, *args, **kwargs):
+        if getattr(_recording, "call", None) is not None:
+            return method(self, *args, **kwargs)
+        counter = _QueryCounter("Grail.%s()" % name, self._repeated_queries is not None)
+        with _counting(counter, call=True):
+            result = method(self, *args, **kwargs)
+        if isinstance(result, types.GeneratorType):
+            return self._recorded_generator(name, counter, result)
+        self._record_call(name, counter)
+        return result
+    return recorded
+
+
 class Grail(object):
 
-    def __init__(self, database_uri=None):
+    def __init__(self, database_uri=None, view_cache_limit=VIEW_CACHE_LIMIT, archive_after=None, repeated_queries=REPEATED_QUERIES):
         """
         The main object, it's the interface with the mission database.
 
@@ -413,31 +1737,163 @@ class Grail(object):
         Arguments:
             * a different uri to connect to another database than the one into
               the configuration file (ie for tests)
+            * view_cache_limit, the maximum number of missions kept in the
+              cache of the views, 0 to disable it
+            * archive_after, if given the missions completed more than this
+              number of days ago are archived at every start, see
+              archive_missions()
+            * repeated_queries, the number of times a call can run the same
+              query with different values before a RepeatedQueriesWarning,
+              None to never warn
         """
         if not database_uri and not DATABASE_ACCESS:
             raise NoDatabaseConfiguration
+        self._repeated_queries = repeated_queries
+        self._stats = {}
+        self._stats_lock = threading.Lock()
+        self._full_text = False
+        self._view_cache = _ViewCache(view_cache_limit)
         self._connect(database_uri)
         self._table_exist()
+        if archive_after is not None:
+            self.archive_missions(archive_after)
 
     def _table_exist(self):
         """
         Intern method to check if the database exist and if the database is in a normal state.
         """
         # check that everything if normal (all table created or not created)
-        if not ((not _Mission.tableExists() and not _Quest.tableExists() and not _Realm.tableExists()) or (_Mission.tableExists() and _Quest.tableExists() and _Realm.tableExists())):
+        mission, quest, realm = [i.tableExists(connection=self._connection) for i in (_Mission, _Quest, _Realm)]
+        if not ((not mission and not quest and not realm) or (mission and quest and realm)):
             print "Grail: WARNING: database in a non conform state, will probably bug. Do you need to launch a migration script ?"
-        elif not _Mission.tableExists() and not _Quest.tableExists() and not _Realm.tableExists():
+        elif not mission and not quest and not realm:
             print "Grail: DB doesn't exist, I'll create it"
             self.reset_db("yes")
+        else:
+            self._migrate_db()
+
+    def _migrate_db(self):
+        """
+        Intern method to upgrade a database created by an older version of
+        HolyGrail. Every step check if it's needed so it can be run on every
+        connection.
+        """
+        connection = self._connection
+        _Change.createTable(ifNotExists=True, connection=connection)
+        _ArchivedMission.createTable(ifNotExists=True, connection=connection)
+        _ArchivedTagMission.createTable(ifNotExists=True, connection=connection)
+        try:
+            connection.queryAll("SELECT effective_due FROM _mission WHERE 1 = 0")
+        except sqlobject.dberrors.Error:
+            connection.addColumn(_Mission.sqlmeta.table, _Mission.sqlmeta.columns["_effective_due"])
+            _update_effective_due(connection)
+        try:
+            connection.queryAll("SELECT tag_id FROM _tag_mission WHERE 1 = 0")
+        except sqlobject.dberrors.Error:
+            # tags descriptions used to be stored in _tag_mission
+            _Tag.createTable(ifNotExists=True, connection=connection)
+            connection.query("INSERT INTO _tag (description) SELECT DISTINCT description FROM _tag_mission")
+            connection.query("ALTER TABLE _tag_mission RENAME TO _tag_mission_old")
+            _TagMission.createTable(createIndexes=False, connection=connection)
+            connection.query("INSERT INTO _tag_mission (id, mission_id_id, tag_id) "
+                             "SELECT _tag_mission_old.id, _tag_mission_old.mission_id_id, _tag.id "
+                             "FROM _tag_mission_old INNER JOIN _tag ON _tag.description = _tag_mission_old.description")
+            connection.query("DROP TABLE _tag_mission_old")
+        try:
+            connection.queryAll("SELECT unmet_prerequisites FROM _mission WHERE 1 = 0")
+        except sqlobject.dberrors.Error:
+            # a mission used to only wait for its previous_mission
+            _Prerequisite.createTable(ifNotExists=True, connection=connection)
+            connection.addColumn(_Mission.sqlmeta.table, _Mission.sqlmeta.columns["unmet_prerequisites"])
+            connection.query("INSERT INTO _prerequisite (mission_id, prerequisite_id) SELECT id, previous_mission_id FROM _mission "
+                             "WHERE previous_mission_id IN (SELECT id FROM _mission)")
+            connection.query("UPDATE _mission SET unmet_prerequisites = 0")
+            connection.query("UPDATE _mission SET unmet_prerequisites = 1 WHERE previous_mission_id IN "
+                             "(SELECT id FROM _mission WHERE completed = %s)" % connection.sqlrepr(False))
+        self.create_indexes()
+        self._create_search_index()
+
+    def create_indexes(self):
+        """
+        Create the indexes that are missing in the database, for example on
+        a database created by an older version of HolyGrail. reset_db()
+        already create all of them.
+
+        The existing indexes are listed first, this is only done on SQLite,
+        PostgreSQL and MySQL.
+        """
+        connection = self._connection
+        existing = self._index_names()
+        if existing is None:
+            return
+        for table in (_Realm, _Quest, _Mission, _Tag, _TagMission, _Prerequisite, _ArchivedMission, _ArchivedTagMission):
+            for index in table.sqlmeta.indexes:
+                if "%s_%s" % (table.sqlmeta.table, index.name) not in existing:
+                    connection.query(connection.createIndexSQL(table, index))
+
+    def _index_names(self):
+        """
+        Intern method that return the names of the indexes of the database
+        as SQLObject name them, table_index, or None if they can't be
+        listed on this database.
+        """
+        connection = self._connection
+        if connection.dbName == "sqlite":
+            return set([i[0] for i in connection.queryAll("SELECT name FROM sqlite_master WHERE type = 'index'")])
+        elif connection.dbName == "postgres":
+            return set([i[0] for i in connection.queryAll("SELECT indexname FROM pg_indexes WHERE schemaname = current_schema()")])
+        elif connection.dbName == "mysql":
+            # the names of the indexes of MySQL are only unique by table
+            return set(["%s_%s" % i for i in connection.queryAll("SELECT DISTINCT table_name, index_name FROM information_schema.statistics "
+                                                                 "WHERE table_schema = DATABASE()")])
+        return None
+
+    def _create_search_index(self):
+        """
+        Intern method that create, if it doesn't exist yet, the full text
+        index used by search_for_mission().
+
+        This is only available on SQLite (with FTS5), the index is kept in
+        sync with the missions descriptions by triggers. On other databases
+        search_for_mission(full_text=True) fallback on a LIKE query, the
+        accents aren't removed so both find the same missions.
+        """
+        connection = self._connection
+        if connection.dbName != "sqlite":
+            return
+        if connection.queryOne("SELECT name FROM sqlite_master WHERE type = 'table' AND name = '_mission_fts'"):
+            self._full_text = True
+            return
+        try:
+            connection.query("CREATE VIRTUAL TABLE _mission_fts USING fts5(description, tokenize = 'unicode61 remove_diacritics 0')")
+        except sqlobject.dberrors.Error:
+            # this SQLite hasn't been compiled with FTS5
+            return
+        connection.query("CREATE TRIGGER _mission_fts_insert AFTER INSERT ON _mission BEGIN "
+                         "INSERT INTO _mission_fts(rowid, description) VALUES (new.id, new.description); END")
+        connection.query("CREATE TRIGGER _mission_fts_update AFTER UPDATE OF description ON _mission BEGIN "
+                         "UPDATE _mission_fts SET description = new.description WHERE rowid = old.id; END")
+        connection.query("CREATE TRIGGER _mission_fts_delete AFTER DELETE ON _mission BEGIN "
+                         "DELETE FROM _mission_fts WHERE rowid = old.id; END")
+        connection.query("INSERT INTO _mission_fts(rowid, description) SELECT id, description FROM _mission")
+        self._full_text = True
 
     def _connect(self, database_uri):
         """
         Connect to the database
 
+        Every Grail use its own connection, so several databases can be
+        used in the same process. The first one is also the default
+        connection of the SQLObject classes when they are used directly.
+
         Argument:
             * a different uri to connect to another database than the one in the config.py file (ie: for unittest)
         """
-        sqlobject.sqlhub.processConnection = sqlobject.connectionForURI(database_uri) if database_uri else sqlobject.connectionForURI(DATABASE_ACCESS)
+        connection = sqlobject.connectionForURI(database_uri) if database_uri else sqlobject.connectionForURI(DATABASE_ACCESS)
+        self._connection = _connection_hub(connection)
+        _instrument(connection)
+        if not hasattr(sqlobject.sqlhub, "processConnection"):
+            sqlobject.sqlhub.processConnection = connection
 
     def reset_db(self, are_you_sure=False):
         """
@@ -446,22 +1902,202 @@ class Grail(object):
         WARNING: this will destroy *EVERYTHING* in the database
         """
         if are_you_sure:
-            _Realm.dropTable(ifExists=True)
-            _Quest.dropTable(ifExists=True)
-            _Mission.dropTable(ifExists=True)
-            _TagMission.dropTable(ifExists=True)
-
-
-            _Realm.createTable()
-            _Quest.createTable()
-            _Mission.createTable()
-            _TagMission.createTable()
+            connection = self._connection
+            # the change log is kept to tell the clients to reload everything
+            _Change.createTable(ifNotExists=True, connection=connection)
+            _Realm.dropTable(ifExists=True, connection=connection)
+            _Quest.dropTable(ifExists=True, connection=connection)
+            _Mission.dropTable(ifExists=True, connection=connection)
+            _TagMission.dropTable(ifExists=True, connection=connection)
+            _Tag.dropTable(ifExists=True, connection=connection)
+            _Prerequisite.dropTable(ifExists=True, connection=connection)
+            _ArchivedMission.dropTable(ifExists=True, connection=connection)
+            _ArchivedTagMission.dropTable(ifExists=True, connection=connection)
+            if connection.dbName == "sqlite":
+                connection.query("DROP TABLE IF EXISTS _mission_fts")
+
+
+            _Realm.createTable(connection=connection)
+            _Quest.createTable(connection=connection)
+            _Mission.createTable(connection=connection)
+            _Tag.createTable(connection=connection)
+            _TagMission.createTable(connection=connection)
+            _Prerequisite.createTable(connection=connection)
+            _ArchivedMission.createTable(connection=connection)
+            _ArchivedTagMission.createTable(connection=connection)
+            connection.cache.clear()
+            self._create_search_index()
+            for table in (_Realm, _Quest, _Mission, _Tag, _TagMission, _Prerequisite, _ArchivedMission, _ArchivedTagMission):
+                _changed(connection, table)
 
             # always have a realm
-            _Realm(description="default realm", default_realm = True, position=0)
+            _Realm(description="default realm", default_realm = True, position=0, connection=connection)
         else:
             print "You aren't sure, so I won't reset it"
 
+    def transaction(self):
+        """
+        Return a context manager that run its block in one database
+        transaction, committed at the end or rolled back if an exception is
+        raised:
+
+            with grail.transaction():
+                mission.toggle()
+                mission.rename("new description")
+
+        The modifications of the missions, quests and realms made in the
+        block are written once per object, before the next query or at
+        commit.
+        """
+        return _transaction(self._connection)
+
+    def _recorded_generator(self, name, counter, generator):
+        # like _counting() around each next(), without its cost for every element
+        counters = _recording.__dict__.setdefault("counters", [])
+        try:
+            while True:
+                counters.append(counter)
+                _recording.call = counter
+                start = time.time()
+                try:
+                    element = next(generator)
+                except StopIteration:
+                    return
+                finally:
+                    counter.seconds += time.time() - start
+                    counters.remove(counter)
+                    _recording.call = None
+                yield element
+        finally:
+            self._record_call(name, counter)
+
+    def _record_call(self, name, counter):
+        # warn the caller of the Grail method
+        self._warn_repeated_queries(counter, 3)
+        with self._stats_lock:
+            stats = self._stats.setdefault(name, {"calls": 0, "queries": 0, "rows": 0, "seconds": 0.0, "query_seconds": 0.0, "max_queries": 0})
+            stats["calls"] += 1
+            stats["queries"] += counter.queries
+            stats["rows"] += counter.rows
+            stats["seconds"] += counter.seconds
+            stats["query_seconds"] += counter.query_seconds
+            stats["max_queries"] = max(stats["max_queries"], counter.queries)
+
+    def _warn_repeated_queries(self, counter, stacklevel):
+        if self._repeated_queries is None:
+            return
+        for count, statement in counter.repeated_queries(self._repeated_queries):
+            warnings.warn("%s ran %d times the query: %s" % (counter.name, count, statement), RepeatedQueriesWarning, stacklevel=stacklevel + 1)
+
+    def stats(self, reset=False):
+        """
+        Return the statistics of the queries of the calls of the public
+        methods of this Grail, by method: a dict of the number of calls, of
+        queries, of rows read, the wall time of the calls and of their
+        queries in seconds and the maximum number of queries of a call.
+
+        The queries of the Grail methods called by another one are counted
+        in the outermost call, and the queries of a generator while it's
+        iterated. Use count_queries() for the other queries, like the ones
+        of the attributes of the missions.
+
+        Argument:
+            * reset, if True start again from zero
+        """
+        with self._stats_lock:
+            stats = dict([(name, dict(i)) for name, i in self._stats.iteritems()])
+            if reset:
+                self._stats = {}
+        return stats
+
+    @contextmanager
+    def count_queries(self):
+        """
+        Return a context manager that count the queries run by the current
+        thread in its block, on any database:
+
+            with grail.count_queries() as counter:
+                for mission in grail.list_missions():
+                    mission.tags
+            print counter.queries, counter.rows, counter.seconds
+
+        The counter has the number of queries and of rows read, the wall
+        time of the block and of its queries in seconds and the number of
+        queries by statement without its values. A RepeatedQueriesWarning is
+        issued at the end if a statement has been run too many times.
+        """
+        counter = _QueryCounter("Grail.count_queries()", self._repeated_queries is not None)
+        with _counting(counter):
+            yield counter
+        self._warn_repeated_queries(counter, 3)
+
+    def changes_since(self, token=None):
+        """
+        Return the missions, quests and realms created, modified or removed
+        since a previous call, for the clients that keep a copy of them.
+
+        Return a tuple (token, changes), the token is given to the next
+        call. changes is None if the client has to reload everything:
+        without token, if the changes since the token have been compacted
+        or if the database has been reset. Otherwise it's a dict:
+
+            {"missions": {id: mission}, "quests": {id: quest}, "realms": {id: realm}}
+
+        where the object is None for the removed rows.
+
+        Argument:
+            * token, the token returned by the previous call
+        """
+        connection = self._connection
+        last, first = connection.queryOne("SELECT MAX(id), MIN(id) FROM _change")
+        last = last or 0
+        if token is None or token > last or (first is not None and token < first - 1):
+            return last, None
+
+        rows = connection.queryAll("SELECT DISTINCT table_name, row_id FROM _change WHERE id > %d AND id <= %d" % (token, last))
+        if [i for i in rows if i[1] is None]:
+            return last, None
+        changes = {}
+        for table, key in ((_Mission, "missions"), (_Quest, "quests"), (_Realm, "realms")):
+            ids = [row_id for table_name, row_id in rows if table_name == table.sqlmeta.table]
+            changes[key] = dict([(i, None) for i in ids])
+            # avoid too big IN clauses
+            for chunk in xrange(0, len(ids), 500):
+                for i in table.select(sqlbuilder.IN(table.q.id, ids[chunk:chunk + 500]), connection=connection):
+                    changes[key][i.id] = i
+        # the missions that have been archived still exist
+        ids = [i for i, mission in changes["missions"].iteritems() if mission is None]
+        for chunk in xrange(0, len(ids), 500):
+            for i in _ArchivedMission.select(sqlbuilder.IN(_ArchivedMission.q.id, ids[chunk:chunk + 500]), connection=connection):
+                changes["missions"][i.id] = i
+        return last, changes
+
+    def archive_missions(self, days=ARCHIVE_AFTER):
+        """
+        Move the missions completed more than some days ago, and their tags,
+        to the archive tables to keep the missions table small. Return the
+        number of missions archived.
+
+        get_mission(), list_missions(all_missions=True) and
+        last_completed_missions() still return the archived missions, the
+        views and the other list methods don't. The missions that are still
+        waited for by a mission that isn't archived are kept.
+
+        Argument:
+            * days, the number of days since the completion
+        """
+        return _archive_missions(self._connection, datetime.now() - timedelta(days))
+
+    def compact_changes(self, kept=CHANGES_KEPT):
+        """
+        Remove the oldest changes of the change log. This is already done
+        automatically every CHANGES_COMPACT_EVERY changes.
+
+        Argument:
+            * kept, the number of changes kept
+        """
+        _compact_changes(self._connection, kept)
+
     def add_mission(self, new_description, tickler=None, due=None, quest=None, realm=None, wait_for=None, unique=False):
         """
         Add a new mission then return it
@@ -480,9 +2116,93 @@ class Grail(object):
                 realm = self.get_default_realm().id
             else:
                 realm = self.get_quest(quest).default_realm.id
-        if unique and _Mission.select(sqlobject.AND(_Mission.q.description == new_description, _Mission.q.completed == False)).count() != 0:
+        if unique and _Mission.select(sqlobject.AND(_Mission.q.description == new_description, _Mission.q.completed == False), connection=self._connection).count() != 0:
             return -1
-        return _Mission(description=new_description, tickler=tickler, _due=due, quest=quest, realm=realm, previous_mission=wait_for)
+        effective_due = _effective_due(due, self.get_quest(quest).due) if quest else due
+        if wait_for is not None and not isinstance(wait_for, _Mission):
+            wait_for = self.get_mission(wait_for)
+        mission = _Mission(description=new_description, tickler=tickler, _due=due, quest=quest, realm=realm, previous_mission=wait_for,
+                           _effective_due=effective_due, unmet_prerequisites=int(bool(wait_for and not wait_for.completed)), connection=self._connection)
+        if wait_for is not None:
+            _Prerequisite(mission=mission.id, prerequisite=wait_for.id, connection=self._connection)
+        return mission
+
+    def add_missions(self, missions, batch_size=500):
+        """
+        Add several missions at once then return the list of their ids.
+
+        The quests, the default realm and the existing missions for the
+        unique ones are fetched once for all the missions then the missions
+        are inserted by batches in one transaction.
+
+        Arguments:
+            * missions, an iterable of dicts of add_mission() arguments or of
+              tuples of those arguments in the same order, the id of a
+              mission that isn't added because of unique is -1
+            * batch_size, the number of missions inserted by query
+        """
+        arguments = ("new_description", "tickler", "due", "quest", "realm", "wait_for", "unique")
+        missions = [dict(zip(arguments, i)) if isinstance(i, tuple) else i for i in missions]
+        connection = self._connection
+
+        quest_ids = list(set([getattr(i["quest"], "id", i["quest"]) for i in missions if i.get("quest")]))
+        quests = dict([(i.id, i) for i in _Quest.select(sqlbuilder.IN(_Quest.q.id, quest_ids), connection=connection)]) if quest_ids else {}
+        for i in quest_ids:
+            if i not in quests:
+                raise QuestDoesntExist(i)
+        default_realm = None
+
+        # uncompleted missions that already have the description of a unique one
+        existing = set()
+        unique = list(set([_to_unicode(i["new_description"]) for i in missions if i.get("unique")]))
+        for chunk in xrange(0, len(unique), batch_size):
+            query = sqlbuilder.Select(_Mission.q.description, where=sqlobject.AND(_Mission.q.completed == False,
+                                      sqlbuilder.IN(_Mission.q.description, unique[chunk:chunk + batch_size])))
+            existing.update([_to_unicode(i[0]) for i in connection.queryAll(connection.sqlrepr(query))])
+
+        # missions waited for, id: completed
+        wait_for_ids = list(set([getattr(i["wait_for"], "id", i["wait_for"]) for i in missions if i.get("wait_for")]))
+        completed = {}
+        for chunk in xrange(0, len(wait_for_ids), batch_size):
+            completed.update(_select_rows(connection, _Mission, ("id", "completed"), sqlbuilder.IN(_Mission.q.id, wait_for_ids[chunk:chunk + batch_size])))
+        for i in wait_for_ids:
+            if i not in completed:
+                raise MissionDoesntExist(i)
+
+        columns = ("description", "created_at", "tickler", "realmID", "questID", "previous_missionID", "_due", "completed", "_effective_due", "unmet_prerequisites")
+        rows = []
+        # position of the row of each mission, None if it isn't added
+        positions = []
+        today = date.today()
+        for i in missions:
+            description = _to_unicode(i["new_description"])
+            if i.get("unique") and description in existing:
+                positions.append(None)
+                continue
+            existing.add(description)
+            quest = quests[getattr(i["quest"], "id", i["quest"])] if i.get("quest") else None
+            realm = i.get("realm")
+            if not realm:
+                if quest and quest.default_realmID:
+                    realm = quest.default_realmID
+                else:
+                    if default_realm is None:
+                        default_realm = self.get_default_realm().id
+                    realm = default_realm
+            positions.append(len(rows))
+            wait_for = getattr(i.get("wait_for"), "id", i.get("wait_for"))
+            rows.append((description, today, i.get("tickler"), getattr(realm, "id", realm), quest.id if quest else None,
+                         wait_for, i.get("due"), False, _effective_due(i.get("due"), quest.due if quest else None),
+                         int(bool(wait_for and not completed[wait_for]))))
+
+        ids = []
+        with _transaction(connection) as transaction:
+            for chunk in xrange(0, len(rows), batch_size):
+                ids += _insert_rows(transaction, _Mission, columns, rows[chunk:chunk + batch_size])
+            prerequisites = [(mission, row[5]) for mission, row in zip(ids, rows) if row[5]]
+            for chunk in xrange(0, len(prerequisites), batch_size):
+                _insert_rows(transaction, _Prerequisite, ("missionID", "prerequisiteID"), prerequisites[chunk:chunk + batch_size])
+        return [ids[i] if i is not None else -1 for i in positions]
 
     def add_quest(self, description, default_realm=None, tickler=None, due=None, hide=False):
         """
@@ -493,7 +2213,7 @@ class Grail(object):
             * default_realm, the default realm of this quest
             * tickler, the tickler of this quest in *datetime*
         """
-        return _Quest(description=description, default_realm=default_realm, due=due, tickler=tickler, hide=hide)
+        return _Quest(description=description, default_realm=default_realm, due=due, tickler=tickler, hide=hide, connection=self._connection)
 
     def add_realm(self, description, hide=False, default=False):
         """
@@ -504,7 +2224,7 @@ class Grail(object):
             * hide, if the quest is hide
             * default, if the quest is now the default realm
         """
-        new_realm = _Realm(position=_Realm.select().count(), description=description, hide=hide)
+        new_realm = _Realm(position=_Realm.select(connection=self._connection).count(), description=description, hide=hide, connection=self._connection)
         if default:
             new_realm.set_default()
         return new_realm
@@ -518,7 +2238,11 @@ class Grail(object):
             * the mission description
         """
         try:
-            return _Mission.get(mission_id)
+            return _Mission.get(mission_id, connection=self._connection)
+        except sqlobject.SQLObjectNotFound:
+            pass
+        try:
+            return _ArchivedMission.get(mission_id, connection=self._connection)
         except sqlobject.SQLObjectNotFound:
             raise MissionDoesntExist(mission_id)
 
@@ -530,7 +2254,7 @@ class Grail(object):
         Argument:
             * mission description
         """
-        query = _Mission.select(_Mission.q.description == description)
+        query = _Mission.select(_Mission.q.description == description, connection=self._connection)
         if query.count() == 0:
             raise MissionDoesntExist(description)
         return [i for i in query]
@@ -544,7 +2268,7 @@ class Grail(object):
             * quest description
         """
         try:
-            return _Quest.get(quest_id)
+            return _Quest.get(quest_id, connection=self._connection)
         except sqlobject.SQLObjectNotFound:
             raise QuestDoesntExist(quest_id)
 
@@ -556,7 +2280,7 @@ class Grail(object):
         Arguments:
             * quest description
         """
-        return [i for i in _Quest.select(_Quest.q.description == description)]
+        return [i for i in _Quest.select(_Quest.q.description == description, connection=self._connection)]
 
     def get_realm(self, realm_id):
         """
@@ -567,7 +2291,7 @@ class Grail(object):
             * realm description
         """
         try:
-            return _Realm.get(realm_id)
+            return _Realm.get(realm_id, connection=self._connection)
         except sqlobject.SQLObjectNotFound:
             raise RealmDoesntExist(realm_id)
 
@@ -579,7 +2303,7 @@ class Grail(object):
         Arguments:
             * realm description
         """
-        query = _Realm.select(_Realm.q.description == description)
+        query = _Realm.select(_Realm.q.description == description, connection=self._connection)
         if query.count() == 0:
             raise RealmDoesntExist(description)
         return [i for i in query]
@@ -588,63 +2312,236 @@ class Grail(object):
         """
         Return the default realm.
         """
-        assert _Realm.select(_Realm.q.default_realm == True).count() == 1
-        return _Realm.select(_Realm.q.default_realm == True)[0]
+        assert _Realm.select(_Realm.q.default_realm == True, connection=self._connection).count() == 1
+        return _Realm.select(_Realm.q.default_realm == True, connection=self._connection)[0]
+
+    def blocked_by(self, missions):
+        """
+        Return the uncompleted missions that several missions wait for as a
+        dict of mission id: list of missions id.
+
+        Argument:
+            * a list of missions or of missions *id*
+        """
+        graph = _DependencyGraph(self._connection)
+        ids = [getattr(i, "id", i) for i in missions]
+        return dict([(i, sorted([j for j in graph.prerequisites.get(i, []) if not graph.completed.get(j, True)])) for i in ids])
+
+    def blocking(self, missions):
+        """
+        Return the missions that wait for several missions as a dict of
+        mission id: list of missions id.
+
+        Argument:
+            * a list of missions or of missions *id*
+        """
+        graph = _DependencyGraph(self._connection)
+        ids = [getattr(i, "id", i) for i in missions]
+        return dict([(i, sorted(graph.dependents.get(i, []))) for i in ids])
+
+    def dependency_chain(self, mission):
+        """
+        Return the list of the missions id that a mission waits for,
+        directly or not, the nearest first.
+
+        Argument:
+            * a mission or a mission *id*
+        """
+        return _DependencyGraph(self._connection, edges_only=True).chain(getattr(mission, "id", mission))
+
+    def ready_missions(self):
+        """
+        Return the set of the id of the uncompleted missions that don't wait
+        for an uncompleted mission, whatever their tickler, quest and realm.
+        """
+        query = sqlbuilder.Select(_Mission.q.id, where=sqlobject.AND(_Mission.q.completed == False, _Mission.q.unmet_prerequisites == 0))
+        return set([i[0] for i in self._connection.queryAll(self._connection.sqlrepr(query))])
+
+    def dependency_cycles(self):
+        """
+        Return the cycles of missions waiting for each other, as lists of
+        missions id. Those missions will never be visible, wait_for() refuse
+        to create them but older versions of HolyGrail only checked the
+        cycles of one or two missions.
+        """
+        return _DependencyGraph(self._connection, edges_only=True).cycles()
+
+    def missions(self, ids=None, realm=None, quest=None, tag=None, completed=None, due_before=None):
+        """
+        Return a selection of missions to modify all of them at once, every
+        modification return the number of missions modified:
+
+            grail.missions(tag="review", completed=False).tickle(next_monday)
+
+        Without arguments every missions are selected, otherwise only those
+        that match all of them.
+
+        Arguments:
+            * ids, a list of missions or of missions *id*
+            * realm, a realm or a realm *id*
+            * quest, a quest or a quest *id*
+            * tag, a tag description
+            * completed, True or False to only select the completed or
+              the uncompleted missions
+            * due_before, a datetime, only select the missions due before it
+        """
+        where = [sqlbuilder.SQLTrueClause]
+        if ids is not None:
+            # an empty list select no mission
+            where.append(sqlbuilder.IN(_Mission.q.id, [getattr(i, "id", i) for i in ids]) if ids else _Mission.q.id == None)
+        if realm is not None:
+            where.append(_Mission.q.realm == getattr(realm, "id", realm))
+        if quest is not None:
+            where.append(_Mission.q.quest == getattr(quest, "id", quest))
+        if tag is not None:
+            where.append(sqlbuilder.IN(_Mission.q.id, sqlbuilder.Select(_TagMission.q.mission_id,
+                                       where=sqlobject.AND(_TagMission.q.tag == _Tag.q.id, _Tag.q.description == tag))))
+        if completed is not None:
+            where.append(_Mission.q.completed == completed)
+        if due_before is not None:
+            where.append(_Mission.q._effective_due < due_before)
+        return _MissionSelection(self._connection, sqlobject.AND(*where))
+
+    def remove_missions(self, missions):
+        """
+        Remove several missions at once with their tags, in one transaction.
+        The missions that waited for them don't wait anymore.
+
+        Return the number of missions removed.
+
+        Argument:
+            * a list of missions or of missions *id*
+        """
+        return _remove_missions(self._connection, [getattr(i, "id", i) for i in missions])
+
+    def remove_quests(self, quests):
+        """
+        Remove several quests at once, in one transaction. Their missions
+        are kept without quest.
+
+        Return the number of quests removed.
+
+        Argument:
+            * a list of quests or of quests *id*
+        """
+        return _remove_quests(self._connection, [getattr(i, "id", i) for i in quests])
 
     def get_missions_from_tag(self, tag):
-        return [i.mission_id for i in _TagMission.select(_TagMission.q.description == tag)]
+        return [i for i in _Mission.select(sqlobject.AND(_TagMission.q.mission_id == _Mission.q.id, _TagMission.q.tag == _Tag.q.id, _Tag.q.description == tag), connection=self._connection).orderBy(_Mission.q.id)]
+
+    def get_tags(self, missions):
+        """
+        Return the tags of several missions in one query as a dict of
+        mission id: list of tags.
+
+        Argument:
+            * a list of missions or of missions *id*
+        """
+        ids = [getattr(i, "id", i) for i in missions]
+        tags = dict([(i, []) for i in ids])
+        connection = self._connection
+        # avoid too big IN clauses
+        for chunk in xrange(0, len(ids), 500):
+            for table in (_TagMission, _ArchivedTagMission):
+                query = sqlbuilder.Select([table.q.mission_id, _Tag.q.description],
+                                          where=sqlobject.AND(table.q.tag == _Tag.q.id, sqlbuilder.IN(table.q.mission_id, ids[chunk:chunk + 500])),
+                                          orderBy=table.q.id)
+                for mission_id, description in connection.queryAll(connection.sqlrepr(query)):
+                    tags[mission_id].append(description.decode("utf-8") if isinstance(description, str) else description)
+        return tags
+
+    def list_tags(self, limit=None, after=None):
+        """
+        Return a generator of every tags descriptions.
+
+        Arguments:
+            * limit, the maximum number of tags returned
+            * after, a cursor returned by page()
+        """
+        clause = _after([_Tag.q.description], _decode_cursor("list_tags", after)) if after is not None else None
+        tags = _Tag.select(clause, connection=self._connection).orderBy("description")
+        for i in (tags[:limit] if limit is not None else tags):
+            yield i.description
 
-    def list_missions(self, all_missions=False):
+    def list_missions(self, all_missions=False, limit=None, after=None):
         """
         Return a generator of visible missions.
 
         Arguments:
             * all_missions=False by default, if True return all the missions.
+            * limit, the maximum number of missions returned
+            * after, a cursor returned by page()
         """
-        if not all_missions:
-            for i in _Mission.select(sqlobject.AND(_Mission.q.completed == False, sqlobject.AND(_Mission.q.realm == _Realm.q.id, _Realm.q.hide == False), sqlobject.OR(_Mission.q.tickler == None, _Mission.q.tickler < datetime.now()))):
-                if i.visible():
-                    yield i
+        after = _decode_cursor("list_missions", after) if after is not None else None
+        if not all_missions and limit is None and after is None:
+            missions = self._cached("list_missions", lambda now: list(_visible_missions(self._connection)), len, self._next_visibility_change)
+            for i in missions:
+                yield i
+        elif not all_missions:
+            missions = _visible_missions(self._connection, _after([_Mission.q.id], after) if after else None)
+            for i in (missions[:limit] if limit is not None else missions):
+                yield i
         else:
-            for i in _Mission.select():
+            # the archived missions are merged by id
+            missions = []
+            for table in (_Mission, _ArchivedMission):
+                select = table.select(_after([table.q.id], after) if after else None, connection=self._connection).orderBy(table.q.id)
+                missions.append(((i.id, i) for i in (select[:limit] if limit is not None else select)))
+            for mission_id, i in islice(merge(*missions), limit):
                 yield i
 
-    def list_quests(self, all_quests=False):
+    def list_quests(self, all_quests=False, limit=None, after=None):
         """
         Return a generator of visible quests.
 
         Arguments:
             * all_quests=False by default, if True return all the quests.
+            * limit, the maximum number of quests returned
+            * after, a cursor returned by page()
         """
+        where = [sqlbuilder.SQLTrueClause]
         if not all_quests:
-            for i in _Quest.select(sqlobject.AND(_Quest.q.hide == False, sqlobject.OR(_Quest.q.tickler == None, _Quest.q.tickler < datetime.now()))):
-                yield i
-        else:
-            for i in _Quest.select():
-                yield i
+            where += [_Quest.q.hide == False, sqlobject.OR(_Quest.q.tickler == None, _Quest.q.tickler < datetime.now())]
+        if after is not None:
+            where.append(_after([_Quest.q.id], _decode_cursor("list_quests", after)))
+        quests = _Quest.select(sqlobject.AND(*where), connection=self._connection).orderBy(_Quest.q.id)
+        for i in (quests[:limit] if limit is not None else quests):
+            yield i
 
-    def list_realms(self, all_realms=False):
+    def list_realms(self, all_realms=False, limit=None, after=None):
         """
         Return a generator of visible realms.
 
         Arguments:
             * all_realms=False by default, if True return all the realms.
+            * limit, the maximum number of realms returned
+            * after, a cursor returned by page()
         """
+        where = [sqlbuilder.SQLTrueClause]
         if not all_realms:
-            for i in _Realm.select(_Realm.q.hide == False).orderBy("position"):
-                yield i
-        else:
-            for i in _Realm.select().orderBy("position"):
-                yield i
+            where.append(_Realm.q.hide == False)
+        if after is not None:
+            where.append(_after([_Realm.q.position], _decode_cursor("list_realms", after)))
+        realms = _Realm.select(sqlobject.AND(*where), connection=self._connection).orderBy("position")
+        for i in (realms[:limit] if limit is not None else realms):
+            yield i
 
-    def last_completed_missions(self, number=5):
+    def last_completed_missions(self, number=5, after=None):
         """
         Return a generator that contain the 5 last completed missions order in a reverse chronological order.
 
         Arguments:
             * number: the maximum number of missions returned
-        """
-        for i in _Mission.select(_Mission.q.completed == True).orderBy("-completed_at")[:number]:
+            * after, a cursor returned by page()
+        """
+        after = _decode_cursor("last_completed_missions", after) if after is not None else None
+        missions = []
+        for table in (_Mission, _ArchivedMission):
+            where = [table.q.completed == True]
+            if after:
+                where.append(_after([table.q.completed_at, table.q.id], after, descending=True))
+            missions += list(table.select(sqlobject.AND(*where), connection=self._connection).orderBy([sqlbuilder.DESC(table.q.completed_at), sqlbuilder.DESC(table.q.id)])[:number])
+        for i in sorted(missions, key=lambda mission: (mission.completed_at, mission.id), reverse=True)[:number]:
             yield i
 
     def main_view(self):
@@ -657,16 +2554,18 @@ class Grail(object):
 
         Order by the realm position.
         """
-        def empty(a):
-            try:
-                a().next()
-                return False
-            except StopIteration:
-                return True
+        for realm, missions in self._cached("main_view", self._main_view, _view_size, self._next_visibility_change):
+            yield [realm, iter(missions)]
 
-        for i in self.list_realms():
-            if not empty(i.get_missions):
-                yield [i, i.get_missions()]
+    def _main_view(self, now):
+        """
+        Intern method that compute the main view as a list of lists.
+        """
+        # every visible missions of every visible realms are fetched in one
+        # ordered query then grouped by realm in one pass
+        realms = dict([(i.id, i) for i in self.list_realms()])
+        missions = _visible_missions(self._connection).orderBy([_Realm.q.position, _Mission.q.id])
+        return [[realms[realm_id], list(realm_missions)] for realm_id, realm_missions in groupby(missions, key=lambda mission: mission.realmID)]
 
     def super_main_view(self):
         """
@@ -681,38 +2580,226 @@ class Grail(object):
 
         Order by the realm position.
         """
-        def list_missions():
-            for i in _Mission.select(sqlobject.AND(_Mission.q.completed == False, _Mission.q._due < datetime.now() + timedelta(8), sqlobject.AND(_Mission.q.realm == _Realm.q.id, _Realm.q.hide == False), sqlobject.OR(_Mission.q.tickler == None, _Mission.q.tickler < datetime.now()))):
-                if i.visible():
-                    yield i
+        view = self._cached("super_main_view", self._super_main_view, _view_size, self._next_super_main_view_change)
+        return [[row, list(missions)] for row, missions in view]
 
-        def create_row(description, time_delta_value):
-            row = [i for i in list_missions() if i.id not in removed and i.due and i.due < datetime.now() + timedelta(time_delta_value)]
-            if not row:
-                return
-            row = sorted(row, key=lambda mission: mission._due)
-            main_view.append([description, row])
-            for i in row:
-                removed.add(i.id)
+    def _super_main_view(self, now):
+        """
+        Intern method that compute the super main view.
+        """
+        rows = [(description, now + timedelta(days)) for description, days in _SUPER_MAIN_VIEW_ROWS]
 
-        main_view = []
-        removed = set()
-        create_row("For today", 1)
-        create_row("For in 3 days", 4)
-        create_row("For this week", 8)
+        # one scan of the visible missions: each one goes either in the first
+        # due date row that match or in the group of its realm
+        realms = dict([(i.id, i) for i in self.list_realms()])
+        missions = _visible_missions(self._connection).orderBy([_Realm.q.position, _Mission.q.id])
 
-        main_view += filter(lambda item: item[1], [[realm, [i for i in realm.get_missions() if i.id not in removed]] for realm in self.list_realms()])
+        due_rows = [[] for i in rows]
+        realm_rows = []
+        for mission in missions:
+            due = mission._effective_due
+            for (description, limit), due_row in zip(rows, due_rows):
+                if due and due < limit:
+                    due_row.append((due, mission.id, mission))
+                    break
+            else:
+                if not realm_rows or realm_rows[-1][0].id != mission.realmID:
+                    realm_rows.append([realms[mission.realmID], []])
+                realm_rows[-1][1].append(mission)
 
-        return main_view
+        main_view = [[description, [mission for due, id, mission in sorted(due_row)]]
+                     for (description, limit), due_row in zip(rows, due_rows) if due_row]
+        return main_view + realm_rows
 
-    def search_for_mission(self, description):
+    def _cached(self, key, compute, size, expires):
         """
-        Receive a string, return all the mission that match that string
+        Intern method that return the result of a view from the cache or
+        compute it and put it in the cache.
 
-        Argument:
+        The cache isn't used inside a transaction.
+
+        Arguments:
+            * key, the key of the view in the cache
+            * compute, a function that compute the view from now
+            * size, a function that return the number of missions of the view
+            * expires, a function that return the date from which the view
+              has to be computed again, or None
+        """
+        connection = self._connection
+        if not self._view_cache.limit or isinstance(connection.getConnection(), Transaction):
+            return compute(datetime.now())
+        token = connection.queryOne("SELECT MAX(id) FROM _change")[0]
+        now = datetime.now()
+        result = self._view_cache.get(key, token, now)
+        if result is None:
+            result = compute(now)
+            self._view_cache.put(key, token, expires(now), size(result), result)
+        return result
+
+    def _next_visibility_change(self, now):
+        """
+        Intern method that return the next tickler of the uncompleted
+        missions and quests, None if there isn't.
+        """
+        ticklers = [_first_after(self._connection, table, "tickler", now, table.q.completed == False) for table in (_Mission, _Quest)]
+        return min([i for i in ticklers if i is not None] or [None])
+
+    def _next_super_main_view_change(self, now):
+        """
+        Intern method that return the next date from which a mission will
+        move in the super main view, because of a tickler or because it
+        becomes due in less than one of the super main view rows.
+        """
+        changes = [self._next_visibility_change(now)]
+        for description, days in _SUPER_MAIN_VIEW_ROWS:
+            due = _first_after(self._connection, _Mission, "_effective_due", now + timedelta(days), _Mission.q.completed == False)
+            changes.append(due - timedelta(days) if due is not None else None)
+        return min([i for i in changes if i is not None] or [None])
+
+    def cache_stats(self):
+        """
+        Return the statistics of the cache of the views: a dict of the
+        number of hits, misses and invalidations, the hit rate, the number
+        of entries and of missions in the cache and the limit of missions.
+        """
+        return self._view_cache.stats()
+
+    def list_due_missions(self, before=None, limit=None, after=None):
+        """
+        Return a generator of the visible missions that have a due date
+        ordered by their due date.
+
+        Arguments:
+            * before, if given only return the missions due before this *datetime*
+            * limit, the maximum number of missions returned
+            * after, a cursor returned by page()
+        """
+        clause = _Mission.q._effective_due != None if before is None else _Mission.q._effective_due < before
+        if after is not None:
+            clause = sqlobject.AND(clause, _after([_Mission.q._effective_due, _Mission.q.id], _decode_cursor("list_due_missions", after)))
+        missions = _visible_missions(self._connection, clause).orderBy([_Mission.q._effective_due, _Mission.q.id])
+        for i in (missions[:limit] if limit is not None else missions):
+            yield i
+
+    def count_late_missions(self):
+        """
+        Return the number of visible missions that are past their due date.
+        """
+        return _visible_missions(self._connection, _Mission.q._effective_due < datetime.now()).count()
+
+    def search_for_mission(self, description, limit=None, realm=None, tag=None, after=None, full_text=False):
+        """
+        Receive a string, return a generator of the missions that contain
+        that string, in the order of their creation.
+
+        With full_text every word of the string has to be the beginning of a
+        word of the mission description, whatever their case and order. The
+        same missions are found on every database, on SQLite the full text
+        index is used and the best matches come first.
+
+        Arguments:
             * a string
+            * limit, the maximum number of missions returned
+            * realm, only return the missions of this realm
+            * tag, only return the missions that have this tag
+            * after, a cursor returned by page()
+            * full_text, search the words instead of the string
+        """
+        query = self._full_text_query(description) if full_text else None
+        words = [re.compile(r"(?<![^\W_])" + re.escape(i), re.UNICODE | re.IGNORECASE) for i in _to_unicode(description).split()] if full_text else []
+        where = []
+        join = None
+        order = [_Mission.q.id]
+        if query:
+            where.append(sqlbuilder.SQLConstant("_mission_fts MATCH %s" % self._connection.sqlrepr(query)))
+            join = "INNER JOIN _mission_fts ON _mission_fts.rowid = _mission.id"
+            order = ["_mission_fts.rank", _Mission.q.id]
+            if after is not None:
+                where.append(_after([sqlbuilder.SQLConstant("_mission_fts.rank"), _Mission.q.id], _decode_cursor("search_for_mission", after)))
+            words = []
+        else:
+            if words:
+                # the missions that contain every word, the ones where a word
+                # isn't the beginning of a word are skipped below
+                where += [sqlbuilder.func.LOWER(_Mission.q.description).contains(i.lower()) for i in _to_unicode(description).split()]
+            else:
+                where.append(_Mission.q.description.contains(description))
+            if after is not None:
+                where.append(_after([_Mission.q.id], _decode_cursor("search_for_mission", after)))
+        if realm is not None:
+            where.append(_Mission.q.realm == realm)
+        if tag is not None:
+            where.append(sqlbuilder.IN(_Mission.q.id, sqlbuilder.Select(_TagMission.q.mission_id, where=sqlobject.AND(_TagMission.q.tag == _Tag.q.id, _Tag.q.description == tag))))
+        missions = _Mission.select(sqlobject.AND(*where), join=join, connection=self._connection).orderBy(order)
+        if words:
+            missions = islice((i for i in missions if all([j.search(i.description) for j in words])), limit)
+        elif limit is not None:
+            missions = missions[:limit]
+        for i in missions:
+            yield i
+
+    def _full_text_query(self, description):
+        """
+        Intern method that return the full text query of a search, None if
+        the full text index can't be used.
+        """
+        words = description.split()
+        if not self._full_text or not words:
+            return None
+        # every word is a prefix query, quoted to avoid the FTS5 syntax
+        return " ".join(['"%s"*' % i.replace('"', '""') for i in words])
+
+    def page(self, method, limit, after=None, **arguments):
         """
-        return [i for i in _Mission.select(_Mission.q.description.contains(description))]
+        Return a page of the elements of a list method as a tuple (elements,
+        cursor). The cursor is given as after to get the next page, it's
+        None for the last page:
+
+            missions, cursor = grail.page("list_missions", 50, all_missions=True)
+            missions, cursor = grail.page("list_missions", 50, cursor, all_missions=True)
+
+        The pages start after the last element of the previous one in the
+        indexed order of the list (id, position, completed_at, due date...),
+        so a deep page cost the same than the first one. The cursor is an
+        opaque string that can be kept between two processes, the list
+        methods also accept it as after.
+
+        Arguments:
+            * method, the name of the list method: list_missions,
+              list_quests, list_realms, list_tags, list_due_missions,
+              last_completed_missions or search_for_mission
+            * limit, the number of elements of a page
+            * after, the cursor of the previous page
+            * the other arguments of the list method
+        """
+        if method not in ("list_missions", "list_quests", "list_realms", "list_tags", "list_due_missions", "last_completed_missions", "search_for_mission"):
+            raise ValueError("%s can't be paginated" % method)
+        arguments["number" if method == "last_completed_missions" else "limit"] = limit + 1
+        elements = list(getattr(self, method)(after=after, **arguments))
+        if len(elements) <= limit:
+            return elements, None
+
+        last = elements[limit - 1]
+        if method == "list_realms":
+            values = [last.position]
+        elif method == "list_tags":
+            values = [last]
+        elif method == "list_due_missions":
+            values = [last._effective_due, last.id]
+        elif method == "last_completed_missions":
+            values = [last.completed_at, last.id]
+        elif method == "search_for_mission" and arguments.get("full_text") and self._full_text_query(arguments["description"]):
+            values = [self._connection.queryOne("SELECT rank FROM _mission_fts WHERE _mission_fts MATCH %s AND rowid = %d"
+                                                % (self._connection.sqlrepr(self._full_text_query(arguments["description"])), last.id))[0], last.id]
+        else:
+            values = [last.id]
+        return elements[:limit], _encode_cursor(method, values)
+
+
+for _name, _method in Grail.__dict__.items():
+    if not _name.startswith("_") and _name not in ("stats", "count_queries", "transaction", "cache_stats") and isinstance(_method, types.FunctionType):
+        setattr(Grail, _name, _recorded(_name, _method))
+del _name, _method
 
 
 if __name__ == "__main__":
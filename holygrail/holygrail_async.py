@@ -0,0 +1,397 @@
+#!/usr/bin/python
+# -*- coding:Utf-8 -*-
+
+"""
+This file is part of HolyGrail.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+HolyGrail  Copyright (C) 2010  Laurent Peuch  <cortex@worlddomination.be>
+"""
+
+import sys
+import threading
+import Queue
+from collections import deque
+
+from holygrail import Grail
+from holygrail_exceptions import CallCancelled, CallQueueFull
+
+# the methods of Grail that return a generator
+_GENERATORS = ("list_missions", "list_quests", "list_realms", "list_tags", "list_due_missions",
+               "last_completed_missions", "main_view", "search_for_mission")
+
+
+class _Future(object):
+    """
+    Intern object that hold the result of a call made by a worker of
+    AsyncGrail.
+    """
+    def __init__(self, function, args, kwargs):
+        self._function = function
+        self._args = args
+        self._kwargs = kwargs
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._state = "pending"
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def _run(self):
+        with self._lock:
+            if self._state != "pending":
+                return
+            self._state = "running"
+        try:
+            self._result = self._function(*self._args, **self._kwargs)
+        except:
+            self._exception = sys.exc_info()
+        self._finish("done")
+
+    def _reject(self, exception):
+        """
+        Intern method that finish the call with exception without running
+        it.
+        """
+        with self._lock:
+            if self._state != "pending":
+                return
+            self._state = "running"
+        self._exception = (type(exception), exception, None)
+        self._finish("done")
+
+    def _finish(self, state):
+        with self._lock:
+            self._state = state
+            callbacks, self._callbacks = self._callbacks, []
+        self._done.set()
+        for i in callbacks:
+            i(self)
+
+    def cancel(self):
+        """
+        Cancel the call if it hasn't been run yet, return True if the call
+        is cancelled.
+        """
+        with self._lock:
+            if self._state != "pending":
+                return self._state == "cancelled"
+            self._state = "cancelling"
+        self._finish("cancelled")
+        return True
+
+    def cancelled(self):
+        return self._state == "cancelled"
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """
+        Wait for the end of the call, return False if it isn't finished
+        after timeout seconds.
+        """
+        return self._done.wait(timeout)
+
+    def result(self):
+        """
+        Wait for the end of the call and return its result.
+
+        The exception raised by the call is raised again here, CallCancelled
+        is raised if the call has been cancelled.
+        """
+        self._done.wait()
+        if self._state == "cancelled":
+            raise CallCancelled
+        if self._exception:
+            raise self._exception[0], self._exception[1], self._exception[2]
+        return self._result
+
+    def add_done_callback(self, callback):
+        """
+        Call callback with this future once the call is finished, for
+        example to wake up an event loop. If the call is already finished
+        callback is called now.
+        """
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+
+class _Channel(object):
+    """
+    Intern bounded buffer between the worker that run a generator method of
+    Grail and the _Stream that consume its elements.
+
+    When the consumer is slower than the worker, the worker wait for it:
+    the generator can't be given to another worker meanwhile, its cursor
+    belong to the connection of its thread. The worker only know the
+    channel, so a stream that isn't used anymore can be garbage collected
+    and close the channel.
+    """
+    def __init__(self, size):
+        self._size = size
+        self._elements = deque()
+        self._condition = threading.Condition()
+        # ("end", None), ("error", exc_info) or ("cancelled", None)
+        self._end = None
+        self._closed = False
+        # the future of the chunk waited for by next_chunk()
+        self._waiting = None
+
+    def fill(self, function, args, kwargs):
+        try:
+            for i in function(*args, **kwargs):
+                if not self._put(i):
+                    return
+        except:
+            self.finish(("error", sys.exc_info()))
+        else:
+            self.finish(("end", None))
+
+    def _put(self, element):
+        with self._condition:
+            while len(self._elements) >= self._size and not self._closed:
+                self._condition.wait()
+            if self._closed:
+                return False
+            self._elements.append(element)
+            self._condition.notify_all()
+            waiting, self._waiting = self._waiting, None
+        if waiting is not None:
+            waiting._run()
+        return True
+
+    def finish(self, end):
+        with self._condition:
+            # the end of a closed stream is its closing
+            if self._end is None and not self._closed:
+                self._end = end
+            self._condition.notify_all()
+            waiting, self._waiting = self._waiting, None
+        if waiting is not None:
+            waiting._run()
+
+    def finished(self, future):
+        # wake up the consumer of a stream that will never be filled
+        if future.cancelled():
+            self.finish(("cancelled", None))
+        elif future._exception:
+            self.finish(("error", future._exception))
+
+    def get(self):
+        """
+        Wait for the next element, return a (kind, value) like the end or
+        ("element", element).
+        """
+        with self._condition:
+            while not self._elements and self._end is None and not self._closed:
+                self._condition.wait()
+            if self._elements:
+                element = self._elements.popleft()
+                self._condition.notify_all()
+                return "element", element
+            return self._end or ("end", None)
+
+    def take(self, size):
+        """
+        Return the elements already produced, at most size of them, an empty
+        list at the end. Raise the exception of the generator.
+        """
+        with self._condition:
+            elements = [self._elements.popleft() for i in range(min(size or len(self._elements), len(self._elements)))]
+            self._condition.notify_all()
+            end = self._end or (("end", None) if self._closed else None)
+        if elements or end is None or end[0] == "end":
+            return elements
+        if end[0] == "cancelled":
+            raise CallCancelled
+        raise end[1][0], end[1][1], end[1][2]
+
+    def wait_chunk(self, future):
+        """
+        Run future, a call of take(), now if there is something to take or
+        once there is.
+        """
+        with self._condition:
+            if self._waiting is not None:
+                raise ValueError("the previous chunk of this stream isn't there yet")
+            ready = self._elements or self._end is not None or self._closed
+            if not ready:
+                self._waiting = future
+        if ready:
+            future._run()
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+            waiting, self._waiting = self._waiting, None
+        if waiting is not None:
+            waiting._run()
+
+
+class _Stream(object):
+    """
+    Intern iterator over the elements of a generator method of Grail that is
+    run by a worker of AsyncGrail.
+
+    next() wait for the next element, next_chunk() doesn't block. close()
+    stop the worker, a stream garbage collected before its end is closed.
+    """
+    def __init__(self, function, args, kwargs, size):
+        self._channel = _Channel(size)
+        self._finished = False
+        self.future = _Future(self._channel.fill, (function, args, kwargs), {})
+        self.future.add_done_callback(self._channel.finished)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._finished:
+            raise StopIteration
+        kind, value = self._channel.get()
+        if kind == "element":
+            return value
+        self._finished = True
+        if kind == "error":
+            raise value[0], value[1], value[2]
+        elif kind == "cancelled":
+            raise CallCancelled
+        raise StopIteration
+
+    def next_chunk(self, size=None):
+        """
+        Return a future of the next elements, once there is at least one of
+        them, as a list of at most size elements (all the elements already
+        produced by default). The list is empty at the end of the stream.
+
+        Only one chunk can be waited for at a time.
+        """
+        future = _Future(self._channel.take, (size,), {})
+        self._channel.wait_chunk(future)
+        return future
+
+    def close(self):
+        """
+        Stop the iteration and free the worker.
+        """
+        self._finished = True
+        self._channel.close()
+        self.future.cancel()
+
+    def __del__(self):
+        # the worker of an abandoned stream would wait for it forever
+        self.close()
+
+
+class AsyncGrail(object):
+    """
+    A Grail that doesn't block its caller, for the front ends that run an
+    event loop.
+
+    Every method of Grail is available and run by a bounded number of worker
+    threads, each one using its own pooled connection to the database:
+        * the generator methods (list_*, main_view, search_for_mission, ...)
+          return an iterator over the elements produced by the worker
+        * the others return a future, use its result() or add_done_callback()
+
+    The calls wait in a bounded queue, the caller is never blocked: when
+    it's full the call isn't made and its future (or iterator) raise
+    CallQueueFull. The worker of an iterator wait for the consumer when it's
+    too slow, next_chunk() return a future of the next elements instead of
+    waiting for them. An iterator is closed, and its worker freed, by close()
+    or when it's garbage collected.
+
+    The iterators have their own workers and queue, so the iterators of slow
+    consumers only delay the other iterators, never the other calls.
+
+    The missions, quests and realms returned are normal objects, using them
+    outside of a worker can still query the database. Use run() to do a
+    whole work, for example a transaction, in a worker.
+    """
+    def __init__(self, database_uri=None, workers=4, queue_size=100, stream_size=100, stream_workers=None):
+        """
+        Arguments:
+            * database_uri, the uri of the database or a Grail
+            * workers, the number of worker threads
+            * queue_size, the maximum number of calls waiting for a worker,
+              and of iterators waiting for a worker
+            * stream_size, the maximum number of elements produced in
+              advance by a generator method
+            * stream_workers, the number of worker threads of the
+              iterators, workers by default
+        """
+        self.grail = database_uri if isinstance(database_uri, Grail) else Grail(database_uri)
+        self._stream_size = stream_size
+        self._calls = Queue.Queue(queue_size)
+        self._streams = Queue.Queue(queue_size)
+        stream_workers = workers if stream_workers is None else stream_workers
+        # (thread, queue it works for)
+        self._workers = [(threading.Thread(target=self._work, args=(queue,)), queue)
+                         for queue, number in ((self._calls, workers), (self._streams, stream_workers)) for i in range(number)]
+        for thread, queue in self._workers:
+            thread.daemon = True
+            thread.start()
+
+    def _work(self, queue):
+        while True:
+            future = queue.get()
+            if future is None:
+                return
+            future._run()
+
+    def run(self, function, *args, **kwargs):
+        """
+        Run function(*args, **kwargs) in a worker and return a future of
+        its result.
+        """
+        return self._submit(self._calls, _Future(function, args, kwargs))
+
+    def _submit(self, queue, future):
+        try:
+            queue.put_nowait(future)
+        except Queue.Full:
+            future._reject(CallQueueFull())
+        return future
+
+    def __getattr__(self, attr):
+        if attr.startswith("_") or attr == "transaction" or not callable(getattr(Grail, attr, None)):
+            raise AttributeError(attr)
+        method = getattr(self.grail, attr)
+        if attr not in _GENERATORS:
+            return lambda *args, **kwargs: self.run(method, *args, **kwargs)
+
+        def stream(*args, **kwargs):
+            stream = _Stream(method, args, kwargs, self._stream_size)
+            self._submit(self._streams, stream.future)
+            return stream
+        return stream
+
+    def close(self):
+        """
+        Stop the workers once the calls already made are finished.
+        """
+        for thread, queue in self._workers:
+            queue.put(None)
+        for thread, queue in self._workers:
+            thread.join()
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,249 @@
+#!/usr/bin/python
+# -*- coding:Utf-8 -*-
+
+"""
+This file is part of HolyGrail.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+HolyGrail  Copyright (C) 2010  Laurent Peuch  <cortex@worlddomination.be>
+
+Benchmarks of HolyGrail on a synthetic database:
+
+    python holygrail_benchmark.py run --missions 10000 --output new.json
+    python holygrail_benchmark.py compare old.json new.json
+"""
+
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+from datetime import datetime, timedelta
+
+from holygrail import Grail
+
+# the arguments of generate_dataset() and their default values
+DATASET = {"realms": 10, "quests": 100, "missions": 10000, "tags": 50, "tags_per_mission": 2,
+           "chains": 100, "chain_length": 5, "ticklers": 0.1, "dues": 0.3, "completed": 0.2, "seed": 0}
+
+# a scenario is slower than before when its median grows more than this ratio
+REGRESSION_THRESHOLD = 0.1
+
+
+def generate_dataset(grail, realms=10, quests=100, missions=10000, tags=50, tags_per_mission=2,
+                     chains=100, chain_length=5, ticklers=0.1, dues=0.3, completed=0.2, seed=0):
+    """
+    Fill a Grail with a synthetic database, always the same for the same
+    arguments, then return the number of rows created.
+
+    Arguments:
+        * grail, the Grail, usually just reset
+        * realms, quests, missions and tags, the number of each (the default
+          realm is kept)
+        * tags_per_mission, the average number of tags of a mission
+        * chains, the number of chains of missions waiting for the previous
+          one, made of chain_length missions taken in the missions
+        * ticklers, dues and completed, the ratio of missions with a tickler
+          (half in the past, half in the future), with a due date and
+          completed
+        * seed, the seed of the random generator
+    """
+    generator = random.Random(seed)
+    now = datetime.now()
+    realm_ids = [grail.get_default_realm().id] + [grail.add_realm("realm %d" % i).id for i in range(realms)]
+    quest_ids = [grail.add_quest("quest %d" % i, default_realm=generator.choice(realm_ids)).id for i in range(quests)]
+
+    def mission(number, wait_for=None):
+        return {"new_description": "mission %d" % number,
+                "realm": generator.choice(realm_ids),
+                "quest": generator.choice(quest_ids) if quest_ids and generator.random() < 0.5 else None,
+                "tickler": now + timedelta(generator.randint(-30, 30)) if generator.random() < ticklers else None,
+                "due": now + timedelta(generator.randint(-10, 60)) if generator.random() < dues else None,
+                "wait_for": wait_for}
+
+    # the chains are added one level at a time, each level waiting for the previous one
+    chain_length = chain_length if chains else 0
+    chains = min(chains, missions // chain_length) if chain_length else 0
+    ids = grail.add_missions([mission(i) for i in range(missions - chains * chain_length)])
+    level = [None] * chains
+    for depth in range(chain_length):
+        level = grail.add_missions([mission(len(ids) + i, wait_for) for i, wait_for in enumerate(level)])
+        ids += level
+
+    tag_count = 0
+    for i in range(tags):
+        tagged = [j for j in ids if generator.random() < float(tags_per_mission) / tags]
+        tag_count += grail.missions(ids=tagged).tag("tag %d" % i)
+    completed_count = grail.missions(ids=generator.sample(ids, int(len(ids) * completed))).complete()
+    return {"realms": len(realm_ids), "quests": len(quest_ids), "missions": len(ids), "tags": tag_count,
+            "completed": completed_count}
+
+
+def _main_view(grail, context):
+    return [(realm, list(missions)) for realm, missions in grail.main_view()]
+
+
+def _super_main_view(grail, context):
+    return [(realm, list(missions)) for realm, missions in grail.super_main_view()]
+
+
+def _search_for_mission(grail, context):
+    return list(grail.search_for_mission("mission %d" % context["random"].randint(0, context["missions"] - 1)))
+
+
+def _search_for_mission_full_text(grail, context):
+    return list(grail.search_for_mission("mission %d" % context["random"].randint(0, context["missions"] - 1), full_text=True))
+
+
+def _add_mission(grail, context):
+    return grail.add_mission("benchmark mission", realm=context["random"].choice(context["realms"]))
+
+
+def _change_position(grail, context):
+    realm = grail.get_realm(context["random"].choice(context["realms"]))
+    realm.change_position(context["random"].randint(0, len(context["realms"]) - 1))
+
+
+def _get_tags(grail, context):
+    return grail.get_tags(context["random"].sample(context["mission_ids"], min(100, len(context["mission_ids"]))))
+
+
+def _get_missions_from_tag(grail, context):
+    return grail.get_missions_from_tag(context["random"].choice(context["tags"]))
+
+
+# name: function(grail, context), the views are run without the view cache
+SCENARIOS = [("main_view", _main_view),
+             ("super_main_view", _super_main_view),
+             ("list_missions", lambda grail, context: list(grail.list_missions())),
+             ("list_all_missions", lambda grail, context: list(grail.list_missions(True))),
+             ("search_for_mission", _search_for_mission),
+             ("search_for_mission_full_text", _search_for_mission_full_text),
+             ("add_mission", _add_mission),
+             ("change_position", _change_position),
+             ("list_tags", lambda grail, context: list(grail.list_tags())),
+             ("get_tags", _get_tags),
+             ("get_missions_from_tag", _get_missions_from_tag)]
+
+# name: uri, %s is a temporary directory
+BACKENDS = [("sqlite-memory", "sqlite:/:memory:"),
+            ("sqlite-file", "sqlite://%s/benchmark.db")]
+
+
+def _time(function, grail, context, repeat):
+    """
+    Intern function that run a scenario repeat times and return its timings
+    in seconds.
+    """
+    timings = []
+    for i in range(repeat):
+        start = time.time()
+        function(grail, context)
+        timings.append(time.time() - start)
+    timings.sort()
+    return {"min": timings[0], "median": timings[len(timings) // 2], "max": timings[-1], "runs": repeat}
+
+
+def run_benchmark(dataset=None, scenarios=None, backends=None, repeat=10):
+    """
+    Generate the dataset on each backend, time the scenarios on it and
+    return the results, that can be saved as JSON and given to compare().
+
+    Arguments:
+        * dataset, a dict of generate_dataset() arguments, DATASET by default
+        * scenarios, the names of the scenarios to run, all of them by default
+        * backends, the names of the backends to use, all of them by default
+        * repeat, the number of runs of each scenario
+    """
+    dataset = dict(DATASET, **(dataset or {}))
+    results = {"date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "python": platform.python_version(),
+               "dataset": dataset, "repeat": repeat, "backends": {}}
+    for backend, uri in BACKENDS:
+        if backends is not None and backend not in backends:
+            continue
+        directory = tempfile.mkdtemp()
+        try:
+            grail = Grail(uri % directory if "%s" in uri else uri, view_cache_limit=0)
+            grail.reset_db("yes")
+            start = time.time()
+            counts = generate_dataset(grail, **dataset)
+            context = {"random": random.Random(dataset["seed"]), "missions": dataset["missions"],
+                       "realms": [i.id for i in grail.list_realms(True)],
+                       "mission_ids": [i.id for i in grail.list_missions(True)],
+                       "tags": list(grail.list_tags()) or ["no tag"]}
+            backend_results = {"generate_dataset": {"seconds": time.time() - start, "rows": counts}, "scenarios": {}}
+            for name, function in SCENARIOS:
+                if scenarios is None or name in scenarios:
+                    backend_results["scenarios"][name] = _time(function, grail, context, repeat)
+            results["backends"][backend] = backend_results
+        finally:
+            shutil.rmtree(directory)
+    return results
+
+
+def compare(old, new, threshold=REGRESSION_THRESHOLD):
+    """
+    Compare the medians of two results of run_benchmark() and return a list
+    of (backend, scenario, old median, new median, ratio, regression) for the
+    scenarios of both, regression is True when the new median is more than
+    threshold slower.
+    """
+    comparison = []
+    for backend in sorted(set(old["backends"]) & set(new["backends"])):
+        old_scenarios, new_scenarios = old["backends"][backend]["scenarios"], new["backends"][backend]["scenarios"]
+        for scenario in sorted(set(old_scenarios) & set(new_scenarios)):
+            old_median, new_median = old_scenarios[scenario]["median"], new_scenarios[scenario]["median"]
+            ratio = new_median / old_median if old_median else 1.0
+            comparison.append((backend, scenario, old_median, new_median, ratio, ratio > 1 + threshold))
+    return comparison
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description="Benchmarks of HolyGrail on a synthetic database")
+    commands = parser.add_subparsers(dest="command")
+    run = commands.add_parser("run", help="time the scenarios and write the results as JSON")
+    for name, value in sorted(DATASET.items()):
+        run.add_argument("--%s" % name.replace("_", "-"), dest=name, type=type(value), default=value)
+    run.add_argument("--scenario", action="append", dest="scenarios", choices=[i[0] for i in SCENARIOS])
+    run.add_argument("--backend", action="append", dest="backends", choices=[i[0] for i in BACKENDS])
+    run.add_argument("--repeat", type=int, default=10)
+    run.add_argument("--output", help="the JSON file of the results, stdout by default")
+    compare_parser = commands.add_parser("compare", help="compare two JSON results, fail if there is a regression")
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD)
+    arguments = parser.parse_args(arguments)
+
+    if arguments.command == "run":
+        results = run_benchmark(dict([(i, getattr(arguments, i)) for i in DATASET]), arguments.scenarios, arguments.backends, arguments.repeat)
+        output = open(arguments.output, "w") if arguments.output else sys.stdout
+        json.dump(results, output, indent=2, sort_keys=True)
+        output.write("\n")
+        if output is not sys.stdout:
+            output.close()
+        return 0
+
+    with open(arguments.old) as old, open(arguments.new) as new:
+        comparison = compare(json.load(old), json.load(new), arguments.threshold)
+    for backend, scenario, old_median, new_median, ratio, regression in comparison:
+        print "%-14s %-28s %10.6f %10.6f %6.2fx%s" % (backend, scenario, old_median, new_median, ratio, "  REGRESSION" if regression else "")
+    return 1 if any([i[-1] for i in comparison]) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,352 @@
+#!/usr/bin/python
+# -*- coding:Utf-8 -*-
+
+"""
+This file is part of HolyGrail.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+HolyGrail  Copyright (C) 2010  Laurent Peuch  <cortex@worlddomination.be>
+"""
+
+import csv
+import gzip
+import json
+from datetime import date, datetime
+from contextlib import contextmanager
+
+import sqlobject
+from sqlobject import sqlbuilder
+from sqlobject.converters import sqlrepr
+from sqlobject.dbconnection import Transaction
+
+from holygrail import _Realm, _Quest, _Mission, _Tag, _TagMission, _Prerequisite, _ArchivedMission, _ArchivedTagMission,\
+    _transaction, _changed, _real_connection, _connection_hub
+
+# the tables in the order they are dumped and restored
+_TABLES = (_Realm, _Quest, _Mission, _Tag, _TagMission, _Prerequisite, _ArchivedMission, _ArchivedTagMission)
+
+# the tables of the ids given by the sequence of a table, the archived
+# missions keep the ids of the missions and they mustn't be given again
+_ID_TABLES = {_Mission: (_Mission, _ArchivedMission), _ArchivedMission: (_Mission, _ArchivedMission)}
+
+# NULL in the CSV dumps, like in the COPY of PostgreSQL
+_CSV_NULL = "\\N"
+
+
+def _open(path, mode):
+    """
+    Intern function that open a dump, compressed with gzip if its name ends
+    with .gz. A file object is returned as it is.
+    """
+    if hasattr(path, "read") or hasattr(path, "write"):
+        return path
+    return gzip.open(path, mode) if path.endswith(".gz") else open(path, mode)
+
+
+def _format(path, format):
+    if format is not None:
+        return format
+    name = getattr(path, "name", path)
+    return "csv" if isinstance(name, basestring) and (name.endswith(".csv") or name.endswith(".csv.gz")) else "jsonl"
+
+
+def _columns(table):
+    """
+    Intern function that return the sqlmeta columns of a table by database
+    name, "id" included (None).
+    """
+    return [("id", None)] + [(i.dbName, i) for i in table.sqlmeta.columnList]
+
+
+def _serialize(value):
+    if isinstance(value, datetime):
+        return value.strftime("%Y-%m-%d %H:%M:%S.%f")
+    elif isinstance(value, date):
+        return value.strftime("%Y-%m-%d")
+    raise TypeError(value)
+
+
+def _rows(connection, table, chunk_size):
+    """
+    Intern generator of the rows of a table, as they are stored, read by
+    chunks in the order of their ids.
+    """
+    names = ", ".join([name for name, column in _columns(table)])
+    last = 0
+    while True:
+        rows = connection.queryAll("SELECT %s FROM %s WHERE id > %d ORDER BY id LIMIT %d" % (names, table.sqlmeta.table, last, chunk_size))
+        for row in rows:
+            yield row
+        if len(rows) < chunk_size:
+            return
+        last = rows[-1][0]
+
+
+@contextmanager
+def _snapshot(connection):
+    """
+    Intern context manager that run its block in a transaction that read
+    the database as it was at its beginning, or in the current transaction
+    if there is already one.
+    """
+    started = not isinstance(_connection_hub(connection).getConnection(), Transaction)
+    with _transaction(connection) as transaction:
+        db_name = _real_connection(transaction).dbName
+        if started and db_name == "sqlite":
+            # pysqlite only begin a transaction before a write, the writes
+            # of the other connections wait for the end of this one
+            transaction.query("BEGIN")
+        elif started and db_name == "postgres":
+            transaction.query("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+        yield transaction
+
+
+def dump(grail, destination, format=None, chunk_size=10000):
+    """
+    Write every realms, quests, missions, tags and waits for of a Grail in
+    a file, it can be read by restore().
+
+    The rows are read by chunks and written as they are stored, so the
+    memory used doesn't depend on the size of the database. They are all
+    read in one transaction, the dump is a snapshot of the database even
+    if it's modified meanwhile (on SQLite the modifications wait for the
+    end of the dump).
+
+    Return a dict of table name: number of rows.
+
+    Arguments:
+        * grail, the Grail
+        * destination, a path or a file object, a path ending with .gz is
+          compressed with gzip
+        * format, "jsonl" or "csv", by default "csv" for the paths ending
+          with .csv or .csv.gz and "jsonl" for the others
+        * chunk_size, the number of rows read by query
+    """
+    format = _format(destination, format)
+    connection = grail._connection
+    counts = {}
+    output = _open(destination, "wb")
+    try:
+        writer = csv.writer(output) if format == "csv" else None
+        if writer is None:
+            output.write(json.dumps({"holygrail": "dump", "version": 1}) + "\n")
+        with _snapshot(connection) as connection:
+            for table in _TABLES:
+                names = [name for name, column in _columns(table)]
+                if writer is None:
+                    output.write(json.dumps({"table": table.sqlmeta.table, "columns": names}) + "\n")
+                else:
+                    writer.writerow(["#table", table.sqlmeta.table] + names)
+                counts[table.sqlmeta.table] = 0
+                for row in _rows(connection, table, chunk_size):
+                    if writer is None:
+                        output.write(json.dumps(row, default=_serialize) + "\n")
+                    else:
+                        writer.writerow([_CSV_NULL if i is None else i.encode("utf-8") if isinstance(i, unicode) else
+                                         _serialize(i) if isinstance(i, date) else i for i in row])
+                    counts[table.sqlmeta.table] += 1
+    finally:
+        if output is not destination:
+            output.close()
+    return counts
+
+
+def _read_jsonl(source):
+    """
+    Intern generator of the (table name, columns, row) of a JSON lines dump.
+    """
+    header = None
+    for number, line in enumerate(source):
+        line = json.loads(line)
+        if number == 0 and not (isinstance(line, dict) and line.get("holygrail") == "dump"):
+            raise ValueError("this isn't a HolyGrail dump")
+        if isinstance(line, dict):
+            header = (str(line["table"]), [str(i) for i in line["columns"]]) if "table" in line else None
+        elif header is None:
+            raise ValueError("this isn't a HolyGrail dump")
+        else:
+            yield header[0], header[1], line
+
+
+def _read_csv(source):
+    """
+    Intern generator of the (table name, columns, row) of a CSV dump, the
+    values are still strings.
+    """
+    header = None
+    for line in csv.reader(source):
+        if line and line[0] == "#table":
+            header = line[1], line[2:]
+        elif header is None:
+            raise ValueError("this isn't a HolyGrail dump")
+        else:
+            yield header[0], header[1], [None if i == _CSV_NULL else i for i in line]
+    if header is None:
+        raise ValueError("this isn't a HolyGrail dump")
+
+
+def _converters(connection, table, names, from_csv):
+    """
+    Intern function that return the functions that turn the values of a dump
+    into SQL literals, None for the columns that aren't in the table anymore.
+
+    The values are converted here once instead of by SQLObject for each row,
+    this is where most of the time of a restore is spent.
+    """
+    db_name = _real_connection(connection).dbName
+    columns = dict(_columns(table))
+    state = sqlbuilder.SQLObjectState(table, connection=connection)
+    true, false = sqlrepr(True, db_name), sqlrepr(False, db_name)
+    converters = []
+    for name in names:
+        if name not in columns:
+            converters.append(None)
+            continue
+        column = columns[name]
+        if column is None or isinstance(column, (sqlobject.col.SOIntCol, sqlobject.col.SOKeyCol)):
+            converters.append(lambda value: str(int(value)))
+        elif isinstance(column, sqlobject.col.SOBoolCol):
+            if from_csv:
+                converters.append(lambda value: false if value in ("0", "f", "False", "false") else true)
+            else:
+                converters.append(lambda value: true if value else false)
+        elif isinstance(column, sqlobject.col.SOUnicodeCol):
+            encoding = column.getDbEncoding(state)
+            if from_csv:
+                converters.append(lambda value: sqlrepr(value.decode("utf-8").encode(encoding), db_name))
+            else:
+                converters.append(lambda value: sqlrepr(value.encode(encoding), db_name))
+        else:
+            # dates are restored as they have been stored
+            converters.append(lambda value: sqlrepr(value.encode("utf-8") if isinstance(value, unicode) else value, db_name))
+    return converters
+
+
+def _insert(connection, table, names, converters, rows):
+    """
+    Intern function that insert rows of a dump, with their ids, in one query.
+    """
+    kept = [(i, converter) for i, converter in enumerate(converters) if converter is not None]
+    values = ", ".join(["(%s)" % ", ".join(["NULL" if row[i] is None else converter(row[i]) for i, converter in kept]) for row in rows])
+    connection.query("INSERT INTO %s (%s) VALUES %s" % (table.sqlmeta.table, ", ".join([names[i] for i, converter in kept]), values))
+
+
+def _clear(connection):
+    """
+    Intern function that remove the rows of every table, in a transaction
+    unlike reset_db() (the tables are already there since the Grail is
+    connected).
+    """
+    for table in reversed(_TABLES):
+        connection.query("DELETE FROM %s" % table.sqlmeta.table)
+
+
+def _write(connection, current, batch, clear):
+    """
+    Intern function that insert a batch in its own transaction, the first
+    one also empty the database.
+    """
+    with _transaction(connection) as transaction:
+        if clear:
+            _clear(transaction)
+        _insert(transaction, *(current[1:] + (batch,)))
+
+
+def _reset_sequences(connection):
+    """
+    Intern function that set the sequences of the ids after the restored
+    ids, that have been inserted without them.
+    """
+    db_name = _real_connection(connection).dbName
+    for table in _TABLES:
+        name = table.sqlmeta.table
+        last = max([connection.queryOne("SELECT MAX(id) FROM %s" % i.sqlmeta.table)[0] or 0 for i in _ID_TABLES.get(table, (table,))])
+        if db_name == "postgres":
+            connection.query("SELECT setval('%s_id_seq', %d, false)" % (name, last + 1))
+        elif db_name == "sqlite":
+            # only the largest id ever used in the table is in sqlite_sequence
+            connection.query("DELETE FROM sqlite_sequence WHERE name = '%s'" % name)
+            connection.query("INSERT INTO sqlite_sequence (name, seq) VALUES ('%s', %d)" % (name, last))
+
+
+def restore(grail, source, format=None, batch_size=5000):
+    """
+    Replace everything in the database of a Grail by the content of a dump
+    written by dump(), the ids and the positions are kept.
+
+    The dump is read line by line and inserted by batches, each one in its
+    own transaction. The database is only emptied in the transaction of the
+    first batch, once the beginning of the dump has been read: if the
+    source can't be read or isn't a dump the database is untouched, if the
+    dump is broken further the database is left with the rows read until
+    then.
+
+    Return a dict of table name: number of rows.
+
+    Arguments:
+        * grail, the Grail
+        * source, a path or a file object, a path ending with .gz is read
+          with gzip
+        * format, "jsonl" or "csv", by default "csv" for the paths ending
+          with .csv or .csv.gz and "jsonl" for the others
+        * batch_size, the number of rows inserted by transaction
+    """
+    format = _format(source, format)
+    tables = dict([(i.sqlmeta.table, i) for i in _TABLES])
+    connection = grail._connection
+    counts = dict([(i, 0) for i in tables])
+    batch = []
+    current = None
+    # the database is emptied with the first batch
+    cleared = False
+    input = _open(source, "rb")
+    try:
+        rows = _read_csv(input) if format == "csv" else _read_jsonl(input)
+        for table_name, names, row in rows:
+            if current is None or current[0] != table_name:
+                if batch:
+                    _write(connection, current, batch, not cleared)
+                    cleared = True
+                    batch = []
+                if table_name not in tables:
+                    raise ValueError("unknown table %s" % table_name)
+                table = tables[table_name]
+                current = (table_name, table, names, _converters(connection, table, names, format == "csv"))
+            batch.append(row)
+            counts[table_name] += 1
+            if len(batch) == batch_size:
+                _write(connection, current, batch, not cleared)
+                cleared = True
+                batch = []
+        if batch:
+            _write(connection, current, batch, not cleared)
+            cleared = True
+    finally:
+        if input is not source:
+            input.close()
+
+    with _transaction(connection) as transaction:
+        if not cleared:
+            # a dump without rows
+            _clear(transaction)
+        _reset_sequences(transaction)
+        for table in _TABLES:
+            _changed(transaction, table)
+    connection.cache.clear()
+    return counts
+
+
+if __name__ == "__main__":
+    pass
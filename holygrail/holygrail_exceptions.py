@@ -81,3 +81,23 @@ class WaitForError(exceptions.Exception):
 
     def __str__(self):
         return self.error
+
+class CallCancelled(exceptions.Exception):
+    def __init__(self):
+        super(CallCancelled, self).__init__()
+
+    def __str__(self):
+        return "this call has been cancelled before being run"
+
+class CallQueueFull(exceptions.Exception):
+    def __init__(self):
+        super(CallQueueFull, self).__init__()
+
+    def __str__(self):
+        return "too many calls are waiting for a worker, this one hasn't been made"
+
+class RepeatedQueriesWarning(UserWarning):
+    """
+    Warn that a call ran many times the same query with different values,
+    usually one query per mission instead of one for all of them.
+    """
@@ -0,0 +1,781 @@
+#!/usr/bin/python
+# -*- coding:Utf-8 -*-
+
+"""
+This file is part of HolyGrail.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+HolyGrail  Copyright (C) 2010  Laurent Peuch  <cortex@worlddomination.be>
+"""
+
+import threading
+from array import array
+from bisect import bisect_left, insort
+from itertools import compress, ifilter, imap, islice, izip, repeat
+from operator import itemgetter
+from datetime import date, datetime, timedelta
+
+import sqlobject
+from sqlobject import sqlbuilder
+
+from holygrail import _Realm, _Quest, _Mission, _Tag, _TagMission, _ArchivedMission, _ArchivedTagMission, _select_rows, _effective_due, _SUPER_MAIN_VIEW_ROWS
+from holygrail_exceptions import MissionDoesntExist, QuestDoesntExist, RealmDoesntExist
+
+# the datetimes of the missions are stored as microseconds since _EPOCH
+_EPOCH = datetime(1970, 1, 1)
+
+# None in the arrays of the missions
+_NO_INTEGER = -2 ** 31
+_NO_DATETIME = float("-inf")
+
+
+def _from_datetime(value):
+    if value is None:
+        return _NO_DATETIME
+    delta = value - _EPOCH
+    # exact up to 285 years around _EPOCH
+    return float((delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds)
+
+
+def _to_datetime(value):
+    return None if value == _NO_DATETIME else _EPOCH + timedelta(microseconds=value)
+
+
+def _from_integer(value):
+    return _NO_INTEGER if value is None else int(value)
+
+
+def _to_integer(value):
+    return None if value == _NO_INTEGER else value
+
+
+def _from_date(value):
+    return _NO_INTEGER if value is None else value.toordinal()
+
+
+def _to_date(value):
+    return None if value == _NO_INTEGER else date.fromordinal(value)
+
+
+def _column_type(column):
+    """
+    Intern function that return how a column of the missions is stored:
+    (array typecode, python value to array value, array value to python
+    value, value of None), the typecode is None for the texts.
+    """
+    if isinstance(column, sqlobject.col.SOStringLikeCol):
+        return None, None, None, None
+    elif isinstance(column, sqlobject.col.SODateTimeCol):
+        return "d", _from_datetime, _to_datetime, _NO_DATETIME
+    elif isinstance(column, sqlobject.col.SODateCol):
+        return "i", _from_date, _to_date, _NO_INTEGER
+    elif isinstance(column, sqlobject.col.SOBoolCol):
+        return "b", lambda value: -1 if value is None else int(bool(value)), lambda value: None if value == -1 else bool(value), -1
+    return "i", _from_integer, _to_integer, _NO_INTEGER
+
+
+def _grow(values, size, default):
+    if len(values) < size:
+        values.extend(array(values.typecode, [default]) * (size - len(values)))
+
+
+class _Texts(object):
+    """
+    Intern column of texts stored in UTF-8 one after the other in a single
+    buffer. A modified text is written at the end, the buffer is compacted
+    when half of it isn't used anymore.
+    """
+    def __init__(self):
+        self._buffer = bytearray()
+        self._starts = array("i")
+        # -1 for None
+        self._lengths = array("i")
+        self._unused = 0
+
+    def resize(self, size):
+        _grow(self._starts, size, 0)
+        _grow(self._lengths, size, -1)
+
+    def __getitem__(self, row):
+        length = self._lengths[row]
+        if length == -1:
+            return None
+        start = self._starts[row]
+        return str(self._buffer[start:start + length]).decode("utf-8")
+
+    def __setitem__(self, row, value):
+        self._unused += max(self._lengths[row], 0)
+        if value is None:
+            self._lengths[row] = -1
+            return
+        value = value.encode("utf-8")
+        self._starts[row] = len(self._buffer)
+        self._lengths[row] = len(value)
+        self._buffer.extend(value)
+        if self._unused > 65536 and self._unused * 2 > len(self._buffer):
+            self._compact()
+
+    def _compact(self):
+        buffer = bytearray()
+        for row, length in enumerate(self._lengths):
+            if length > 0:
+                start = self._starts[row]
+                self._starts[row] = len(buffer)
+                buffer.extend(self._buffer[start:start + length])
+        self._buffer = buffer
+        self._unused = 0
+
+
+class _Missions(object):
+    """
+    Intern storage of the missions of a ReadModel: one array by column,
+    indexed by the ids of the missions, so a mission takes a few dozen bytes
+    instead of an object and one object by value. The ids are given in
+    sequence by the database, the holes of the removed missions are kept.
+    """
+    columns = ("id",) + tuple([i.name for i in _Mission.sqlmeta.columnList])
+
+    def __init__(self):
+        # 0 for no mission, 1 for a mission and 2 for an archived mission
+        self.state = array("b")
+        self.values = {}
+        self._types = []
+        for column in _Mission.sqlmeta.columnList:
+            typecode, from_python, to_python, none = _column_type(column)
+            self.values[column.name] = _Texts() if typecode is None else array(typecode)
+            self._types.append((column.name, from_python, to_python, none))
+        self._getters = dict([(name, (self.values[name], to_python)) for name, from_python, to_python, none in self._types])
+
+    def resize(self, size):
+        if size <= len(self.state):
+            return
+        # a bit more to not grow the arrays for each new mission
+        size = max(size, len(self.state) + len(self.state) // 8 + 16)
+        _grow(self.state, size, 0)
+        for name, from_python, to_python, none in self._types:
+            if from_python is None:
+                self.values[name].resize(size)
+            else:
+                _grow(self.values[name], size, none)
+
+    def set(self, rows, archived):
+        """
+        Store rows of the columns, the id first.
+        """
+        if not rows:
+            return
+        self.resize(max([i[0] for i in rows]) + 1)
+        state = 2 if archived else 1
+        for row in rows:
+            self.state[row[0]] = state
+        # column by column, most of the time is spent here when everything is loaded
+        for position, (name, from_python, to_python, none) in enumerate(self._types):
+            values = self.values[name]
+            if from_python is None:
+                for row in rows:
+                    values[row[0]] = row[position + 1]
+            else:
+                for row in rows:
+                    values[row[0]] = from_python(row[position + 1])
+
+    def get(self, name, mission_id):
+        values, to_python = self._getters[name]
+        return values[mission_id] if to_python is None else to_python(values[mission_id])
+
+    def __contains__(self, mission_id):
+        return 0 < mission_id < len(self.state) and self.state[mission_id] != 0
+
+    def ids(self):
+        return compress(xrange(len(self.state)), self.state)
+
+
+class _TagLinks(object):
+    """
+    Intern copy of a table of the tags of the missions: the mission and the
+    tag of each row by id and, by mission, a linked list of its rows in the
+    order of their ids.
+    """
+    def __init__(self):
+        self.mission = array("i")
+        self.tag = array("i")
+        self._next = array("i")
+        self._first = array("i")
+
+    def add(self, row_id, mission_id, tag_id):
+        """
+        Add a row, return False if it's already known.
+        """
+        if row_id >= len(self.mission):
+            size = max(row_id + 1, len(self.mission) + len(self.mission) // 8 + 16)
+            for i in (self.mission, self.tag, self._next):
+                _grow(i, size, 0)
+        if mission_id >= len(self._first):
+            _grow(self._first, max(mission_id + 1, len(self._first) + len(self._first) // 8 + 16), 0)
+        if self.mission[row_id]:
+            return False
+        self.mission[row_id], self.tag[row_id] = mission_id, tag_id
+        previous, current = None, self._first[mission_id]
+        while current and current < row_id:
+            previous, current = current, self._next[current]
+        self._next[row_id] = current
+        if previous is None:
+            self._first[mission_id] = row_id
+        else:
+            self._next[previous] = row_id
+        return True
+
+    def remove(self, row_id):
+        """
+        Remove a row, return its (mission id, tag id) or None if it isn't
+        known.
+        """
+        if row_id >= len(self.mission) or not self.mission[row_id]:
+            return None
+        mission_id, tag_id = self.mission[row_id], self.tag[row_id]
+        previous, current = None, self._first[mission_id]
+        while current != row_id:
+            previous, current = current, self._next[current]
+        if previous is None:
+            self._first[mission_id] = self._next[row_id]
+        else:
+            self._next[previous] = self._next[row_id]
+        self.mission[row_id] = self.tag[row_id] = self._next[row_id] = 0
+        return mission_id, tag_id
+
+    def tags(self, mission_id):
+        """
+        Return the ids of the tags of a mission.
+        """
+        tags = []
+        current = self._first[mission_id] if mission_id < len(self._first) else 0
+        while current:
+            tags.append(self.tag[current])
+            current = self._next[current]
+        return tags
+
+
+class _Record(object):
+    """
+    Intern read only copy of a row, its attributes are the columns of the
+    SQLObject class.
+    """
+    __slots__ = ("_model",)
+    _columns = ()
+
+    def __init__(self, model):
+        self._model = model
+
+    def _set(self, row):
+        for name, value in zip(self._columns, row):
+            setattr(self, name, value)
+
+    def __repr__(self):
+        return "<%s %s %r>" % (self.__class__.__name__, self.id, self.description)
+
+
+class _RealmRecord(_Record):
+    _columns = ("id",) + tuple([i.name for i in _Realm.sqlmeta.columnList])
+    __slots__ = _columns
+
+
+class _QuestRecord(_Record):
+    _columns = ("id",) + tuple([i.name for i in _Quest.sqlmeta.columnList])
+    __slots__ = _columns
+
+    @property
+    def default_realm(self):
+        return self._model._realms.get(self.default_realmID)
+
+
+class _MissionRecord(tuple):
+    """
+    Intern view of a mission stored in the arrays of a ReadModel, the tuple
+    (model, id). It's created when the mission is returned and always read
+    the current values, each one while the model is locked, two views of
+    the same mission are equal.
+    """
+    __slots__ = ()
+    _model = property(itemgetter(0))
+    id = property(itemgetter(1))
+
+    def __repr__(self):
+        return "<%s %s %r>" % (self.__class__.__name__, self.id, self.description)
+
+    @property
+    def realm(self):
+        return self._model._realms.get(self.realmID)
+
+    @property
+    def quest(self):
+        return self._model._quests.get(self.questID)
+
+    @property
+    def previous_mission(self):
+        previous_mission = self.previous_missionID
+        return _MissionRecord((self._model, previous_mission)) if previous_mission in self._model._missions else None
+
+    @property
+    def due(self):
+        return self._effective_due
+
+    @property
+    def tags(self):
+        return self._model._mission_tags(self.id)
+
+    @property
+    def archived(self):
+        return self._model._missions.state[self.id] == 2
+
+
+def _column_property(name):
+    def get(self):
+        # a text can be moved by a modification of the model
+        model = self._model
+        with model._lock:
+            return model._missions.get(name, self.id)
+    return property(get)
+
+for _name in _Missions.columns[1:]:
+    setattr(_MissionRecord, _name, _column_property(_name))
+del _name
+
+
+def _remove(sorted_list, value):
+    """
+    Intern function that remove a value from a sorted list.
+    """
+    position = bisect_left(sorted_list, value)
+    if position < len(sorted_list) and sorted_list[position] == value:
+        del sorted_list[position]
+
+
+def _position(index, keys, key, mission_id):
+    """
+    Intern function that return the position of (key, mission_id) in an
+    index of mission ids sorted by (key of the mission, id).
+    """
+    low, high = 0, len(index)
+    while low < high:
+        middle = (low + high) // 2
+        i = index[middle]
+        if keys[i] < key or (keys[i] == key and i < mission_id):
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+class ReadModel(object):
+    """
+    An in memory copy of the database of a Grail for the clients that read
+    it a lot, like the ncurses one.
+
+    Everything is loaded once, the missions in arrays of their columns
+    (about 15 MB for 100k missions with their tags), and indexed by realm,
+    quest, tag and due date. The missions are returned as records that have
+    their attributes (mission.realm, mission.quest and mission.tags
+    included) and the realms and the quests as records. The modifications
+    made through any Grail on the same database are then applied to the
+    copy, a transaction once it's committed.
+
+    The records are read only, use the Grail to modify them:
+
+        grail.get_mission(record.id).toggle()
+
+    The view methods of Grail are answered from memory, the missions of a
+    view are selected while the copy is locked, so the modifications
+    applied meanwhile by another thread don't change a view being read.
+    """
+    def __init__(self, grail):
+        """
+        Argument:
+            * grail, the Grail of the database
+        """
+        self.grail = grail
+        self._connection = grail._connection
+        self._lock = threading.RLock()
+        with self._lock:
+            self._load()
+        self._connection.listeners.append(self._apply)
+
+    def close(self):
+        """
+        Stop following the modifications of the database.
+        """
+        if self._apply in self._connection.listeners:
+            self._connection.listeners.remove(self._apply)
+
+    def _rows(self, table, columns, ids):
+        if ids is None:
+            return _select_rows(self._connection, table, columns)
+        rows = []
+        # avoid too big IN clauses
+        for chunk in xrange(0, len(ids), 500):
+            rows += _select_rows(self._connection, table, columns, sqlbuilder.IN(table.q.id, ids[chunk:chunk + 500]))
+        return rows
+
+    def _load(self):
+        self._realms = {}
+        self._quests = {}
+        self._missions = _Missions()
+        self._by_realm = {}
+        self._by_quest = {}
+        self._by_tag = {}
+        # the ids of the missions sorted by (date, id)
+        self._by_due = array("i")
+        self._by_completed_at = array("i")
+        self._tags = {}
+        self._tag_links = {_TagMission: _TagLinks(), _ArchivedTagMission: _TagLinks()}
+        self._load_realms(None)
+        self._load_quests(None)
+        self._load_tags(None)
+
+        # the indexes are sorted once instead of inserting every mission
+        last = max([self._connection.queryOne("SELECT MAX(id) FROM %s" % i.sqlmeta.table)[0] or 0 for i in (_Mission, _ArchivedMission)])
+        self._missions.resize(last + 1)
+        by_realm, by_quest = {}, {}
+        for table in (_Mission, _ArchivedMission):
+            self._missions.set(self._rows(table, _Missions.columns, None), table is _ArchivedMission)
+        quest = self._missions.values["questID"]
+        for i in self._missions.ids():
+            by_realm.setdefault(self._missions.values["realmID"][i], []).append(i)
+            # the due date of the archived missions doesn't follow their quest
+            if quest[i] != _NO_INTEGER and self._missions.state[i] == 1:
+                by_quest.setdefault(quest[i], []).append(i)
+        self._by_realm = dict([(i, array("i", j)) for i, j in by_realm.iteritems()])
+        self._by_quest = dict([(i, array("i", j)) for i, j in by_quest.iteritems()])
+        for index, name in ((self._by_due, "_effective_due"), (self._by_completed_at, "completed_at")):
+            keys = self._missions.values[name]
+            index.extend(array("i", sorted([i for i in self._missions.ids() if keys[i] != _NO_DATETIME], key=lambda i: (keys[i], i))))
+
+        by_tag = {}
+        for table in (_TagMission, _ArchivedTagMission):
+            for row_id, mission_id, tag_id in self._rows(table, ("id", "mission_idID", "tagID"), None):
+                self._tag_links[table].add(row_id, mission_id, tag_id)
+                if table is _TagMission:
+                    by_tag.setdefault(self._tags[tag_id], []).append(mission_id)
+        self._by_tag = dict([(i, array("i", sorted(j))) for i, j in by_tag.iteritems()])
+
+    def _apply(self, table, ids):
+        """
+        Intern listener that reload the modified rows.
+        """
+        with self._lock:
+            if ids is None:
+                self._load()
+            elif table in (_Mission, _ArchivedMission):
+                self._load_missions(ids)
+            elif table is _Quest:
+                self._load_quests(ids)
+            elif table is _Realm:
+                self._load_realms(ids)
+            elif table is _Tag:
+                self._load_tags(ids)
+            elif table in (_TagMission, _ArchivedTagMission):
+                self._load_tag_missions(table, ids)
+
+    def _load_realms(self, ids):
+        removed = set(ids or [])
+        for row in self._rows(_Realm, _RealmRecord._columns, ids):
+            realm = self._realms.get(row[0]) or _RealmRecord(self)
+            realm._set(row)
+            self._realms[realm.id] = realm
+            removed.discard(realm.id)
+        for i in removed:
+            self._realms.pop(i, None)
+
+    def _load_quests(self, ids):
+        removed = set(ids or [])
+        for row in self._rows(_Quest, _QuestRecord._columns, ids):
+            quest = self._quests.get(row[0]) or _QuestRecord(self)
+            due = getattr(quest, "due", None)
+            quest._set(row)
+            self._quests[quest.id] = quest
+            removed.discard(quest.id)
+            if ids is not None and quest.due != due:
+                # the due date of the missions of the quest has changed
+                effective_due = self._missions.values["_effective_due"]
+                for i in list(self._by_quest.get(quest.id, [])):
+                    self._unindex(i)
+                    effective_due[i] = _from_datetime(_effective_due(self._missions.get("_due", i), quest.due))
+                    self._index(i)
+        for i in removed:
+            self._quests.pop(i, None)
+
+    def _load_missions(self, ids):
+        removed = set(ids or [])
+        rows = [(i, False) for i in self._rows(_Mission, _Missions.columns, ids)]
+        rows += [(i, True) for i in self._rows(_ArchivedMission, _Missions.columns, ids)]
+        for row, archived in rows:
+            if row[0] in self._missions:
+                self._unindex(row[0])
+            self._missions.set([row], archived)
+            self._index(row[0])
+            removed.discard(row[0])
+        for i in removed:
+            if i in self._missions:
+                self._unindex(i)
+                self._missions.state[i] = 0
+                for tag in self._tag_links[_TagMission].tags(i):
+                    _remove(self._by_tag.get(self._tags[tag], []), i)
+
+    def _index(self, mission_id):
+        values = self._missions.values
+        insort(self._by_realm.setdefault(values["realmID"][mission_id], array("i")), mission_id)
+        # the due date of the archived missions doesn't follow their quest
+        if values["questID"][mission_id] != _NO_INTEGER and self._missions.state[mission_id] == 1:
+            insort(self._by_quest.setdefault(values["questID"][mission_id], array("i")), mission_id)
+        for index, name in ((self._by_due, "_effective_due"), (self._by_completed_at, "completed_at")):
+            key = values[name][mission_id]
+            if key != _NO_DATETIME:
+                index.insert(_position(index, values[name], key, mission_id), mission_id)
+
+    def _unindex(self, mission_id):
+        values = self._missions.values
+        _remove(self._by_realm.get(values["realmID"][mission_id], []), mission_id)
+        _remove(self._by_quest.get(values["questID"][mission_id], []), mission_id)
+        for index, name in ((self._by_due, "_effective_due"), (self._by_completed_at, "completed_at")):
+            key = values[name][mission_id]
+            if key != _NO_DATETIME:
+                position = _position(index, values[name], key, mission_id)
+                if position < len(index) and index[position] == mission_id:
+                    del index[position]
+
+    def _load_tags(self, ids):
+        for tag_id, description in self._rows(_Tag, ("id", "description"), ids):
+            self._tags[tag_id] = description
+
+    def _load_tag_missions(self, table, ids):
+        links = self._tag_links[table]
+        removed = set(ids or [])
+        for row_id, mission_id, tag_id in sorted(self._rows(table, ("id", "mission_idID", "tagID"), ids)):
+            removed.discard(row_id)
+            if links.add(row_id, mission_id, tag_id) and table is _TagMission:
+                insort(self._by_tag.setdefault(self._tags[tag_id], array("i")), mission_id)
+        for i in removed:
+            link = links.remove(i)
+            if link is not None and table is _TagMission:
+                _remove(self._by_tag.get(self._tags[link[1]], []), link[0])
+
+    def _mission_tags(self, mission_id):
+        with self._lock:
+            return tuple([self._tags[i] for i in self._tag_links[_TagMission].tags(mission_id) + self._tag_links[_ArchivedTagMission].tags(mission_id)])
+
+    def _records(self, ids):
+        return imap(_MissionRecord, izip(repeat(self), ids))
+
+    def _hidden_quests(self, now):
+        return set([i.id for i in self._quests.itervalues() if i.hide or i.completed or (i.tickler is not None and i.tickler >= now)])
+
+    def _visible(self, ids, now, hidden_quests, check_realm=True):
+        """
+        Intern generator of the ids of the visible missions, see
+        _visible_missions(). It must be consumed while the model is locked.
+
+        Arguments:
+            * ids, the ids of the missions to filter
+            * now, the current datetime
+            * hidden_quests, the result of _hidden_quests(now)
+            * check_realm, skip the missions of the hidden realms
+        """
+        values, state = self._missions.values, self._missions.state
+        completed, unmet, tickler, quest, realm = [values[i] for i in ("completed", "unmet_prerequisites", "tickler", "questID", "realmID")]
+        hidden_realms = set([i.id for i in self._realms.itervalues() if i.hide]) if check_realm else ()
+        now = _from_datetime(now)
+        for i in ids:
+            if state[i] and not completed[i] and not unmet[i] and tickler[i] < now and quest[i] not in hidden_quests and realm[i] not in hidden_realms:
+                yield i
+
+    def _visible_realms(self):
+        return sorted([i for i in self._realms.itervalues() if not i.hide], key=lambda realm: realm.position)
+
+    def get_mission(self, mission_id):
+        """
+        Return the mission with this id, raise MissionDoesntExist if it
+        doesn't exist.
+        """
+        if mission_id not in self._missions:
+            raise MissionDoesntExist(mission_id)
+        return _MissionRecord((self, mission_id))
+
+    def get_quest(self, quest_id):
+        """
+        Return the quest with this id, raise QuestDoesntExist if it doesn't
+        exist.
+        """
+        try:
+            return self._quests[quest_id]
+        except KeyError:
+            raise QuestDoesntExist(quest_id)
+
+    def get_realm(self, realm_id):
+        """
+        Return the realm with this id, raise RealmDoesntExist if it doesn't
+        exist.
+        """
+        try:
+            return self._realms[realm_id]
+        except KeyError:
+            raise RealmDoesntExist(realm_id)
+
+    def get_default_realm(self):
+        """
+        Return the default realm.
+        """
+        return [i for i in self._realms.itervalues() if i.default_realm][0]
+
+    def get_missions_from_tag(self, tag):
+        """
+        Return the list of the missions that have this tag.
+        """
+        with self._lock:
+            return list(self._records([i for i in self._by_tag.get(tag, []) if i in self._missions]))
+
+    def get_tags(self, missions):
+        """
+        Return the tags of several missions as a dict of mission id: list
+        of tags.
+
+        Argument:
+            * a list of missions or of missions *id*
+        """
+        with self._lock:
+            ids = [getattr(i, "id", i) for i in missions]
+            return dict([(i, list(self._mission_tags(i)) if i in self._missions else []) for i in ids])
+
+    def list_tags(self):
+        """
+        Return a generator of every tags descriptions.
+        """
+        with self._lock:
+            return iter(sorted(self._tags.values()))
+
+    def list_missions(self, all_missions=False):
+        """
+        Return a generator of visible missions.
+
+        Arguments:
+            * all_missions=False by default, if True return all the missions.
+        """
+        with self._lock:
+            now = datetime.now()
+            ids = self._missions.ids()
+            return self._records(list(ids if all_missions else self._visible(ids, now, self._hidden_quests(now))))
+
+    def list_quests(self, all_quests=False):
+        """
+        Return a generator of visible quests.
+
+        Arguments:
+            * all_quests=False by default, if True return all the quests.
+        """
+        with self._lock:
+            now = datetime.now()
+            return iter([self._quests[i] for i in sorted(self._quests)
+                         if all_quests or (not self._quests[i].hide and (self._quests[i].tickler is None or self._quests[i].tickler < now))])
+
+    def list_realms(self, all_realms=False):
+        """
+        Return a generator of visible realms.
+
+        Arguments:
+            * all_realms=False by default, if True return all the realms.
+        """
+        with self._lock:
+            return iter(sorted(self._realms.values(), key=lambda realm: realm.position) if all_realms else self._visible_realms())
+
+    def last_completed_missions(self, number=5):
+        """
+        Return a generator of the last completed missions in a reverse
+        chronological order.
+
+        Arguments:
+            * number: the maximum number of missions returned
+        """
+        with self._lock:
+            completed = self._missions.values["completed"]
+            ids = reversed(self._by_completed_at)
+            return self._records(list(islice(ifilter(lambda i: completed[i] == 1, ids), number)))
+
+    def _realm_rows(self, now, keep=None):
+        """
+        Intern method that return the [realm, iterator over its visible
+        missions] of the visible realms that have visible missions. It must
+        be called while the model is locked.
+
+        Arguments:
+            * now, the current datetime
+            * keep, if given only the missions for which it's True
+        """
+        rows = []
+        hidden_quests = self._hidden_quests(now)
+        for realm in self._visible_realms():
+            missions = self._visible(self._by_realm.get(realm.id, ()), now, hidden_quests, check_realm=False)
+            missions = list(ifilter(keep, missions) if keep is not None else missions)
+            # the realms without visible missions are skipped
+            if missions:
+                rows.append([realm, self._records(missions)])
+        return rows
+
+    def main_view(self):
+        """
+        Return the main view, like Grail.main_view().
+        """
+        with self._lock:
+            return iter(self._realm_rows(datetime.now()))
+
+    def super_main_view(self):
+        """
+        Return the super main view, like Grail.super_main_view(), the
+        missions of the realms are iterators like in main_view().
+        """
+        with self._lock:
+            now = datetime.now()
+            hidden_quests = self._hidden_quests(now)
+            effective_due = self._missions.values["_effective_due"]
+            # the missions of each row are the ones between two limits in the due dates index
+            rows = []
+            start = 0
+            for description, days in _SUPER_MAIN_VIEW_ROWS:
+                limit = _from_datetime(now + timedelta(days))
+                end = _position(self._by_due, effective_due, limit, 0)
+                missions = list(self._records(self._visible(self._by_due[start:end], now, hidden_quests)))
+                if missions:
+                    rows.append([description, missions])
+                start = end
+            return rows + self._realm_rows(now, lambda i: effective_due[i] == _NO_DATETIME or effective_due[i] >= limit)
+
+    def list_due_missions(self, before=None):
+        """
+        Return a generator of the visible missions that have a due date
+        ordered by their due date.
+
+        Arguments:
+            * before, if given only return the missions due before this *datetime*
+        """
+        with self._lock:
+            now = datetime.now()
+            end = len(self._by_due) if before is None else _position(self._by_due, self._missions.values["_effective_due"], _from_datetime(before), 0)
+            return self._records(list(self._visible(self._by_due[:end], now, self._hidden_quests(now))))
+
+    def count_late_missions(self):
+        """
+        Return the number of visible missions that are past their due date.
+        """
+        return len(list(self.list_due_missions(datetime.now())))
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,249 @@
+#!/usr/bin/python
+# -*- coding:Utf-8 -*-
+
+"""
+This file is part of HolyGrail.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+HolyGrail  Copyright (C) 2010  Laurent Peuch  <cortex@worlddomination.be>
+"""
+
+from datetime import datetime
+from xml.etree.cElementTree import iterparse
+
+from holygrail import _Realm, _Quest, _Mission, _Tag, _TagMission, _Prerequisite,\
+    _transaction, _insert_rows, _select_rows, _expire_cached, _changed, _id_lists, _to_unicode, _shift_unmet_prerequisites
+from holygrail_dump import _open
+
+# the elements of a Tracks export that are imported, by the element that
+# contains them
+_RECORDS = {"contexts": "context", "projects": "project", "todos": "todo",
+            "tags": "tag", "taggings": "tagging", "dependencies": "dependency"}
+
+
+def _integer(value):
+    return int(value) if value else None
+
+
+def _datetime(value):
+    """
+    Intern function that read a date or a datetime of a Tracks export, the
+    time zone is dropped.
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if len(value) == 10:
+        return datetime.strptime(value, "%Y-%m-%d")
+    return datetime.strptime(value[:19].replace("T", " "), "%Y-%m-%d %H:%M:%S")
+
+
+def _date(value):
+    value = _datetime(value)
+    return value.date() if value else datetime.now().date()
+
+
+class _TracksImport(object):
+    """
+    Intern object that insert the elements of a Tracks export by batches, in
+    the order of the file.
+
+    Tracks write the todos before the contexts and the projects, and the
+    taggings or dependencies can't be inserted before their todos: what
+    isn't known yet is kept aside and linked at the end. Only the mapping of
+    the Tracks ids to the new ids stays in memory.
+    """
+    def __init__(self, grail, batch_size, progress):
+        self._connection = grail._connection
+        self._batch_size = batch_size
+        self._progress = progress
+        self._kind = None
+        self._batch = []
+        self._contexts, self._projects, self._todos, self._tags = {}, {}, {}, {}
+        self._tag_ids = {}
+        self._default_realm = None
+        self._next_position = None
+        self._first_mission = None
+        # (mission, Tracks context, Tracks project) of the todos read before their context or project
+        self._unlinked_missions = []
+        # taggings and dependencies read before their todos
+        self._deferred = {"tagging": [], "dependency": []}
+        self.counts = {"realms": 0, "quests": 0, "missions": 0, "tags": 0, "prerequisites": 0}
+
+    def add(self, kind, fields):
+        if kind != self._kind or len(self._batch) >= self._batch_size:
+            self.flush()
+        self._kind = kind
+        self._batch.append(fields)
+
+    def flush(self):
+        if not self._batch:
+            return
+        batch, self._batch = self._batch, []
+        if self._kind == "tag":
+            # the tags are only inserted when a todo use them
+            self._tags.update([(_integer(i.get("id")), _to_unicode(i.get("name") or "")) for i in batch])
+            return
+        with _transaction(self._connection) as transaction:
+            getattr(self, "_insert_%s" % self._kind)(transaction, batch)
+        if self._progress:
+            self._progress(dict(self.counts))
+
+    def _insert_context(self, connection, batch):
+        if self._next_position is None:
+            self._next_position = (connection.queryOne("SELECT MAX(position) FROM _realm")[0] or 0) + 1
+        rows = []
+        for i in batch:
+            rows.append((_to_unicode(i.get("name") or ""), _date(i.get("created-at")),
+                         i.get("hide") == "true" or i.get("state") in ("hidden", "closed"), self._next_position))
+            self._next_position += 1
+        ids = _insert_rows(connection, _Realm, ("description", "created_at", "hide", "position"), rows)
+        self._contexts.update(zip([_integer(i.get("id")) for i in batch], ids))
+        self.counts["realms"] += len(ids)
+
+    def _insert_project(self, connection, batch):
+        rows = [(_to_unicode(i.get("name") or ""), _date(i.get("created-at")), i.get("state") == "completed",
+                 _datetime(i.get("completed-at")), self._contexts.get(_integer(i.get("default-context-id"))),
+                 i.get("state") == "hidden") for i in batch]
+        ids = _insert_rows(connection, _Quest, ("description", "created_at", "completed", "completed_at", "default_realmID", "hide"), rows)
+        self._projects.update(zip([_integer(i.get("id")) for i in batch], ids))
+        self.counts["quests"] += len(ids)
+
+    def _insert_todo(self, connection, batch):
+        if self._default_realm is None:
+            self._default_realm = connection.queryOne("SELECT id FROM _realm WHERE default_realm = %s" % connection.sqlrepr(True))[0]
+        rows, unlinked = [], []
+        for position, i in enumerate(batch):
+            context, project = _integer(i.get("context-id")), _integer(i.get("project-id"))
+            if (context and context not in self._contexts) or (project and project not in self._projects):
+                unlinked.append((position, context, project))
+            due = _datetime(i.get("due"))
+            # the projects of Tracks don't have due dates, the effective due date is the due date
+            rows.append((_to_unicode(i.get("description") or ""), _date(i.get("created-at")), _datetime(i.get("show-from")),
+                         self._contexts.get(context, self._default_realm), self._projects.get(project), due,
+                         i.get("state") == "completed", _datetime(i.get("completed-at")), due, 0))
+        ids = _insert_rows(connection, _Mission, ("description", "created_at", "tickler", "realmID", "questID", "_due",
+                                                  "completed", "completed_at", "_effective_due", "unmet_prerequisites"), rows)
+        self._todos.update(zip([_integer(i.get("id")) for i in batch], ids))
+        self._unlinked_missions += [(ids[position], context, project) for position, context, project in unlinked]
+        if self._first_mission is None and ids:
+            self._first_mission = ids[0]
+        self.counts["missions"] += len(ids)
+
+    def _tag_id(self, connection, name):
+        if name not in self._tag_ids:
+            existing = _select_rows(connection, _Tag, ("id",), _Tag.q.description == name)
+            self._tag_ids[name] = existing[0][0] if existing else _insert_rows(connection, _Tag, ("description",), [(name,)])[0]
+        return self._tag_ids[name]
+
+    def _insert_tagging(self, connection, batch):
+        rows = set()
+        for i in batch:
+            if i.get("taggable-type", "Todo") != "Todo":
+                continue
+            todo, tag = _integer(i.get("taggable-id")), _integer(i.get("tag-id"))
+            if todo not in self._todos or tag not in self._tags:
+                self._deferred["tagging"].append(i)
+                continue
+            rows.add((self._todos[todo], self._tag_id(connection, self._tags[tag])))
+        _insert_rows(connection, _TagMission, ("mission_idID", "tagID"), sorted(rows))
+        self.counts["tags"] += len(rows)
+
+    def _insert_dependency(self, connection, batch):
+        rows = set()
+        for i in batch:
+            successor, predecessor = _integer(i.get("successor-id")), _integer(i.get("predecessor-id"))
+            if successor not in self._todos or predecessor not in self._todos:
+                self._deferred["dependency"].append(i)
+            elif successor != predecessor:
+                rows.add((self._todos[successor], self._todos[predecessor]))
+        _insert_rows(connection, _Prerequisite, ("missionID", "prerequisiteID"), sorted(rows))
+        self.counts["prerequisites"] += len(rows)
+
+    def finish(self):
+        """
+        Link what has been read before the elements it needs, then count the
+        unmet prerequisites of the new missions.
+        """
+        self.flush()
+        for kind in ("tagging", "dependency"):
+            deferred, self._deferred[kind] = self._deferred[kind], []
+            for chunk in xrange(0, len(deferred), self._batch_size):
+                self._kind = kind
+                self._batch = deferred[chunk:chunk + self._batch_size]
+                self.flush()
+            # the todos of the ones still deferred aren't in the export
+            self._deferred[kind] = []
+        if self._first_mission is None:
+            return
+
+        with _transaction(self._connection) as connection:
+            links = {}
+            for mission, context, project in self._unlinked_missions:
+                links.setdefault((self._contexts.get(context, self._default_realm), self._projects.get(project)), []).append(mission)
+            for (realm, quest), ids in links.iteritems():
+                for i in _id_lists(ids):
+                    connection.query("UPDATE _mission SET realm_id = %d, quest_id = %s WHERE id IN (%s)" % (realm, connection.sqlrepr(quest), i))
+            _expire_cached(connection, _Mission, condition=lambda mission: mission.id >= self._first_mission)
+            _changed(connection, _Mission, [i[0] for i in self._unlinked_missions])
+            # the new missions only wait for new missions
+            uncompleted = connection.queryAll("SELECT DISTINCT prerequisite_id FROM _prerequisite, _mission WHERE _mission.id = prerequisite_id "
+                                              "AND mission_id >= %d AND completed = %s" % (self._first_mission, connection.sqlrepr(False)))
+            _shift_unmet_prerequisites(connection, [i[0] for i in uncompleted], 1)
+
+
+def import_tracks(grail, source, batch_size=1000, progress=None):
+    """
+    Import an XML export of Tracks (getontracks.org) in a Grail: the contexts
+    become realms, the projects quests and the todos missions, with their
+    tags, due dates, show from dates (the ticklers) and dependencies.
+
+    The file is parsed as it is read and the elements inserted by batches,
+    each one in its own transaction, so only the mapping of the Tracks ids
+    stays in memory.
+
+    Return a dict of the number of realms, quests, missions, tags (of the
+    missions) and prerequisites imported.
+
+    Arguments:
+        * grail, the Grail
+        * source, a path or a file object, a path ending with .gz is read
+          with gzip
+        * batch_size, the number of elements inserted by transaction
+        * progress, a function called after each batch with the numbers
+          imported until then
+    """
+    importer = _TracksImport(grail, batch_size, progress)
+    input = _open(source, "rb")
+    try:
+        parents = []
+        for event, element in iterparse(input, events=("start", "end")):
+            if event == "start":
+                parents.append(element)
+                continue
+            parents.pop()
+            if len(parents) == 2 and _RECORDS.get(parents[-1].tag) == element.tag:
+                importer.add(element.tag, dict([(i.tag, None if i.get("nil") == "true" else i.text) for i in element]))
+                # the elements already imported are freed
+                parents[-1].clear()
+    finally:
+        if input is not source:
+            input.close()
+    importer.finish()
+    return importer.counts
+
+
+if __name__ == "__main__":
+    pass
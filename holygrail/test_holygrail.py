@@ -20,11 +20,20 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 HolyGrail  Copyright (C) 2010  Laurent Peuch  <cortex@worlddomination.be>
 """
 
-import unittest, time
+import unittest, time, tempfile, shutil, threading, warnings
+from StringIO import StringIO
 
 from datetime import date, datetime, timedelta
 
-from holygrail import Grail, MissionDoesntExist, CanRemoveTheDefaultRealm, RealmDoesntExist, RealmStillHasElems, _Realm, QuestDoesntExist, _Mission, _Quest, WaitForError
+import sqlobject
+
+from holygrail import Grail, MissionDoesntExist, CanRemoveTheDefaultRealm, RealmDoesntExist, RealmStillHasElems, _Realm, QuestDoesntExist, _Mission, _Quest, WaitForError, _Prerequisite, _ArchivedMission
+from holygrail_async import AsyncGrail
+from holygrail_dump import dump, restore
+from holygrail_tracks import import_tracks
+from holygrail_benchmark import generate_dataset, run_benchmark, compare
+from holygrail_read_model import ReadModel
+from holygrail_exceptions import CallCancelled, CallQueueFull, RepeatedQueriesWarning
 
 def _to_list(sequence):
     return map(lambda x: [x[0], list(x[1])], list(sequence))
@@ -64,6 +73,28 @@ class Test_Main(unittest.TestCase):
         grail.reset_db("yes")
         return grail
 
+    def test_create_indexes_twice(self):
+        self.grail.create_indexes()
+        with self.grail.count_queries() as counter:
+            self.grail.create_indexes()
+        # only the query that list the indexes
+        self.assertEqual(1, counter.queries)
+
+    def test_create_missing_indexes(self):
+        self.grail._connection.query("DROP INDEX _mission_quest_index")
+        self.grail.create_indexes()
+        self.assertTrue(self.grail._connection.queryOne("SELECT name FROM sqlite_master WHERE type = 'index' AND name = '_mission_quest_index'"))
+
+    def test_create_indexes_errors(self):
+        directory = tempfile.mkdtemp()
+        try:
+            grail = Grail("sqlite://%s/grail.db" % directory)
+            grail._connection.query("DROP TABLE _prerequisite")
+            # the errors other than an existing index aren't hidden
+            self.assertRaises(sqlobject.dberrors.Error, grail.create_indexes)
+        finally:
+            shutil.rmtree(directory)
+
     def test_add_a_mission(self):
         """
         You should be able to add a new mission.
@@ -89,6 +120,538 @@ class Test_Main(unittest.TestCase):
         mission.toggle()
         self.assertNotEqual(-1, self.grail.add_mission("This is a new mission", unique=True))
 
+    def test_add_missions(self):
+        realm = self.grail.add_realm("realm")
+        quest = self.grail.add_quest("quest", default_realm=realm.id, due=datetime.now())
+        first = self.grail.add_mission("first")
+        ids = self.grail.add_missions([("mission",),
+                                       {"new_description": "mission 2", "quest": quest.id},
+                                       ("mission 3", None, None, None, realm.id, first),
+                                       {"new_description": "mission 4", "due": datetime.now() + timedelta(1)}])
+        self.assertEqual(4, len(ids))
+        missions = [self.grail.get_mission(i) for i in ids]
+        self.assertEqual(["mission", "mission 2", "mission 3", "mission 4"], [i.description for i in missions])
+        self.assertEqual(self.grail.get_default_realm(), missions[0].realm)
+        self.assertEqual(realm, missions[1].realm)
+        self.assertEqual(quest, missions[1].quest)
+        self.assertTrue(comp_datetime(quest.due, missions[1].due))
+        self.assertEqual(realm, missions[2].realm)
+        self.assertEqual(first, missions[2].previous_mission)
+        self.assertEqual([first] + missions[0:2] + missions[3:], list(self.grail.list_missions()))
+
+    def test_add_missions_unique(self):
+        self.grail.add_mission("This is a new mission")
+        self.grail.add_mission("This is a completed mission").toggle()
+        ids = self.grail.add_missions([{"new_description": "This is a new mission", "unique": True},
+                                       {"new_description": "This is a completed mission", "unique": True},
+                                       {"new_description": "This is a completed mission", "unique": True},
+                                       {"new_description": "This is a completed mission"}])
+        self.assertEqual(-1, ids[0])
+        self.assertNotEqual(-1, ids[1])
+        self.assertEqual(-1, ids[2])
+        self.assertNotEqual(-1, ids[3])
+
+    def test_add_missions_quest_doesnt_exist(self):
+        self.assertRaises(QuestDoesntExist, self.grail.add_missions, [{"new_description": "mission", "quest": 42}])
+        self.assertEqual([], list(self.grail.list_missions()))
+
+    def test_add_missions_wait_for_doesnt_exist(self):
+        mission = self.grail.add_mission("mission")
+        self.assertRaises(MissionDoesntExist, self.grail.add_missions, [{"new_description": "first", "wait_for": mission.id},
+                                                                      {"new_description": "second", "wait_for": 999}])
+        self.assertEqual([mission.id], [i.id for i in self.grail.list_missions(True)])
+
+    def test_transaction(self):
+        mission = self.grail.add_mission("mission")
+        with self.grail.transaction():
+            mission.toggle()
+            mission.rename("new description")
+            self.assertEqual([], list(self.grail.list_missions()))
+            other_mission = self.grail.add_mission("other mission")
+        mission.expire()
+        self.assertTrue(mission.completed)
+        self.assertEqual("new description", mission.description)
+        self.assertEqual([other_mission], list(self.grail.list_missions()))
+
+    def test_transaction_rollback(self):
+        mission = self.grail.add_mission("mission")
+        try:
+            with self.grail.transaction():
+                mission.toggle()
+                mission.rename("new description")
+                self.grail.add_mission("other mission")
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertFalse(mission.completed)
+        self.assertEqual("mission", mission.description)
+        self.assertEqual([mission], list(self.grail.list_missions()))
+
+    def test_several_databases(self):
+        directory = tempfile.mkdtemp()
+        try:
+            grail1 = Grail("sqlite://%s/grail1.db" % directory)
+            grail2 = Grail("sqlite://%s/grail2.db" % directory)
+            grail1.add_mission("mission 1")
+            grail2.add_mission("mission 2")
+            with grail2.transaction():
+                grail2.add_realm("realm 2")
+            self.assertEqual(["mission 1"], [i.description for i in grail1.list_missions()])
+            self.assertEqual(["mission 2"], [i.description for i in grail2.list_missions()])
+            self.assertEqual(["default realm"], [i.description for i in grail1.list_realms()])
+            self.assertEqual(["default realm", "realm 2"], [i.description for i in grail2.list_realms()])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_threads(self):
+        directory = tempfile.mkdtemp()
+        try:
+            grail = Grail("sqlite://%s/grail.db" % directory)
+            grail.add_missions([("mission %d" % i,) for i in range(10)])
+            results = []
+            def read():
+                results.append(len(list(grail.list_missions())))
+            threads = [threading.Thread(target=read) for i in range(5)]
+            for i in threads:
+                i.start()
+            for i in threads:
+                i.join()
+            self.assertEqual([10] * 5, results)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_changes_since(self):
+        token, changes = self.grail.changes_since()
+        self.assertEqual(None, changes)
+        self.assertEqual((token, {"missions": {}, "quests": {}, "realms": {}}), self.grail.changes_since(token))
+        mission = self.grail.add_mission("mission")
+        quest = self.grail.add_quest("quest")
+        token, changes = self.grail.changes_since(token)
+        self.assertEqual({"missions": {mission.id: mission}, "quests": {quest.id: quest}, "realms": {}}, changes)
+        with self.grail.transaction():
+            mission.toggle()
+            mission.rename("new description")
+            other_mission = self.grail.add_mission("other mission")
+        realm = self.grail.add_realm("realm")
+        realm.change_position(0)
+        quest.remove()
+        token, changes = self.grail.changes_since(token)
+        self.assertEqual({"missions": {mission.id: mission, other_mission.id: other_mission},
+                          "quests": {quest.id: None},
+                          "realms": {realm.id: realm, self.grail.get_default_realm().id: self.grail.get_default_realm()}}, changes)
+        mission.add_tag("tag")
+        self.assertEqual({mission.id: mission}, self.grail.changes_since(token)[1]["missions"])
+
+    def test_archive_missions(self):
+        old = self.grail.add_mission("old")
+        old.add_tag("tag")
+        recent = self.grail.add_mission("recent")
+        waited = self.grail.add_mission("waited for")
+        waiting = self.grail.add_mission("waiting", wait_for=waited)
+        last = self.grail.add_mission("last")
+        for mission in (old, recent, waited):
+            mission.toggle()
+        for mission in (old, waited):
+            mission.completed_at = datetime.now() - timedelta(40)
+        last.toggle()
+        last.completed_at = datetime.now() - timedelta(40)
+        token = self.grail.changes_since()[0]
+        self.assertEqual(1, self.grail.archive_missions(30))
+        self.assertEqual(0, self.grail.archive_missions(30))
+        archived = self.grail.get_mission(old.id)
+        self.assertTrue(isinstance(archived, _ArchivedMission))
+        self.assertEqual(["tag"], archived.tags)
+        self.assertEqual({old.id: ["tag"]}, self.grail.get_tags([old.id]))
+        self.assertEqual(archived, self.grail.changes_since(token)[1]["missions"][old.id])
+        self.assertEqual([old.id, recent.id, waited.id, waiting.id, last.id], [i.id for i in self.grail.list_missions(all_missions=True)])
+        self.assertEqual([recent.id, last.id, waited.id, old.id], [i.id for i in self.grail.last_completed_missions()])
+        self.assertEqual(4, _Mission.select(connection=self.grail._connection).count())
+
+    def test_archived_mission_toggle(self):
+        mission = self.grail.add_mission("old")
+        mission.add_tag("tag")
+        mission.toggle()
+        mission.completed_at = datetime.now() - timedelta(40)
+        self.grail.add_mission("last")
+        self.assertEqual(1, self.grail.archive_missions(30))
+        self.grail.get_mission(mission.id).toggle()
+        mission = self.grail.get_mission(mission.id)
+        self.assertFalse(isinstance(mission, _ArchivedMission))
+        self.assertFalse(mission.completed)
+        self.assertEqual(["tag"], mission.tags)
+        self.assertTrue(mission in self.grail.list_missions())
+
+    def test_archived_mission_unmet_prerequisites(self):
+        prerequisite = self.grail.add_mission("prerequisite")
+        mission = self.grail.add_mission("old", wait_for=prerequisite)
+        mission.toggle()
+        mission.completed_at = datetime.now() - timedelta(40)
+        self.grail.add_mission("last")
+        self.assertEqual(1, self.grail.archive_missions(30))
+        prerequisite.toggle()
+        self.grail.get_mission(mission.id).toggle()
+        mission = self.grail.get_mission(mission.id)
+        self.assertFalse(mission.completed)
+        self.assertEqual(0, mission.unmet_prerequisites)
+        self.assertEqual([], mission.prerequisites)
+        self.assertTrue(mission in self.grail.list_missions())
+
+    def test_archived_mission_modifications(self):
+        mission = self.grail.add_mission("old")
+        mission.add_tag("tag")
+        mission.toggle()
+        mission.completed_at = datetime.now() - timedelta(40)
+        self.grail.add_mission("last")
+        self.grail.archive_missions(30)
+        archived = self.grail.get_mission(mission.id)
+        archived.add_tag("tag")
+        archived.add_tag("other")
+        archived.remove_tag("tag")
+        self.assertRaises(ValueError, archived.remove_tag, "tag")
+        self.assertEqual(["other"], archived.tags)
+        self.assertEqual({mission.id: ["other"]}, self.grail.get_tags([mission.id]))
+        self.assertTrue(isinstance(self.grail.get_mission(mission.id), _ArchivedMission))
+        tickler = datetime.now() + timedelta(3)
+        archived.tickle(tickler)
+        mission = self.grail.get_mission(mission.id)
+        self.assertFalse(isinstance(mission, _ArchivedMission))
+        self.assertTrue(mission.completed)
+        self.assertEqual(tickler, mission.tickler)
+        self.assertEqual(["other"], mission.tags)
+        mission.toggle()
+        self.assertFalse(mission.completed)
+
+    def test_archived_mission_remove(self):
+        realm = self.grail.add_realm("realm")
+        quest = self.grail.add_quest("quest")
+        mission = self.grail.add_mission("old", realm=realm.id, quest=quest.id)
+        mission.add_tag("tag")
+        mission.toggle()
+        mission.completed_at = datetime.now() - timedelta(40)
+        self.grail.add_mission("last")
+        self.grail.archive_missions(30)
+        self.assertRaises(RealmStillHasElems, realm.remove)
+        quest.remove()
+        self.assertEqual(None, self.grail.get_mission(mission.id).quest)
+        self.assertEqual(1, self.grail.remove_missions([mission.id]))
+        self.assertRaises(MissionDoesntExist, self.grail.get_mission, mission.id)
+        realm.remove()
+
+    def test_dump_restore(self):
+        realm = self.grail.add_realm(u"réalm")
+        quest = self.grail.add_quest("quest", default_realm=realm.id, due=datetime(2030, 1, 2, 3, 4, 5))
+        old = self.grail.add_mission("old")
+        old.add_tag("tag")
+        old.toggle()
+        old.completed_at = datetime.now() - timedelta(40)
+        first = self.grail.add_mission(u"first, \"quoted\"\nmission", quest=quest.id, due=datetime(2030, 1, 1))
+        first.add_tag("tag")
+        second = self.grail.add_mission("second", realm=realm.id, wait_for=first)
+        third = self.grail.add_mission("third")
+        third.toggle()
+        second.add_prerequisite(third)
+        first.remove()
+        self.assertEqual(1, self.grail.archive_missions(30))
+        realm.change_position(0)
+
+        snapshot = lambda grail: ([(i.id, i.description, i.completed, i.due, i.realm.id, i.quest and i.quest.id, i.tags, i.unmet_prerequisites)
+                                   for i in grail.list_missions(True)],
+                                  [(i.id, i.description, i.position, i.default_realm) for i in grail.list_realms(True)],
+                                  [(i.id, i.description, i.due) for i in grail.list_quests(True)],
+                                  [list(grail.dependency_chain(i)) for i in grail.list_missions(True)],
+                                  list(grail.list_tags()))
+        expected = snapshot(self.grail)
+        directory = tempfile.mkdtemp()
+        try:
+            for name in ("dump.jsonl", "dump.jsonl.gz", "dump.csv"):
+                path = "%s/%s" % (directory, name)
+                counts = dump(self.grail, path, chunk_size=2)
+                self.assertEqual(2, counts["_realm"])
+                self.assertEqual(1, counts["_archived_mission"])
+                grail = Grail("sqlite://%s/%s.db" % (directory, name))
+                grail.add_mission("removed by the restore")
+                self.assertEqual(counts, restore(grail, path, batch_size=2))
+                self.assertEqual(expected, snapshot(grail))
+                self.assertEqual([second.id], [i.id for i in grail.search_for_mission("second")])
+                self.assertNotEqual(second.id, grail.add_mission("new").id)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_dump_snapshot(self):
+        directory = tempfile.mkdtemp()
+        try:
+            grail = Grail("sqlite://%s/grail.db" % directory)
+            other = Grail("sqlite://%s/grail.db" % directory)
+            first = grail.add_mission("first")
+            first.add_tag("tag")
+            grail.add_mission("second")
+            output = StringIO()
+            writers = []
+            def write(line):
+                # a mission and its tag are added while the missions are dumped
+                if not writers and '"first"' in line:
+                    writers.append(threading.Thread(target=lambda: other.add_mission("new").add_tag("tag")))
+                    writers[0].start()
+                    writers[0].join(0.2)
+                StringIO.write(output, line)
+            output.write = write
+            counts = dump(grail, output, chunk_size=1)
+            writers[0].join()
+            self.assertEqual(2, counts["_mission"])
+            self.assertEqual(1, counts["_tag_mission"])
+            self.assertEqual(3, len(list(grail.list_missions())))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_restore_archived_ids(self):
+        first = self.grail.add_mission("first")
+        old = self.grail.add_mission("old")
+        old.toggle()
+        old.completed_at = datetime.now() - timedelta(40)
+        last = self.grail.add_mission("last")
+        self.assertEqual(1, self.grail.archive_missions(30))
+        last.remove()
+        directory = tempfile.mkdtemp()
+        try:
+            dump(self.grail, "%s/dump.jsonl" % directory)
+            grail = Grail("sqlite://%s/restored.db" % directory)
+            restore(grail, "%s/dump.jsonl" % directory)
+            # the ids of the archived missions aren't given again
+            new = grail.add_mission("new")
+            self.assertTrue(new.id > old.id)
+            self.assertEqual([first.id, new.id], [i.id for i in grail.list_missions()])
+            self.assertTrue(isinstance(grail.get_mission(old.id), _ArchivedMission))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_restore_not_a_dump(self):
+        directory = tempfile.mkdtemp()
+        try:
+            with open("%s/dump.csv" % directory, "w") as dump_file:
+                dump_file.write("id,description\n")
+            self.assertRaises(ValueError, restore, self.grail, "%s/dump.csv" % directory)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_failed_restore_keep_the_database(self):
+        mission = self.grail.add_mission("mission")
+        directory = tempfile.mkdtemp()
+        try:
+            with open("%s/dump.jsonl" % directory, "w") as dump_file:
+                dump_file.write('{"table": "_mission", "columns": ["id"]}\n[1]\n')
+            self.assertRaises(ValueError, restore, self.grail, "%s/dump.jsonl" % directory)
+            self.assertRaises(IOError, restore, self.grail, "%s/nonexistent.jsonl" % directory)
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual([mission.id], [i.id for i in self.grail.list_missions()])
+        self.assertEqual(["default realm"], [i.description for i in self.grail.list_realms()])
+
+    def test_import_tracks(self):
+        # Tracks write the todos before the contexts and the projects
+        export = StringIO("""<?xml version="1.0" encoding="UTF-8"?>
+<data>
+  <todos type="array">
+    <todo><id type="integer">10</id><context-id type="integer">1</context-id><project-id type="integer">5</project-id>
+      <description>first</description><state>completed</state><completed-at type="datetime">2010-01-02T03:04:05Z</completed-at>
+      <due type="datetime" nil="true"/><show-from nil="true"/></todo>
+    <todo><id type="integer">11</id><context-id type="integer">2</context-id><project-id type="integer" nil="true"/>
+      <description>second \xc3\xa9</description><state>active</state><due type="date">2030-01-01</due></todo>
+    <todo><id type="integer">12</id><context-id type="integer">1</context-id><project-id type="integer" nil="true"/>
+      <description>third</description><state>pending</state><show-from type="datetime">2030-02-01T10:00:00+01:00</show-from></todo>
+    <todo><id type="integer">13</id><context-id type="integer">1</context-id><project-id type="integer" nil="true"/>
+      <description>fourth</description><state>pending</state></todo>
+  </todos>
+  <contexts type="array">
+    <context><id type="integer">1</id><name>work</name><hide type="boolean">false</hide></context>
+    <context><id type="integer">2</id><name>home</name><hide type="boolean">true</hide></context>
+  </contexts>
+  <projects type="array">
+    <project><id type="integer">5</id><name>project</name><state>active</state><default-context-id type="integer">2</default-context-id></project>
+  </projects>
+  <tags type="array">
+    <tag><id type="integer">7</id><name>tag</name></tag>
+  </tags>
+  <taggings type="array">
+    <tagging><taggable-id type="integer">10</taggable-id><tag-id type="integer">7</tag-id><taggable-type>Todo</taggable-type></tagging>
+    <tagging><taggable-id type="integer">11</taggable-id><tag-id type="integer">7</tag-id><taggable-type>Todo</taggable-type></tagging>
+    <tagging><taggable-id type="integer">5</taggable-id><tag-id type="integer">7</tag-id><taggable-type>Project</taggable-type></tagging>
+  </taggings>
+  <dependencies type="array">
+    <dependency><successor-id type="integer">12</successor-id><predecessor-id type="integer">10</predecessor-id></dependency>
+    <dependency><successor-id type="integer">13</successor-id><predecessor-id type="integer">11</predecessor-id></dependency>
+  </dependencies>
+</data>""")
+        progress = []
+        counts = import_tracks(self.grail, export, batch_size=2, progress=progress.append)
+        self.assertEqual({"realms": 2, "quests": 1, "missions": 4, "tags": 2, "prerequisites": 2}, counts)
+        self.assertEqual(counts, progress[-1])
+        self.assertTrue(len(progress) > 3)
+
+        [work], [home], [project] = self.grail.get_realm_by_desc("work"), self.grail.get_realm_by_desc("home"), self.grail.get_quest_by_desc("project")
+        self.assertTrue(home.hide)
+        self.assertEqual(home, project.default_realm)
+        [first], [second], [third], [fourth] = [self.grail.get_mission_by_desc(i) for i in ("first", u"second \xe9", "third", "fourth")]
+        self.assertEqual((work, project), (first.realm, first.quest))
+        self.assertTrue(first.completed)
+        self.assertEqual(datetime(2010, 1, 2, 3, 4, 5), first.completed_at)
+        self.assertEqual((home, None, datetime(2030, 1, 1)), (second.realm, second.quest, second.due))
+        self.assertEqual(datetime(2030, 2, 1, 10), third.tickler)
+        self.assertEqual(["tag"], first.tags)
+        self.assertEqual(["tag"], second.tags)
+        self.assertEqual([first], third.prerequisites)
+        self.assertEqual((0, 1), (third.unmet_prerequisites, fourth.unmet_prerequisites))
+        self.assertEqual({fourth.id: [second.id]}, self.grail.blocked_by([fourth]))
+        self.assertEqual([second.id], [i.id for i in self.grail.missions(tag="tag", completed=False)])
+
+    def test_stats(self):
+        self.grail.stats(reset=True)
+        self.grail.add_mission("mission")
+        missions = self.grail.list_missions()
+        self.assertEqual(["add_mission"], self.grail.stats().keys())
+        self.assertEqual(1, len(list(missions)))
+        stats = self.grail.stats(reset=True)
+        # the Grail methods called by add_mission() are counted in its call
+        self.assertEqual(["add_mission", "list_missions"], sorted(stats.keys()))
+        self.assertEqual(1, stats["list_missions"]["calls"])
+        self.assertTrue(stats["list_missions"]["queries"] >= 1)
+        self.assertEqual(stats["add_mission"]["queries"], stats["add_mission"]["max_queries"])
+        self.assertTrue(stats["add_mission"]["seconds"] >= stats["add_mission"]["query_seconds"])
+        self.assertEqual({}, self.grail.stats())
+
+    def test_count_queries(self):
+        grail = Grail('sqlite:/:memory:', repeated_queries=3)
+        grail.add_missions([("mission %d" % i,) for i in range(5)])
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            with grail.count_queries() as counter:
+                missions = list(grail.list_missions())
+            self.assertEqual([], caught)
+            self.assertTrue(counter.rows >= 5)
+            with grail.count_queries() as counter:
+                for mission in missions:
+                    mission.tags
+            self.assertEqual(5, counter.queries)
+            self.assertEqual([RepeatedQueriesWarning], [i.category for i in caught])
+            self.assertTrue("ran 5 times the query" in str(caught[0].message))
+            self.assertEqual(__file__.replace(".pyc", ".py"), caught[0].filename)
+
+    def all_pages(self, method, limit, **arguments):
+        elements, cursor = self.grail.page(method, limit, **arguments)
+        pages = [elements]
+        while cursor is not None:
+            elements, cursor = self.grail.page(method, limit, cursor, **arguments)
+            self.assertTrue(len(elements) <= limit)
+            pages.append(elements)
+        return pages
+
+    def test_page_list_missions(self):
+        missions = [self.grail.add_mission("mission %d" % i) for i in range(7)]
+        missions[2].toggle()
+        missions[2].completed_at = datetime.now() - timedelta(40)
+        self.grail.archive_missions(30)
+        ids = [i.id for i in missions]
+        self.assertEqual([ids[:3], ids[3:6], ids[6:]], [[j.id for j in i] for i in self.all_pages("list_missions", 3, all_missions=True)])
+        self.assertEqual([missions[:2] + missions[3:4], missions[4:7]], self.all_pages("list_missions", 3))
+        cursor = self.grail.page("list_missions", 2)[1]
+        self.assertEqual(missions[3:5], list(self.grail.list_missions(limit=2, after=cursor)))
+
+    def test_page_other_lists(self):
+        quests = [self.grail.add_quest("quest %d" % i) for i in range(5)]
+        self.assertEqual([quests[:2], quests[2:4], quests[4:]], self.all_pages("list_quests", 2))
+        realms = [self.grail.get_default_realm()] + [self.grail.add_realm("realm %d" % i) for i in range(4)]
+        self.assertEqual([realms[:3], realms[3:]], self.all_pages("list_realms", 3, all_realms=True))
+        due = datetime.now() + timedelta(1)
+        missions = [self.grail.add_mission("mission %d" % i, due=due + timedelta(i % 2)) for i in range(5)]
+        for i in missions:
+            i.add_tag("tag %d" % i.id)
+        self.assertEqual(sorted(["tag %d" % i.id for i in missions]), sum(self.all_pages("list_tags", 2), []))
+        self.assertEqual([missions[0], missions[2], missions[4], missions[1], missions[3]], sum(self.all_pages("list_due_missions", 2), []))
+
+    def test_page_last_completed_missions(self):
+        missions = [self.grail.add_mission("mission %d" % i) for i in range(6)]
+        completed_at = datetime.now() - timedelta(40)
+        for i in missions:
+            i.toggle()
+            i.completed_at = completed_at
+        missions[0].completed_at = datetime.now()
+        self.grail.archive_missions(30)
+        pages = self.all_pages("last_completed_missions", 4)
+        self.assertEqual([[missions[0].id] + [i.id for i in reversed(missions[3:])], [i.id for i in reversed(missions[1:3])]], [[j.id for j in i] for i in pages])
+
+    def test_page_search_for_mission(self):
+        missions = [self.grail.add_mission("some mission %d" % i) for i in range(5)]
+        self.grail.add_mission("other")
+        self.assertEqual(missions, sum(self.all_pages("search_for_mission", 2, description="ssion"), []))
+        self.assertEqual(list(self.grail.search_for_mission("mission", full_text=True)),
+                         sum(self.all_pages("search_for_mission", 2, description="mission", full_text=True), []))
+        # without the full text index
+        self.grail._full_text = False
+        self.assertEqual(missions, sum(self.all_pages("search_for_mission", 2, description="mission", full_text=True), []))
+
+    def test_page_invalid_cursor(self):
+        self.grail.add_quest("quest")
+        self.grail.add_quest("other quest")
+        cursor = self.grail.page("list_quests", 1)[1]
+        self.assertRaises(ValueError, self.grail.page, "list_missions", 1, cursor)
+        self.assertRaises(ValueError, self.grail.page, "list_quests", 1, "not a cursor")
+        self.assertRaises(ValueError, self.grail.page, "main_view", 1)
+
+    def test_changes_since_reset(self):
+        token = self.grail.changes_since()[0]
+        self.grail.add_missions([("mission %d" % i,) for i in range(10)])
+        self.assertEqual(10, len(self.grail.changes_since(token)[1]["missions"]))
+        self.grail.reset_db("yes")
+        self.assertEqual(None, self.grail.changes_since(token)[1])
+
+    def test_compact_changes(self):
+        token = self.grail.changes_since()[0]
+        self.grail.add_mission("mission")
+        self.grail.add_mission("other mission")
+        self.grail.compact_changes(1)
+        self.assertEqual(None, self.grail.changes_since(token)[1])
+        self.assertEqual(1, len(self.grail.changes_since(token + 1)[1]["missions"]))
+
+    def test_view_cache(self):
+        mission = self.grail.add_mission("mission")
+        self.assertEqual([mission], list(self.grail.list_missions()))
+        self.assertEqual([mission], list(self.grail.list_missions()))
+        stats = self.grail.cache_stats()
+        self.assertEqual(1, stats["hits"])
+        self.assertEqual(1, stats["entries"])
+        self.assertEqual(1, stats["size"])
+        mission.toggle()
+        self.assertEqual([], list(self.grail.list_missions()))
+        self.assertEqual(1, self.grail.cache_stats()["invalidations"])
+        mission.toggle()
+        self.assertEqual([mission], _to_list(self.grail.main_view())[0][1])
+        self.assertEqual([mission], _to_list(self.grail.main_view())[0][1])
+        self.grail.get_default_realm().toggle_hide()
+        self.assertEqual([], list(self.grail.main_view()))
+
+    def test_view_cache_tickler(self):
+        mission = self.grail.add_mission("mission", tickler=datetime.now() + timedelta(seconds=0.3))
+        self.assertEqual([], list(self.grail.list_missions()))
+        self.assertEqual([], list(self.grail.list_missions()))
+        time.sleep(0.4)
+        self.assertEqual([mission], list(self.grail.list_missions()))
+
+    def test_view_cache_due(self):
+        mission = self.grail.add_mission("mission", due=datetime.now() + timedelta(days=1, seconds=0.3))
+        self.assertEqual("For in 3 days", self.grail.super_main_view()[0][0])
+        self.assertEqual("For in 3 days", self.grail.super_main_view()[0][0])
+        time.sleep(0.4)
+        self.assertEqual("For today", self.grail.super_main_view()[0][0])
+
+    def test_view_cache_limit(self):
+        grail = Grail('sqlite:/:memory:', view_cache_limit=2)
+        grail.add_missions([("mission %d" % i,) for i in range(3)])
+        list(grail.list_missions())
+        self.assertEqual(0, grail.cache_stats()["entries"])
+        grail = Grail('sqlite:/:memory:', view_cache_limit=0)
+        list(grail.list_missions())
+        list(grail.list_missions())
+        self.assertEqual(0, grail.cache_stats()["hits"])
+
     def test_get_mission_by_desc(self):
 
         t1 = self.grail.add_mission("This is a new mission")
@@ -121,6 +684,121 @@ class Test_Main(unittest.TestCase):
         self.assertEqual(was, len(list(self.grail.list_missions())))
         self.assertRaises(MissionDoesntExist, self.grail.get_mission, id)
 
+    def test_remove_missions(self):
+        mission1 = self.grail.add_mission("a")
+        mission1.add_tag("tag")
+        mission2 = self.grail.add_mission("b", wait_for=mission1)
+        mission2.add_tag("tag")
+        mission3 = self.grail.add_mission("c", wait_for=mission2)
+        mission4 = self.grail.add_mission("d", wait_for=mission2)
+        self.assertEqual(2, self.grail.remove_missions([mission1, mission2.id, 12345]))
+        self.assertRaises(MissionDoesntExist, self.grail.get_mission, mission1.id)
+        self.assertRaises(MissionDoesntExist, self.grail.get_mission, mission2.id)
+        self.assertEqual([], self.grail.get_missions_from_tag("tag"))
+        self.assertEqual(0, self.grail._connection.queryOne("SELECT COUNT(*) FROM _tag_mission")[0])
+        self.assertEqual(None, mission3.previous_mission)
+        self.assertEqual([], mission4.prerequisites)
+        self.assertEqual([mission3, mission4], list(self.grail.list_missions()))
+
+    def test_missions_selection(self):
+        realm = self.grail.add_realm("realm")
+        quest = self.grail.add_quest("quest")
+        mission1 = self.grail.add_mission("a", realm=realm.id)
+        mission2 = self.grail.add_mission("b", quest=quest.id, due=datetime.now() + timedelta(1))
+        mission3 = self.grail.add_mission("c", due=datetime.now() + timedelta(3))
+        mission3.add_tag("tag")
+        self.assertEqual([mission1, mission2, mission3], list(self.grail.missions()))
+        self.assertEqual([mission1.id, mission3.id], self.grail.missions([mission1, mission3.id]).ids())
+        self.assertEqual([mission1], list(self.grail.missions(realm=realm)))
+        self.assertEqual([mission2], list(self.grail.missions(quest=quest.id)))
+        self.assertEqual([mission3], list(self.grail.missions(tag="tag")))
+        self.assertEqual([mission2], list(self.grail.missions(due_before=datetime.now() + timedelta(2))))
+        self.assertEqual(0, self.grail.missions([]).count())
+        mission1.toggle()
+        self.assertEqual([mission2, mission3], list(self.grail.missions(completed=False)))
+
+    def test_missions_complete(self):
+        mission1 = self.grail.add_mission("a")
+        mission2 = self.grail.add_mission("b")
+        mission3 = self.grail.add_mission("c", wait_for=mission1)
+        mission3.add_prerequisite(mission2)
+        mission2.toggle()
+        self.assertEqual(1, self.grail.missions([mission1, mission2]).complete())
+        self.assertTrue(mission1.completed)
+        self.assertTrue(mission1.completed_at is not None)
+        self.assertEqual(0, mission3.unmet_prerequisites)
+        self.assertEqual([mission3], list(self.grail.list_missions()))
+
+    def test_missions_tickle(self):
+        mission1 = self.grail.add_mission("a")
+        mission2 = self.grail.add_mission("b")
+        self.assertEqual([mission1, mission2], list(self.grail.list_missions()))
+        self.assertEqual(2, self.grail.missions().tickle(datetime.now() + timedelta(1)))
+        self.assertTrue(mission1.tickler > datetime.now())
+        self.assertEqual([], list(self.grail.list_missions()))
+
+    def test_missions_queries(self):
+        self.grail.add_missions([("mission %d" % i,) for i in range(50)])
+        missions = list(self.grail.list_missions())
+        with self.grail.count_queries() as counter:
+            self.grail.missions(completed=False).tickle(datetime.now() - timedelta(1))
+            self.grail.missions(completed=False).complete()
+        # the cached missions aren't reloaded one by one
+        self.assertTrue(counter.queries < 10)
+        self.assertTrue(missions[10].completed)
+
+    def test_quest_due_queries(self):
+        quest = self.grail.add_quest("quest")
+        self.grail.add_missions([("mission %d" % i, None, None, quest) for i in range(50)])
+        missions = list(self.grail.list_missions())
+        due = datetime.now() + timedelta(3)
+        with self.grail.count_queries() as counter:
+            quest.due_for(due)
+        # the cached missions aren't reloaded one by one
+        self.assertTrue(counter.queries < 10)
+        self.assertEqual(due.date(), missions[20].due.date())
+
+    def test_remove_quest_queries(self):
+        quest = self.grail.add_quest("quest")
+        self.grail.add_missions([("mission %d" % i, None, None, quest) for i in range(50)])
+        missions = list(self.grail.list_missions())
+        with self.grail.count_queries() as counter:
+            quest.remove()
+            self.grail.remove_missions(missions[:10])
+        # the cached missions aren't reloaded one by one
+        self.assertTrue(counter.queries < 25)
+        self.assertEqual(None, missions[20].quest)
+
+    def test_missions_postpone(self):
+        due = datetime.now() + timedelta(1)
+        quest = self.grail.add_quest("quest", due=due + timedelta(1))
+        mission1 = self.grail.add_mission("a", due=due)
+        mission2 = self.grail.add_mission("b", due=due, quest=quest.id)
+        self.grail.add_mission("c")
+        self.assertEqual(2, self.grail.missions().postpone(timedelta(2)))
+        self.assertTrue(comp_datetime(mission1.due, due + timedelta(2)))
+        self.assertTrue(comp_datetime(mission2.due, due + timedelta(1)))
+        self.assertTrue(comp_datetime(mission2._due, due + timedelta(2)))
+
+    def test_missions_move_to_realm(self):
+        realm = self.grail.add_realm("realm")
+        mission1 = self.grail.add_mission("a")
+        mission2 = self.grail.add_mission("b")
+        self.assertEqual(1, self.grail.missions([mission1]).move_to_realm(realm))
+        self.assertEqual(realm, mission1.realm)
+        self.assertNotEqual(realm, mission2.realm)
+        self.assertRaises(RealmDoesntExist, self.grail.missions().move_to_realm, 1337)
+
+    def test_missions_tag(self):
+        mission1 = self.grail.add_mission("a")
+        mission2 = self.grail.add_mission("b")
+        mission1.add_tag("review")
+        self.assertEqual(1, self.grail.missions().tag("review"))
+        self.assertEqual(["review"], mission2.tags)
+        self.assertEqual([mission1, mission2], self.grail.get_missions_from_tag("review"))
+        self.assertEqual(0, self.grail.missions().tag("review"))
+        self.assertEqual(2, self.grail.missions(tag="review").remove())
+
     def test_seach_for_mission(self):
 
         mission_to_add = ("new mission", "another mission", "yet a mission", "missiondo", "missionmission")
@@ -128,7 +806,7 @@ class Test_Main(unittest.TestCase):
 
         true = [self.grail.add_mission(i) for i in mission_to_add]
         false = [self.grail.add_mission(i) for i in mission_to_add_that_doesnt_match]
-        result = self.grail.search_for_mission("mission")
+        result = list(self.grail.search_for_mission("mission"))
 
         self.assertEqual(len(mission_to_add), len(result))
 
@@ -138,6 +816,39 @@ class Test_Main(unittest.TestCase):
             self.assertFalse(i.description in mission_to_add_that_doesnt_match)
             self.assertFalse(i in false)
 
+    def test_search_for_mission_follow_changes(self):
+        mission = self.grail.add_mission("some mission")
+        self.assertEqual([mission], list(self.grail.search_for_mission("some")))
+        mission.rename("another thing")
+        self.assertEqual([], list(self.grail.search_for_mission("some")))
+        self.assertEqual([mission], list(self.grail.search_for_mission("thing another", full_text=True)))
+        mission.remove()
+        self.assertEqual([], list(self.grail.search_for_mission("thing", full_text=True)))
+
+    def test_search_for_mission_full_text(self):
+        missions = [self.grail.add_mission(i) for i in (u"Buy milk", u"milkshake", u"semi-skimmed milk", u"buttermilk", u"lait_milk", u"écrire")]
+        self.assertEqual(missions[:5], list(self.grail.search_for_mission("milk")))
+        self.assertEqual([], list(self.grail.search_for_mission("milk buy")))
+        self.assertEqual([missions[3]], list(self.grail.search_for_mission("ermil")))
+        self.assertEqual([], list(self.grail.search_for_mission("ermil", full_text=True)))
+        searches = ["MILK", "milk buy", "skim", u"écr", "ecr"]
+        results = [sorted([i.id for i in self.grail.search_for_mission(i, full_text=True)]) for i in searches]
+        self.assertEqual([[missions[i].id for i in j] for j in ([0, 1, 2, 4], [0], [2], [5], [])], results)
+        # the same missions are found without the full text index
+        self.grail._full_text = False
+        self.assertEqual(results, [sorted([i.id for i in self.grail.search_for_mission(i, full_text=True)]) for i in searches])
+        self.assertEqual([missions[0].id, missions[1].id], [i.id for i in self.grail.search_for_mission("mil", limit=2, full_text=True)])
+
+    def test_search_for_mission_filters(self):
+        realm = self.grail.add_realm("realm")
+        mission = self.grail.add_mission("some mission")
+        mission2 = self.grail.add_mission("some other mission", realm=realm.id)
+        mission3 = self.grail.add_mission("again some mission")
+        mission3.add_tag("plop")
+        self.assertEqual(2, len(list(self.grail.search_for_mission("mission", limit=2))))
+        self.assertEqual([mission2], list(self.grail.search_for_mission("mission", realm=realm)))
+        self.assertEqual([mission3], list(self.grail.search_for_mission("mission", tag="plop")))
+
     def test_get_mission(self):
         mission = self.grail.add_mission("mission")
         self.assertTrue(mission is self.grail.get_mission(mission.id))
@@ -398,6 +1109,19 @@ class Test_Main(unittest.TestCase):
         self.assertRaises(QuestDoesntExist, self.grail.get_quest, old_id)
         self.assertEqual(0, len(list(self.grail.list_quests())))
 
+    def test_remove_quests(self):
+        quest1 = self.grail.add_quest("a", due=datetime.now() + timedelta(1))
+        quest2 = self.grail.add_quest("b")
+        quest3 = self.grail.add_quest("c")
+        mission1 = self.grail.add_mission("mission", quest=quest1.id)
+        mission2 = self.grail.add_mission("other mission", quest=quest2.id)
+        self.assertEqual(2, self.grail.remove_quests([quest1, quest2.id]))
+        self.assertRaises(QuestDoesntExist, self.grail.get_quest, quest1.id)
+        self.assertEqual([quest3], list(self.grail.list_quests()))
+        self.assertEqual(None, mission1.quest)
+        self.assertEqual(None, mission1.due)
+        self.assertEqual(None, self.grail.get_mission(mission2.id).quest)
+
     def test_change_mission_quest(self):
         quest = self.grail.add_quest("manger une pomme")
         mission = self.grail.add_mission("le nouveau leak d'ACTA est dégeulasse")
@@ -540,6 +1264,15 @@ class Test_Main(unittest.TestCase):
         self.assertEqual(0, realm1.position)
         self.assertEqual(1, realm2.position)
 
+    def test_change_realm_position_queries(self):
+        realms = [self.grail.add_realm("realm %d" % i) for i in range(50)]
+        with self.grail.count_queries() as counter:
+            realms[10].change_position(12)
+        # the cached realms aren't reloaded one by one
+        self.assertTrue(counter.queries < 10)
+        self.assertEqual([12, 11, 13], [realms[i].position for i in (10, 11, 12)])
+        self.assertTrue(realms[11] is self.grail.get_realm(realms[11].id))
+
     def test_change_realm_position_2_realms(self):
         realm1 = self.grail.get_default_realm()
         realm2 = self.grail.add_realm("realm2")
@@ -609,6 +1342,19 @@ class Test_Main(unittest.TestCase):
         self.assertEqual(1, realm2.position)
         self.assertEqual(2, realm1.position)
 
+    def test_change_realm_position_negative(self):
+        realm1 = self.grail.get_default_realm()
+        realm2 = self.grail.add_realm("realm2")
+        realm3 = self.grail.add_realm("realm3")
+        realm4 = self.grail.add_realm("realm4")
+        realm4.change_position(-1)
+        self.assertEqual(0, realm4.position)
+        self.assertEqual(1, realm1.position)
+        self.assertEqual(2, realm2.position)
+        self.assertEqual(3, realm3.position)
+        realm4.change_position(-1)
+        self.assertEqual([0, 1, 2, 3], sorted([i.position for i in self.grail.list_realms(True)]))
+
     def test_change_realm_position_6_realms(self):
         realm1 = self.grail.get_default_realm()
         realm1.rename("realm1")
@@ -766,6 +1512,16 @@ class Test_Main(unittest.TestCase):
         self.assertEqual([[self.grail.get_default_realm(), [mission]],
                           [realm, [other_mission]]], _to_list(self.grail.main_view()))
 
+    def test_main_view_realm_position(self):
+        realm = self.grail.add_realm("realm")
+        hidden = self.grail.add_realm("hidden", hide=True)
+        mission = self.grail.add_mission("kropotkikine")
+        other_mission = self.grail.add_mission("James Joyce a l'air terrible", realm=realm)
+        self.grail.add_mission("caché", realm=hidden)
+        realm.change_position(0)
+        self.assertEqual([[realm, [other_mission]],
+                          [self.grail.get_default_realm(), [mission]]], _to_list(self.grail.main_view()))
+
     def test_last_completed_missions_empty(self):
         last_completed_missions = self.grail.last_completed_missions()
         self.assertEqual([], list(last_completed_missions))
@@ -829,6 +1585,40 @@ class Test_Main(unittest.TestCase):
         mission = self.grail.add_mission("la gamine qui est dans le siège devant moi arrête pas de faire plein de conneries", quest=quest.id, due=(due + timedelta(1)))
         self.assertTrue(comp_datetime(mission.due, due))
 
+    def test_quest_due_for_update_missions_due(self):
+        due = datetime.now()
+        quest = self.grail.add_quest("quest")
+        mission = self.grail.add_mission("mission", quest=quest.id)
+        mission2 = self.grail.add_mission("mission 2", quest=quest.id, due=due - timedelta(1))
+        quest.due_for(due)
+        self.assertTrue(comp_datetime(mission.due, due))
+        self.assertTrue(comp_datetime(mission2.due, due - timedelta(1)))
+        quest.due_for(None)
+        self.assertEqual(None, mission.due)
+        self.assertTrue(comp_datetime(mission2.due, due - timedelta(1)))
+
+    def test_change_quest_update_mission_due(self):
+        due = datetime.now()
+        quest = self.grail.add_quest("quest", due=due)
+        mission = self.grail.add_mission("mission")
+        mission.change_quest(quest.id)
+        self.assertTrue(comp_datetime(mission.due, due))
+        mission.change_quest(None)
+        self.assertEqual(None, mission.due)
+        mission.due_for(due + timedelta(1))
+        mission.change_quest(quest)
+        self.assertTrue(comp_datetime(mission.due, due))
+        quest.remove()
+        self.assertTrue(comp_datetime(mission.due, due + timedelta(1)))
+
+    def test_list_due_missions(self):
+        mission = self.grail.add_mission("mission", due=datetime.now() + timedelta(3))
+        mission2 = self.grail.add_mission("mission 2", due=datetime.now() - timedelta(1))
+        self.grail.add_mission("mission 3")
+        self.assertEqual([mission2, mission], list(self.grail.list_due_missions()))
+        self.assertEqual([mission2], list(self.grail.list_due_missions(before=datetime.now())))
+        self.assertEqual(1, self.grail.count_late_missions())
+
     def test_get_missions_on_realm_empty(self):
         realm = self.grail.add_realm("regardcitoyens ça déchire")
         self.assertEqual([], list(realm.get_missions()))
@@ -856,6 +1646,106 @@ class Test_Main(unittest.TestCase):
         mission = self.grail.add_mission("ima new mission")
         self.assertRaises(WaitForError, mission.wait_for, mission)
 
+    def test_cant_wait_for_a_mission_that_wait_for_you_indirectly(self):
+        mission1 = self.grail.add_mission("a")
+        mission2 = self.grail.add_mission("b", wait_for=mission1)
+        mission3 = self.grail.add_mission("c", wait_for=mission2)
+        self.assertRaises(WaitForError, mission1.wait_for, mission3)
+        self.assertEqual(mission1.previous_mission, None)
+        self.assertEqual(self.grail.dependency_cycles(), [])
+
+    def test_dependency_cycles(self):
+        mission1 = self.grail.add_mission("a")
+        mission2 = self.grail.add_mission("b", wait_for=mission1)
+        mission3 = self.grail.add_mission("c", wait_for=mission2)
+        # created by an older version of HolyGrail
+        _Prerequisite(mission=mission1, prerequisite=mission3, connection=self.grail._connection)
+        self.assertEqual(sorted(self.grail.dependency_cycles()[0]), [mission1.id, mission2.id, mission3.id])
+
+    def test_blocked_by_and_blocking(self):
+        mission1 = self.grail.add_mission("a")
+        mission2 = self.grail.add_mission("b", wait_for=mission1)
+        mission3 = self.grail.add_mission("c", wait_for=mission1)
+        self.assertEqual(self.grail.blocked_by([mission1, mission2.id, mission3]), {mission1.id: [], mission2.id: [mission1.id], mission3.id: [mission1.id]})
+        self.assertEqual(self.grail.blocking([mission1, mission2]), {mission1.id: [mission2.id, mission3.id], mission2.id: []})
+        mission1.toggle()
+        self.assertEqual(self.grail.blocked_by([mission2]), {mission2.id: []})
+
+    def test_dependency_chain(self):
+        mission1 = self.grail.add_mission("a")
+        mission2 = self.grail.add_mission("b", wait_for=mission1)
+        mission3 = self.grail.add_mission("c", wait_for=mission2)
+        self.assertEqual(self.grail.dependency_chain(mission3), [mission2.id, mission1.id])
+        self.assertEqual(self.grail.dependency_chain(mission1.id), [])
+
+    def test_ready_missions(self):
+        mission1 = self.grail.add_mission("a")
+        mission2 = self.grail.add_mission("b", wait_for=mission1)
+        mission3 = self.grail.add_mission("c", wait_for=mission2)
+        self.assertEqual(self.grail.ready_missions(), set([mission1.id]))
+        mission1.toggle()
+        self.assertEqual(self.grail.ready_missions(), set([mission2.id]))
+
+    def test_several_prerequisites(self):
+        mission1 = self.grail.add_mission("a")
+        mission2 = self.grail.add_mission("b")
+        mission3 = self.grail.add_mission("c", wait_for=mission1)
+        mission3.add_prerequisite(mission2.id)
+        mission3.add_prerequisite(mission2)
+        self.assertEqual([mission1, mission2], mission3.prerequisites)
+        self.assertEqual(2, mission3.unmet_prerequisites)
+        mission1.toggle()
+        self.assertEqual(1, mission3.unmet_prerequisites)
+        self.assertFalse(mission3 in self.grail.list_missions())
+        mission2.toggle()
+        self.assertEqual(0, mission3.unmet_prerequisites)
+        self.assertTrue(mission3 in self.grail.list_missions())
+        mission1.toggle()
+        self.assertFalse(mission3 in self.grail.list_missions())
+        mission3.remove_prerequisite(mission1)
+        self.assertEqual(None, mission3.previous_mission)
+        self.assertEqual([mission2], mission3.prerequisites)
+        self.assertTrue(mission3 in self.grail.list_missions())
+        self.assertRaises(ValueError, mission3.remove_prerequisite, mission1)
+        self.assertRaises(WaitForError, mission2.add_prerequisite, mission3)
+
+    def test_remove_prerequisite_mission(self):
+        mission1 = self.grail.add_mission("a")
+        mission2 = self.grail.add_mission("b")
+        mission3 = self.grail.add_mission("c", wait_for=mission1)
+        mission3.add_prerequisite(mission2)
+        mission1.remove()
+        self.assertEqual(None, mission3.previous_mission)
+        self.assertEqual([mission2], mission3.prerequisites)
+        self.assertEqual(1, mission3.unmet_prerequisites)
+        mission2.toggle()
+        mission2.remove()
+        self.assertEqual([], mission3.prerequisites)
+        self.assertEqual(0, mission3.unmet_prerequisites)
+
+    def test_wait_for_replace_prerequisites(self):
+        mission1 = self.grail.add_mission("a")
+        mission2 = self.grail.add_mission("b")
+        mission3 = self.grail.add_mission("c", wait_for=mission1)
+        mission3.add_prerequisite(mission2)
+        mission3.wait_for(mission2)
+        self.assertEqual(mission2, mission3.previous_mission)
+        self.assertEqual([mission2], mission3.prerequisites)
+        self.assertEqual(1, mission3.unmet_prerequisites)
+        mission3.wait_for(None)
+        self.assertEqual([], mission3.prerequisites)
+        self.assertEqual(0, mission3.unmet_prerequisites)
+
+    def test_add_missions_wait_for(self):
+        mission1 = self.grail.add_mission("a")
+        mission2 = self.grail.add_mission("b")
+        mission2.toggle()
+        ids = self.grail.add_missions([("c", None, None, None, None, mission1), ("d", None, None, None, None, mission2.id)])
+        self.assertEqual([mission1], self.grail.get_mission(ids[0]).prerequisites)
+        self.assertEqual(1, self.grail.get_mission(ids[0]).unmet_prerequisites)
+        self.assertEqual(0, self.grail.get_mission(ids[1]).unmet_prerequisites)
+        self.assertEqual(set([mission1.id, ids[1]]), self.grail.ready_missions())
+
     def test_super_main_view_empty(self):
         self.assertEqual(self.grail.super_main_view(), [])
 
@@ -952,6 +1842,13 @@ class Test_Main(unittest.TestCase):
         mission = self.grail.add_mission("prout", due=datetime.now() - timedelta(days=100))
         self.assertEqual(self.grail.super_main_view(), [["For today", [mission]]])
 
+    def test_super_main_view_quest_due(self):
+        quest = self.grail.add_quest("quest", due=datetime.now() + timedelta(days=3))
+        mission = self.grail.add_mission("prout", quest=quest.id)
+        mission2 = self.grail.add_mission("prout", quest=quest.id, due=datetime.now())
+        mission3 = self.grail.add_mission("prout", quest=quest.id, due=datetime.now() + timedelta(days=5))
+        self.assertEqual(self.grail.super_main_view(), [["For today", [mission2]], ["For in 3 days", [mission, mission3]]])
+
     def test_get_realm_missions(self):
         default = self.grail.get_default_realm()
         # empty
@@ -1021,6 +1918,18 @@ class Test_Main(unittest.TestCase):
         mission = self.grail.add_mission("new mission", tickler)
         self.assertTrue(mission in default.get_missions(all_missions=True))
 
+    def test_get_realm_missions_visibility(self):
+        realm = self.grail.add_realm("pouet", hide=True)
+        quest = self.grail.add_quest("plop")
+        mission = self.grail.add_mission("visible", realm=realm.id)
+        waiting = self.grail.add_mission("waiting", realm=realm.id, wait_for=mission)
+        in_quest = self.grail.add_mission("in a quest", realm=realm.id, quest=quest.id)
+        self.assertEqual([mission, in_quest], list(realm.get_missions()))
+        self.assertEqual([], list(self.grail.list_missions()))
+        quest.toggle()
+        mission.toggle()
+        self.assertEqual([waiting], list(realm.get_missions()))
+
     def test_get_quest_missions(self):
         quest = self.grail.add_quest("pipapou")
         # empty
@@ -1166,6 +2075,26 @@ class TestTags(unittest.TestCase):
         self.assertTrue(mission2 in missions)
         self.assertEqual(2, len(missions))
 
+    def test_tags_shared_between_missions(self):
+        mission1 = self.grail.add_mission("tsointsoin")
+        mission2 = self.grail.add_mission("tsointsoin")
+        mission1.add_tag("plop")
+        mission2.add_tag("plop")
+        mission1.remove_tag("plop")
+        self.assertEqual([], mission1.tags)
+        self.assertEqual(["plop"], mission2.tags)
+        self.assertEqual(["plop"], list(self.grail.list_tags()))
+
+    def test_get_tags(self):
+        mission1 = self.grail.add_mission("tsointsoin")
+        mission2 = self.grail.add_mission("tsointsoin")
+        mission3 = self.grail.add_mission("tsointsoin")
+        mission1.add_tag("plop")
+        mission1.add_tag("plup")
+        mission2.add_tag("plop")
+        self.assertEqual({mission1.id: ["plop", "plup"], mission2.id: ["plop"], mission3.id: []},
+                         self.grail.get_tags([mission1, mission2, mission3.id]))
+
     def test_mission_with_quest_without_datetime(self):
         quest = self.grail.add_quest("quest")
         mission = self.grail.add_mission("prout", quest=quest.id)
@@ -1177,6 +2106,330 @@ class TestTags(unittest.TestCase):
     # TODO: add other search methods
     # TODO: spliter mes tests unitaires en plusieurs classes
 
+class Test_ReadModel(unittest.TestCase):
+
+    def setUp(self):
+        self.grail = Grail('sqlite:/:memory:')
+        self.grail.reset_db("yes")
+        self.model = ReadModel(self.grail)
+
+    def tearDown(self):
+        self.model.close()
+
+    def assertSameViews(self):
+        ids = lambda sequence: [i.id for i in sequence]
+        view = lambda main_view: [[getattr(row, "id", row), ids(missions)] for row, missions in main_view]
+        self.assertEqual(ids(self.grail.list_missions()), ids(self.model.list_missions()))
+        self.assertEqual(ids(self.grail.list_missions(True)), ids(self.model.list_missions(True)))
+        self.assertEqual(ids(self.grail.list_quests()), ids(self.model.list_quests()))
+        self.assertEqual(ids(self.grail.list_realms()), ids(self.model.list_realms()))
+        self.assertEqual(ids(self.grail.list_realms(True)), ids(self.model.list_realms(True)))
+        self.assertEqual(view(self.grail.main_view()), view(self.model.main_view()))
+        self.assertEqual(view(self.grail.super_main_view()), view(self.model.super_main_view()))
+        self.assertEqual(ids(self.grail.list_due_missions()), ids(self.model.list_due_missions()))
+        self.assertEqual(ids(self.grail.last_completed_missions()), ids(self.model.last_completed_missions()))
+        self.assertEqual(self.grail.count_late_missions(), self.model.count_late_missions())
+        self.assertEqual(list(self.grail.list_tags()), list(self.model.list_tags()))
+        missions = list(self.grail.list_missions(True))
+        self.assertEqual(self.grail.get_tags(missions), self.model.get_tags(missions))
+        for mission in missions:
+            self.assertEqual(mission.description, self.model.get_mission(mission.id).description)
+            self.assertEqual(mission.due, self.model.get_mission(mission.id).due)
+
+    def test_load(self):
+        realm = self.grail.add_realm("realm")
+        quest = self.grail.add_quest("quest", due=datetime.now() + timedelta(2))
+        mission = self.grail.add_mission("mission", quest=quest.id, realm=realm.id)
+        mission.add_tag("tag")
+        self.grail.add_mission("other mission", due=datetime.now() - timedelta(1)).toggle()
+        self.model.close()
+        self.model = ReadModel(self.grail)
+        self.assertEqual(("tag",), self.model.get_mission(mission.id).tags)
+        self.assertEqual("quest", self.model.get_mission(mission.id).quest.description)
+        self.assertEqual("realm", self.model.get_mission(mission.id).realm.description)
+        self.assertSameViews()
+
+    def test_views_selected_when_returned(self):
+        first = self.grail.add_mission("first", due=datetime.now() + timedelta(1))
+        second = self.grail.add_mission("second")
+        missions = self.model.list_missions()
+        main_view = self.model.main_view()
+        due_missions = self.model.list_due_missions()
+        # applied while the views are read
+        first.toggle()
+        self.grail.add_mission("third")
+        self.assertEqual([first.id, second.id], [i.id for i in missions])
+        self.assertEqual([[first.id, second.id]], [[i.id for i in row[1]] for row in main_view])
+        self.assertEqual([first.id], [i.id for i in due_missions])
+        self.assertTrue(self.model.get_mission(first.id).completed)
+
+    def test_follow_modifications(self):
+        realm = self.grail.add_realm("realm")
+        quest = self.grail.add_quest("quest")
+        first = self.grail.add_mission("first", realm=realm.id)
+        second = self.grail.add_mission("second", quest=quest.id, wait_for=first)
+        self.assertSameViews()
+        second.add_tag("tag")
+        second.add_tag("other tag")
+        second.remove_tag("tag")
+        self.assertEqual(("other tag",), self.model.get_mission(second.id).tags)
+        quest.due_for(datetime.now() + timedelta(2))
+        self.assertEqual(second.due, self.model.get_mission(second.id).due)
+        self.assertSameViews()
+        first.toggle()
+        realm.change_position(0)
+        self.assertSameViews()
+        third = self.grail.add_mission("third")
+        second.add_prerequisite(third)
+        self.assertSameViews()
+        third.toggle()
+        self.assertSameViews()
+        quest.toggle_hide()
+        self.grail.add_missions([("bulk %d" % i,) for i in range(5)])
+        self.assertSameViews()
+        first.remove()
+        self.assertRaises(MissionDoesntExist, self.model.get_mission, first.id)
+        self.assertSameViews()
+        self.grail.missions().tag("bulk tag")
+        self.grail.missions(completed=False).postpone(timedelta(1))
+        self.grail.missions([second]).complete()
+        self.assertSameViews()
+        self.grail.remove_quests([quest])
+        self.grail.remove_missions([second, third])
+        self.assertSameViews()
+
+    def test_transaction(self):
+        mission = self.grail.add_mission("mission")
+        with self.grail.transaction():
+            mission.rename("new description")
+            self.grail.add_mission("other mission")
+            self.assertEqual(["mission"], [i.description for i in self.model.list_missions()])
+        self.assertSameViews()
+        try:
+            with self.grail.transaction():
+                mission.toggle()
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertFalse(self.model.get_mission(mission.id).completed)
+        self.assertSameViews()
+
+    def test_archive_missions(self):
+        mission = self.grail.add_mission("old")
+        mission.add_tag("tag")
+        mission.toggle()
+        mission.completed_at = datetime.now() - timedelta(40)
+        self.grail.add_mission("last").add_tag("tag")
+        self.grail.archive_missions(30)
+        self.assertEqual(("tag",), self.model.get_mission(mission.id).tags)
+        self.assertEqual([self.model.get_mission(mission.id + 1)], self.model.get_missions_from_tag("tag"))
+        self.assertSameViews()
+        self.model.close()
+        self.model = ReadModel(self.grail)
+        self.assertEqual(("tag",), self.model.get_mission(mission.id).tags)
+        self.assertSameViews()
+        self.grail.get_mission(mission.id).toggle()
+        self.assertEqual(("tag",), self.model.get_mission(mission.id).tags)
+        self.assertEqual(2, len(self.model.get_missions_from_tag("tag")))
+        self.assertSameViews()
+
+    def test_records(self):
+        first = self.grail.add_mission(u"prémière")
+        completed_at = datetime(2030, 1, 2, 3, 4, 5, 678901)
+        second = self.grail.add_mission("second", wait_for=first, due=completed_at)
+        second.completed_at = completed_at
+        record = self.model.get_mission(second.id)
+        self.assertEqual(record, self.model.get_mission(second.id))
+        self.assertNotEqual(record, self.model.get_mission(first.id))
+        self.assertEqual(u"prémière", self.model.get_mission(first.id).description)
+        self.assertEqual(self.model.get_mission(first.id), record.previous_mission)
+        self.assertEqual(completed_at, record.completed_at)
+        self.assertEqual(date.today(), record.created_at)
+        self.assertEqual(None, record.tickler)
+        self.assertEqual(1, record.unmet_prerequisites)
+        self.assertFalse(record.completed)
+        self.assertFalse(record.archived)
+        # the records read the current values
+        first.rename("first" * 20000)
+        for i in range(10):
+            first.rename("first %d" % i)
+        first.toggle()
+        second.toggle()
+        self.assertEqual("first 9", record.previous_mission.description)
+        self.assertTrue(record.completed)
+        self.assertEqual(0, record.unmet_prerequisites)
+        self.assertSameViews()
+
+    def test_reset_db(self):
+        self.grail.add_mission("mission")
+        self.grail.reset_db("yes")
+        self.assertEqual([], list(self.model.list_missions()))
+        self.assertSameViews()
+
+
+class Test_Benchmark(unittest.TestCase):
+
+    def test_generate_dataset(self):
+        grail = Grail('sqlite:/:memory:')
+        grail.reset_db("yes")
+        counts = generate_dataset(grail, realms=2, quests=3, missions=50, tags=4, chains=5, chain_length=3, completed=0.5)
+        self.assertEqual({"realms": 3, "quests": 3, "missions": 50, "completed": 25}, dict([(i, counts[i]) for i in ("realms", "quests", "missions", "completed")]))
+        self.assertEqual(50, len(list(grail.list_missions(True))))
+        self.assertEqual(4, len(list(grail.list_tags())))
+        # the first mission of each chain doesn't wait
+        self.assertEqual(10, len([i for i in grail.list_missions(True) if i.prerequisites]))
+
+    def test_run_and_compare(self):
+        old = run_benchmark({"missions": 20, "quests": 2, "realms": 2, "tags": 2, "chains": 2}, backends=["sqlite-memory"], repeat=2)
+        self.assertEqual(["sqlite-memory"], old["backends"].keys())
+        scenarios = old["backends"]["sqlite-memory"]["scenarios"]
+        self.assertTrue("main_view" in scenarios and "change_position" in scenarios)
+        self.assertEqual(2, scenarios["main_view"]["runs"])
+        new = {"backends": {"sqlite-memory": {"scenarios": {"main_view": {"median": scenarios["main_view"]["median"] * 2 + 1},
+                                                            "list_tags": scenarios["list_tags"]}}}}
+        self.assertEqual([("sqlite-memory", "list_tags", False), ("sqlite-memory", "main_view", True)],
+                         [(i[0], i[1], i[-1]) for i in compare(old, new)])
+
+
+class Test_Async(unittest.TestCase):
+
+    def setUp(self):
+        # an in memory database can't be used by other threads
+        self.directory = tempfile.mkdtemp()
+        self.grail = AsyncGrail("sqlite://%s/grail.db" % self.directory, workers=2, stream_size=2)
+
+    def tearDown(self):
+        self.grail.close()
+        shutil.rmtree(self.directory)
+
+    def test_call(self):
+        future = self.grail.add_mission("mission")
+        self.assertEqual("mission", future.result().description)
+        self.assertTrue(future.done())
+        self.assertEqual(["mission"], [i.description for i in self.grail.list_missions()])
+
+    def test_call_exception(self):
+        self.assertRaises(MissionDoesntExist, self.grail.get_mission(42).result)
+
+    def test_main_view(self):
+        self.grail.add_mission("mission").wait()
+        self.assertEqual([["default realm", ["mission"]]],
+                         [[realm.description, [i.description for i in missions]] for realm, missions in self.grail.main_view()])
+
+    def test_done_callback(self):
+        results = []
+        done = threading.Event()
+        def callback(future):
+            results.append(future.result().description)
+            done.set()
+        self.grail.add_realm("realm").add_done_callback(callback)
+        done.wait(5)
+        self.assertEqual(["realm"], results)
+
+    def test_cancel(self):
+        self.grail.grail.add_missions([("mission %d" % i,) for i in range(5)])
+        grail = AsyncGrail(self.grail.grail, workers=1, stream_size=1)
+        blocker = threading.Event()
+        running = grail.run(blocker.wait)
+        stalled = grail.list_missions()
+        stalled.next()
+        future = grail.add_mission("mission")
+        stream = grail.list_missions()
+        self.assertTrue(future.cancel())
+        self.assertTrue(future.cancelled())
+        self.assertTrue(stream.future.cancel())
+        blocker.set()
+        stalled.close()
+        self.assertRaises(CallCancelled, future.result)
+        self.assertRaises(CallCancelled, list, stream)
+        self.assertEqual(5, len(list(grail.list_missions())))
+        grail.close()
+
+    def test_slow_consumer(self):
+        self.grail.grail.add_missions([("mission %d" % i,) for i in range(10)])
+        stream = self.grail.list_missions()
+        self.assertEqual("mission 0", stream.next().description)
+        time.sleep(0.2)
+        # the worker wait for the consumer
+        self.assertFalse(stream.future.done())
+        stream.close()
+        self.assertTrue(stream.future.wait(5))
+        self.assertEqual(10, len(list(self.grail.list_missions())))
+
+    def test_queue_full(self):
+        grail = AsyncGrail(self.grail.grail, workers=1, queue_size=1)
+        blocker = threading.Event()
+        running = grail.run(blocker.wait)
+        while not running._state == "running":
+            time.sleep(0.01)
+        queued = grail.run(lambda: "queued")
+        # the caller isn't blocked
+        refused = grail.add_mission("mission")
+        self.assertTrue(refused.done())
+        self.assertRaises(CallQueueFull, refused.result)
+        blocker.set()
+        self.assertEqual("queued", queued.result())
+        grail.close()
+
+    def test_stalled_streams(self):
+        self.grail.grail.add_missions([("mission %d" % i,) for i in range(10)])
+        grail = AsyncGrail(self.grail.grail, workers=2, queue_size=1, stream_size=2)
+        stalled = []
+        for i in range(2):
+            stalled.append(grail.list_missions())
+            stalled[-1].next()
+        waiting = grail.list_missions()
+        # every worker of the iterators wait for its consumer
+        self.assertRaises(CallQueueFull, list, grail.list_missions())
+        # but the other calls are still made
+        self.assertEqual("default realm", grail.get_default_realm().result().description)
+        for i in stalled:
+            i.close()
+        self.assertEqual(10, len(list(waiting)))
+        grail.close()
+
+    def test_next_chunk(self):
+        self.grail.grail.add_missions([("mission %d" % i,) for i in range(5)])
+        stream = self.grail.list_missions()
+        descriptions = []
+        chunk = stream.next_chunk().result()
+        while chunk:
+            self.assertTrue(len(chunk) <= 2)
+            descriptions += [i.description for i in chunk]
+            chunk = stream.next_chunk(1).result()
+        self.assertEqual(["mission %d" % i for i in range(5)], descriptions)
+        self.assertEqual([], stream.next_chunk().result())
+        stream = self.grail.list_missions(unknown_argument=True)
+        self.assertRaises(TypeError, stream.next_chunk().result)
+
+    def test_next_chunk_callback(self):
+        self.grail.grail.add_missions([("mission %d" % i,) for i in range(3)])
+        stream = self.grail.list_missions()
+        chunks = []
+        done = threading.Event()
+        def callback(future):
+            chunk = future.result()
+            chunks.append(len(chunk))
+            if chunk:
+                stream.next_chunk().add_done_callback(callback)
+            else:
+                done.set()
+        stream.next_chunk().add_done_callback(callback)
+        self.assertTrue(done.wait(5))
+        self.assertEqual(3, sum(chunks))
+
+    def test_abandoned_stream(self):
+        grail = AsyncGrail(self.grail.grail, workers=1, stream_size=2)
+        self.grail.grail.add_missions([("mission %d" % i,) for i in range(10)])
+        stream = grail.list_missions()
+        future = stream.future
+        stream.next()
+        del stream
+        # the worker isn't waiting for the stream anymore
+        self.assertTrue(future.wait(5))
+        self.assertEqual(10, len(list(grail.list_missions())))
+        grail.close()
+
 if __name__ == "__main__":
    unittest.main()
 